@@ -0,0 +1,155 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import add_arguments, configure_from_args, instruments
+from elevation import ElevationProvider
+from flood import FloodScenario
+from itn_store import ITNStore
+from land_check import LandBoundary
+from node_index import NodeIndex
+from router import EASTING_RANGE, NORTHING_RANGE, elevation_file, init_worker, road_file, shape_file, worker_router
+
+
+# Route a group of users who start from the same road node in a worker process, with one search of the road graph.
+# The results are returned with the rows of the users, and the number of searches run.
+def route_group(users):
+    router = worker_router()
+    searches = router.get_searches()
+    results = router.route_group([(easting, northing) for _, easting, northing in users], validate=False)
+    return [(row, result) for (row, _, _), result in zip(users, results)], router.get_searches() - searches
+
+
+# Check in one vectorised pass whether each location is within the boundary of the elevation raster and on the land
+# of the Isle of Wight
+def on_land(shape_path, eastings, northings):
+    in_raster = ((eastings >= EASTING_RANGE[0]) & (eastings <= EASTING_RANGE[1]) &
+                 (northings >= NORTHING_RANGE[0]) & (northings <= NORTHING_RANGE[1]))
+    return in_raster & LandBoundary.open(shape_path).contains_xy(eastings, northings)
+
+
+# Find the nearest road node of each location in one bulk query of the persistent r-tree of all the road nodes.
+# -1 is returned for the locations without any road node within 5km, like ITN.nearest_node does.
+# The r-tree is closed afterwards, so that the workers forked next do not share its files.
+def nearest_nodes(store, eastings, northings):
+    node_index = NodeIndex.open(store)
+    try:
+        return node_index.nearest_batch(eastings, northings, max_distance=5000)
+    finally:
+        node_index.close()
+
+
+# Read a CSV or Parquet file of users
+def read_users(path):
+    if path.lower().endswith('.parquet'):
+        return pd.read_parquet(path)
+    return pd.read_csv(path)
+
+
+# Write the results to a CSV or Parquet file
+def write_results(results, path):
+    if path.lower().endswith('.parquet'):
+        results.to_parquet(path, index=False)
+    else:
+        results.to_csv(path, index=False)
+
+
+# Find the highest point, the route and the walking time of every user of a population file.
+# The locations are checked against the land boundary in one pass and snapped to the road nodes in bulk, and users
+# who share the same nearest road node are routed together by the same worker of a process pool.
+# With a water level, the users under water are found in the same pass from the flooded area of the scenario.
+# The routes can be kept in a SQLite route cache, shared by the workers and reused by the next batches.
+def run_batch(users_path, output_path, workers=None, easting_column='easting', northing_column='northing',
+              shape_path=shape_file, road_path=road_file, elevation_path=elevation_file, closures_path=None,
+              water_level=None, cache_path=None, cache_size=100000):
+    start = time.perf_counter()
+    users = read_users(users_path)
+    eastings = users[easting_column].to_numpy(dtype=np.float64)
+    northings = users[northing_column].to_numpy(dtype=np.float64)
+
+    with instruments.stage('batch_land_check'):
+        valid = on_land(shape_path, eastings, northings)
+    under_water = np.zeros(len(users), dtype=bool)
+    if water_level is not None:
+        dem = ElevationProvider.open(elevation_path)
+        flood = FloodScenario.load(dem, water_level)
+        under_water[valid] = flood.regions_xy(eastings[valid], northings[valid]) == 0
+        valid &= ~under_water
+        # The raster is closed before the workers are forked, so that they do not share its file
+        dem.close()
+    store = ITNStore(road_path).open()
+    nodes = np.full(len(users), -1, dtype=np.int64)
+    with instruments.stage('batch_nearest_nodes'):
+        nodes[valid] = nearest_nodes(store, eastings[valid], northings[valid])
+    print(str(int(valid.sum())) + ' of ' + str(len(users)) + ' users are on the land of Isle of Wight, ' +
+          str(len(np.unique(nodes[nodes >= 0]))) + ' nearest road nodes.\n')
+
+    # Group the users by their nearest road node
+    groups = {}
+    for row in np.flatnonzero(nodes >= 0).tolist():
+        groups.setdefault(int(nodes[row]), []).append((row, float(eastings[row]), float(northings[row])))
+
+    results = [{} for _ in range(len(users))]
+    for row in np.flatnonzero(~valid & ~under_water).tolist():
+        results[row] = {'error': 'The position is not on the land of Isle of Wight.'}
+    for row in np.flatnonzero(under_water).tolist():
+        results[row] = {'error': 'Error! The user location is under water at a water level of ' +
+                                 format(float(water_level), 'g') + ' m!!!'}
+    for row in np.flatnonzero(valid & (nodes < 0)).tolist():
+        results[row] = {'error': 'Sorry, no ITN node found within 5km!'}
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(shape_path, road_path, elevation_path, closures_path, water_level,
+                                       cache_size if cache_path is not None else 0, cache_path,
+                                       instruments.get_config())) as pool:
+        chunksize = max(1, len(groups) // ((workers or os.cpu_count() or 1) * 4))
+        searches = 0  # searches of the road graph run by the workers
+        for group, group_searches in pool.map(route_group, list(groups.values()), chunksize=chunksize):
+            searches += group_searches
+            for row, result in group:
+                results[row] = result
+
+    output = users.copy()
+    output['node_user'] = [result.get('node_user') for result in results]
+    output['highest_easting'] = [result['highest_point'][0] if 'highest_point' in result else np.nan
+                                 for result in results]
+    output['highest_northing'] = [result['highest_point'][1] if 'highest_point' in result else np.nan
+                                  for result in results]
+    output['walking_time'] = [result.get('walking_time', np.nan) for result in results]
+    output['walking_time_mins'] = output['walking_time'] / 60.0
+    output['route'] = [json.dumps(result['route']) if 'route' in result else None for result in results]
+    output['error'] = [result.get('error') for result in results]
+    write_results(output, output_path)
+
+    elapsed = time.perf_counter() - start
+    print('Routed ' + str(len(users)) + ' users in ' + str(round(elapsed, 2)) + ' s (' +
+          str(round(len(users) / elapsed, 2)) + ' users/second, ' + str(searches) + ' searches of the road graph).')
+    return output
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evacuation routes for a whole population file.')
+    parser.add_argument('users', help='CSV or Parquet file with the easting and northing of each user')
+    parser.add_argument('output', help='CSV or Parquet file to write the results to')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--easting-column', default='easting')
+    parser.add_argument('--northing-column', default='northing')
+    parser.add_argument('--closures', help='JSON file of road closures (see closures.py)')
+    parser.add_argument('--water-level', type=float, help='water level (m) of the flood scenario')
+    parser.add_argument('--cache', help='SQLite file of a route cache reused by the next batches')
+    parser.add_argument('--cache-size', type=int, default=100000, help='results kept in the route cache')
+    add_arguments(parser)
+    args = parser.parse_args()
+    configure_from_args(args)
+    run_batch(args.users, args.output, args.workers, args.easting_column, args.northing_column,
+              closures_path=args.closures, water_level=args.water_level, cache_path=args.cache,
+              cache_size=args.cache_size)
+
+
+if __name__ == '__main__':
+    main()
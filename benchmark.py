@@ -0,0 +1,389 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import time
+import tracemalloc
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+import shapely
+from rasterio import features
+from rasterio.transform import from_origin
+from shapely.geometry import LineString, Point, Polygon
+
+from elevation import ElevationProvider
+from itn_store import ITNStore
+from land_check import LandBoundary
+from naismith_graph import NaismithGraph
+from node_index import NodeIndex
+from router import EASTING_RANGE, NORTHING_RANGE, EvacuationRouter, elevation_file, road_file, shape_file
+from routing import ROUTING_BACKENDS
+from summit_index import SummitIndex
+from task2 import HighestPoint
+from task3 import ITN
+from task4 import ShortestPath
+
+# Files of the synthetic data, relative to the root folder of a benchmark, in the same layout as Material/
+links_file = 'Material/roads/links.shp'
+nodes_file = 'Material/roads/nodes.shp'
+background_file = 'Material/background/raster-50k_2724246.tif'
+
+# Sizes of the synthetic data: distance (m) between neighbouring road nodes and cell size (m) of the DEM.
+# The area is the extent of SZ.asc (EASTING_RANGE x NORTHING_RANGE): 'small' has about 2 400 road nodes, 'island' about
+# 26 000 and 'county' about 650 000.
+PRESETS = {
+    'small': {'spacing': 500, 'cell_size': 50},
+    'island': {'spacing': 150, 'cell_size': 10},
+    'county': {'spacing': 30, 'cell_size': 5}
+}
+
+# Road types of the synthetic road links (descriptiveTerm), the first ones being the most common
+ROAD_TYPES = ('Local Street', 'Minor Road', 'B Road', 'A Road', 'Private Road - Restricted Access')
+
+# Stages timed for each query
+STAGES = ('highest_point', 'nearest_node', 'shortest_path', 'end_to_end', 'plot')
+
+
+# Extent (min_x, min_y, max_x, max_y) of the synthetic data
+def extent():
+    return EASTING_RANGE[0], NORTHING_RANGE[0], EASTING_RANGE[1], NORTHING_RANGE[1]
+
+
+# Outline of a synthetic island: an ellipse filling most of the extent with a wavy coast
+def island_outline(vertices=720):
+    min_x, min_y, max_x, max_y = extent()
+    centre_x, centre_y = (min_x + max_x) / 2, (min_y + max_y) / 2
+    angle = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+    radius = 1 + 0.05 * np.sin(7 * angle) + 0.03 * np.cos(13 * angle)
+    xs = centre_x + 0.42 * (max_x - min_x) * radius * np.cos(angle)
+    ys = centre_y + 0.40 * (max_y - min_y) * radius * np.sin(angle)
+    return Polygon(np.column_stack([xs, ys]))
+
+
+# Write a synthetic DEM as an ESRI ASCII grid: hills of random height and width on the island, and the sea at 0 m
+def generate_dem(path, cell_size, island, seed=0, hills=40):
+    rng = np.random.default_rng(seed)
+    min_x, min_y, max_x, max_y = extent()
+    ncols, nrows = int((max_x - min_x) / cell_size), int((max_y - min_y) / cell_size)
+    xs = min_x + (np.arange(ncols) + 0.5) * cell_size
+    ys = max_y - (np.arange(nrows) + 0.5) * cell_size
+    elevation = np.zeros((nrows, ncols), dtype=np.float32)
+    isle_min_x, isle_min_y, isle_max_x, isle_max_y = island.bounds
+    for _ in range(hills):
+        hill_x, hill_y = rng.uniform(isle_min_x, isle_max_x), rng.uniform(isle_min_y, isle_max_y)
+        height, width = rng.uniform(20, 200), rng.uniform(500, 4000)
+        # The hill is computed as the product of its profiles along x and y, row by row to bound the memory
+        profile_x = np.exp(-(xs - hill_x) ** 2 / (2 * width ** 2)).astype(np.float32)
+        profile_y = np.exp(-(ys - hill_y) ** 2 / (2 * width ** 2)).astype(np.float32)
+        rows = np.flatnonzero(profile_y > 1e-4)
+        elevation[rows] += height * profile_y[rows, np.newaxis] * profile_x
+    elevation += rng.uniform(0, 0.5, elevation.shape).astype(np.float32)
+    # The sea is flat, at 0 m
+    transform = from_origin(min_x, max_y, cell_size, cell_size)
+    elevation[features.rasterize([(island, 1)], out_shape=(nrows, ncols), transform=transform, fill=0) == 0] = 0
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write('ncols ' + str(ncols) + '\nnrows ' + str(nrows) + '\nxllcorner ' + str(min_x) + '\nyllcorner ' +
+                str(min_y) + '\ncellsize ' + str(cell_size) + '\nNODATA_value -9999\n')
+        np.savetxt(f, elevation, fmt='%.2f')
+    return elevation.shape
+
+
+# Write a synthetic ITN JSON file with the schema of solent_itn.json: a jittered grid of road nodes on the island, with
+# road links between neighbouring road nodes (a few of them missing) which bend once between their road nodes
+def generate_itn(path, spacing, island, seed=0):
+    rng = np.random.default_rng(seed)
+    isle_min_x, isle_min_y, isle_max_x, isle_max_y = island.bounds
+    grid_x = np.arange(isle_min_x, isle_max_x, spacing)
+    grid_y = np.arange(isle_min_y, isle_max_y, spacing)
+    xx, yy = np.meshgrid(grid_x, grid_y, indexing='ij')
+    coords = np.stack([xx, yy], axis=-1) + rng.uniform(-spacing / 4, spacing / 4, xx.shape + (2,))
+    on_land = shapely.contains_xy(island, coords[..., 0], coords[..., 1])
+
+    node_ids = np.full(xx.shape, '', dtype=object)
+    road_nodes = {}
+    for i, j in zip(*np.nonzero(on_land)):
+        node = 'osgb' + str(4000000000000000 + i * 100000 + j)
+        node_ids[i, j] = node
+        road_nodes[node] = {'coords': [round(float(coords[i, j, 0]), 3), round(float(coords[i, j, 1]), 3)]}
+
+    road_links = {}
+    for di, dj in ((1, 0), (0, 1)):
+        starts = np.argwhere(on_land[:on_land.shape[0] - di, :on_land.shape[1] - dj] & on_land[di:, dj:])
+        starts = starts[rng.random(len(starts)) > 0.05]
+        bends = rng.uniform(-spacing / 8, spacing / 8, (len(starts), 2))
+        road_types = rng.choice(len(ROAD_TYPES), len(starts), p=[0.5, 0.25, 0.12, 0.1, 0.03])
+        for (i, j), bend, road_type in zip(starts, bends, road_types):
+            start, end = coords[i, j], coords[i + di, j + dj]
+            middle = (start + end) / 2 + bend
+            link_coords = [[round(float(x), 3), round(float(y), 3)] for x, y in (start, middle, end)]
+            link = 'osgb' + str(5000000000000000 + len(road_links))
+            road_links[link] = {
+                'length': float(np.hypot(*np.diff(np.array(link_coords), axis=0).T).sum()),
+                'coords': link_coords,
+                'start': node_ids[i, j],
+                'end': node_ids[i + di, j + dj],
+                'descriptiveTerm': ROAD_TYPES[road_type],
+                'natureOfRoad': 'Single Carriageway'
+            }
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'roadnodes': road_nodes, 'roadlinks': road_links}, f)
+    return len(road_nodes), len(road_links)
+
+
+# Write the layers of the map (Task 5) of a synthetic ITN: road links and road nodes as shape files and a background
+# raster with a colormap
+def generate_map_layers(root, itn_path, cell_size=10, seed=0):
+    with open(itn_path, 'r') as f:
+        itn = json.load(f)
+    road_links = itn['roadlinks']
+    os.makedirs(os.path.join(root, os.path.dirname(links_file)), exist_ok=True)
+    gpd.GeoDataFrame({'fid': list(road_links),
+                      'descript_1': [link['descriptiveTerm'] for link in road_links.values()]},
+                     geometry=[LineString(link['coords']) for link in road_links.values()],
+                     crs=27700).to_file(os.path.join(root, links_file))
+    gpd.GeoDataFrame({'fid': list(itn['roadnodes'])},
+                     geometry=[Point(node['coords']) for node in itn['roadnodes'].values()],
+                     crs=27700).to_file(os.path.join(root, nodes_file))
+
+    rng = np.random.default_rng(seed)
+    min_x, min_y, max_x, max_y = extent()
+    width, height = int((max_x - min_x) / cell_size), int((max_y - min_y) / cell_size)
+    os.makedirs(os.path.join(root, os.path.dirname(background_file)), exist_ok=True)
+    with rasterio.open(os.path.join(root, background_file), 'w', driver='GTiff', width=width, height=height, count=1,
+                       dtype='uint8', crs='EPSG:27700', transform=from_origin(min_x, max_y, cell_size, cell_size),
+                       tiled=True, compress='deflate') as dst:
+        dst.write(rng.integers(0, 16, (height, width), dtype=np.uint8), 1)
+        dst.write_colormap(1, {i: (200 + i * 3, 220 - i * 2, 180 + i * 4, 255) for i in range(256)})
+
+
+# Generate the synthetic data of a preset (or of a given road node spacing and DEM cell size) in a root folder
+def generate(root, preset='small', spacing=None, cell_size=None, seed=0, map_layers=True):
+    spacing = spacing if spacing is not None else PRESETS[preset]['spacing']
+    cell_size = cell_size if cell_size is not None else PRESETS[preset]['cell_size']
+    island = island_outline()
+    os.makedirs(os.path.join(root, os.path.dirname(shape_file)), exist_ok=True)
+    gpd.GeoDataFrame({'id': [1]}, geometry=[island], crs=27700).to_file(os.path.join(root, shape_file))
+    shape = generate_dem(os.path.join(root, elevation_file), cell_size, island, seed)
+    print('DEM of ' + str(shape[1]) + ' x ' + str(shape[0]) + ' cells written.')
+    nodes, links = generate_itn(os.path.join(root, road_file), spacing, island, seed)
+    print('ITN of ' + str(nodes) + ' road nodes and ' + str(links) + ' road links written.')
+    if map_layers:
+        generate_map_layers(root, os.path.join(root, road_file), seed=seed)
+        print('Map layers written.')
+
+
+# Random locations on the land of the island, within the DEM
+def random_locations(root, count, seed=0):
+    rng = np.random.default_rng(seed)
+    land = LandBoundary.open(os.path.join(root, shape_file))
+    min_x, min_y, max_x, max_y = extent()
+    locations = np.zeros((0, 2))
+    while len(locations) < count:
+        xs, ys = rng.uniform(min_x, max_x, count * 2), rng.uniform(min_y, max_y, count * 2)
+        on_land = land.contains_xy(xs, ys)
+        locations = np.concatenate([locations, np.column_stack([xs[on_land], ys[on_land]])])
+    return locations[:count]
+
+
+# Time a call, and trace the peak memory it allocates if trace_memory is set.
+# The result, the elapsed time (s), the peak memory (bytes, 0 if not traced) and the error are returned. The error is
+# None if the call succeeded, otherwise the result is None and the error is the last message printed by the call (or
+# the exception raised).
+def measure(function, trace_memory=False):
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    messages = io.StringIO()
+    result, error = None, None
+    try:
+        with contextlib.redirect_stdout(messages):
+            result = function()
+    # Error handling: the tasks call exit() when there is no answer for the user, and any other failure of a stage is
+    # kept as the error of the query rather than stopping the benchmark
+    except (SystemExit, Exception) as e:
+        lines = [line for line in messages.getvalue().splitlines() if line.strip()]
+        error = lines[-1] if isinstance(e, SystemExit) and lines else repr(e)
+    elapsed = time.perf_counter() - start
+    peak = 0
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, elapsed, peak, error
+
+
+# Build the summit index of a DEM, releasing the DEM afterwards
+def build_summit_index(elevation_path):
+    dem = ElevationProvider.open(elevation_path)
+    try:
+        return SummitIndex(dem).build()
+    finally:
+        dem.close()
+
+
+# Time the building of the road network store, the road graph, the summit index and the r-tree of the road nodes
+def time_builds(root):
+    elevation_path = os.path.join(root, elevation_file)
+    store = ITNStore(os.path.join(root, road_file))
+    builds = {}
+    for build, function in (('itn_store', store.build),
+                            ('naismith_graph', lambda: NaismithGraph(store.open(), elevation_path).build()),
+                            ('summit_index', lambda: build_summit_index(elevation_path)),
+                            ('node_index', lambda: NodeIndex(store.open()).build())):
+        _, builds[build], _, error = measure(function)
+        # Error handling: the queries cannot be timed without the data built from the files
+        if error is not None:
+            print('Error! The ' + build + ' cannot be built (' + error + ')!!!')
+            exit(1)
+    return builds
+
+
+# Run the pipeline for random locations on the land and time each stage of each query.
+# The stages are the tasks run one after the other as by main.py (highest point, nearest road node, shortest path
+# with the road graph and the geometry of the route, and the map if plots is more than 0 for the first plots
+# queries), and the whole query answered by EvacuationRouter.
+def run(root, queries=100, backend='csr', plots=0, trace_memory=True, seed=0):
+    shape_path, road_path = os.path.join(root, shape_file), os.path.join(root, road_file)
+    elevation_path = os.path.join(root, elevation_file)
+    report = {'root': os.path.abspath(root), 'queries': queries, 'backend': backend, 'builds': time_builds(root)}
+
+    router = EvacuationRouter(shape_path, road_path, elevation_path, backend)
+    store = ITNStore(road_path).open()
+    dem = ElevationProvider.open(elevation_path)
+    summits = SummitIndex.load(dem)
+    samples = {stage: {'time': [], 'memory': [], 'failures': 0} for stage in STAGES}
+    failures = []  # stage and error of each failed query
+
+    # Add the time and memory of a stage, or its failure for the query. The result of the stage is returned, None if
+    # it failed, in which case the stages depending on it are skipped.
+    def record(stage, measured, k):
+        result, elapsed, peak, error = measured
+        if error is not None:
+            samples[stage]['failures'] += 1
+            failures.append({'query': k, 'stage': stage, 'error': error})
+            return None
+        samples[stage]['time'].append(elapsed)
+        samples[stage]['memory'].append(peak)
+        return result
+
+    for k, (x, y) in enumerate(random_locations(root, queries, seed).tolist()):
+        position = Point(x, y)
+        hp = HighestPoint(position, dem, summits)
+        highest_points = record('highest_point', measure(hp.get_highest_point, trace_memory), k)
+        path = None
+        if highest_points is not None:
+            buffer = hp.get_buffer()
+            itn = ITN(road_path, buffer, store)
+            if record('nearest_node', measure(lambda: itn.nearest_node(position), trace_memory), k) is not None:
+                shortest_path = ShortestPath(road_path, itn, hp.get_5k_transform(), buffer, store, backend)
+                path = record('shortest_path', measure(
+                    lambda: shortest_path.shortest_path(elevation_path, position, highest_points), trace_memory), k)
+        record('end_to_end', measure(lambda: router.route(x, y), trace_memory), k)
+        if k < plots and path is not None:
+            # Imported here so that the benchmark does not need matplotlib unless maps are timed
+            from map_layers import MapLayers
+            from task5 import Plotting
+            layers = MapLayers.open(shape_path, os.path.join(root, links_file), os.path.join(root, nodes_file),
+                                    os.path.join(root, background_file), elevation_path)
+            plotter = Plotting(position, path[2], path[3], layers)
+            record('plot', measure(lambda: plotter.plot_map(os.path.join(root, 'benchmark_map.png')), trace_memory),
+                   k)
+    router.close()
+    dem.close()
+
+    report['stages'] = {}
+    report['failures'] = failures
+    for stage, sample in samples.items():
+        if not sample['time']:
+            continue
+        times = np.array(sample['time']) * 1000
+        report['stages'][stage] = {
+            'count': len(times),
+            'failures': sample['failures'],
+            'p50_ms': float(np.percentile(times, 50)),
+            'p95_ms': float(np.percentile(times, 95)),
+            'p99_ms': float(np.percentile(times, 99)),
+            'mean_ms': float(times.mean()),
+            'peak_memory_mb': float(max(sample['memory'])) / 2 ** 20
+        }
+    return report
+
+
+# Print a report as a table
+def print_report(report):
+    print('Builds:')
+    for build, elapsed in report['builds'].items():
+        print('  ' + build.ljust(16) + str(round(elapsed, 3)) + ' s')
+    print('Stages (' + str(report['queries']) + ' queries, backend ' + report['backend'] + '):')
+    print('  ' + 'stage'.ljust(16) + ''.join(column.rjust(12) for column in ('p50 ms', 'p95 ms', 'p99 ms', 'peak MB')))
+    for stage, stats in report['stages'].items():
+        print('  ' + stage.ljust(16) + ''.join(str(round(stats[key], 2)).rjust(12)
+                                               for key in ('p50_ms', 'p95_ms', 'p99_ms', 'peak_memory_mb')))
+    if report['failures']:
+        print('Failures (' + str(len(report['failures'])) + ', not included in the latencies):')
+        for failure in report['failures']:
+            print('  query ' + str(failure['query']) + ' ' + failure['stage'] + ': ' + failure['error'])
+
+
+# Compare a report with a saved baseline, and return the stages whose p50 or p95 latency or peak memory is more than
+# tolerance (e.g. 0.2 for 20%) above the baseline
+def compare(report, baseline, tolerance=0.2):
+    regressions = []
+    for stage, stats in report['stages'].items():
+        if stage not in baseline['stages']:
+            continue
+        for key in ('p50_ms', 'p95_ms', 'peak_memory_mb'):
+            before, after = baseline['stages'][stage][key], stats[key]
+            if before > 0 and after > before * (1 + tolerance):
+                regressions.append((stage, key, before, after))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the evacuation pipeline on synthetic data.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    generate_parser = subparsers.add_parser('generate', help='generate synthetic data')
+    generate_parser.add_argument('root', help='folder to write the synthetic Material/ folder to')
+    generate_parser.add_argument('--preset', choices=list(PRESETS), default='small')
+    generate_parser.add_argument('--spacing', type=float, help='distance (m) between neighbouring road nodes')
+    generate_parser.add_argument('--cell-size', type=float, help='cell size (m) of the DEM')
+    generate_parser.add_argument('--seed', type=int, default=0)
+    generate_parser.add_argument('--no-map-layers', action='store_true', help='do not write the layers of the map')
+    run_parser = subparsers.add_parser('run', help='time the pipeline')
+    run_parser.add_argument('root', help='folder holding the Material/ folder')
+    run_parser.add_argument('--queries', type=int, default=100)
+    run_parser.add_argument('--backend', choices=ROUTING_BACKENDS, default='csr')
+    run_parser.add_argument('--plots', type=int, default=0, help='number of queries to draw the map of')
+    run_parser.add_argument('--no-memory', action='store_true', help='do not trace the memory (faster)')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--save', help='file to save the report to as a baseline')
+    run_parser.add_argument('--baseline', help='baseline to compare the report with')
+    run_parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        generate(args.root, args.preset, args.spacing, args.cell_size, args.seed, not args.no_map_layers)
+        return
+    report = run(args.root, args.queries, args.backend, args.plots, not args.no_memory, args.seed)
+    print_report(report)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for stage, key, before, after in regressions:
+            print('Regression: ' + stage + ' ' + key + ' ' + str(round(before, 2)) + ' -> ' + str(round(after, 2)))
+        if regressions:
+            exit(1)
+        print('No regression against ' + args.baseline + '.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+import argparse
+import json
+import math
+import os
+
+import geopandas as gpd
+import shapely
+from shapely.geometry import mapping, shape
+
+from map_layers import CRS_BNG
+
+
+# Road closures during a flood, as a list of closures of road links by their feature ids, of the road links within an
+# area (e.g. a flooded area) or of the road links with a road node at or below a water level. Each closure has a factor
+# of the walking time of its road links, None if they are impassable. The closures are kept in a JSON file which the
+# routers read again whenever it changes, so they can be updated as flood extents change without rebuilding the graph.
+class RoadClosures:
+
+    def __init__(self, closures=None):
+        self.__closures = list(closures) if closures is not None else []
+
+    # Closures of a JSON file, none if the file does not exist
+    @staticmethod
+    def read(path):
+        # Error handling: no file means no road closed
+        if not os.path.exists(path):
+            return RoadClosures()
+        with open(path, 'r') as f:
+            return RoadClosures(json.load(f)['closures'])
+
+    # Write the closures to a JSON file, under a temporary name and then moved into place so that a router never reads
+    # a half written file
+    def write(self, path):
+        temp_path = path + '.' + str(os.getpid()) + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'closures': self.__closures}, f)
+        os.replace(temp_path, path)
+
+    # Signature of a JSON file of closures (None if it does not exist), the closures are read again whenever it changes
+    @staticmethod
+    def file_signature(path):
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    # Method to return the closures
+    def get_closures(self):
+        return list(self.__closures)
+
+    # Close road links by their feature ids
+    def close_links(self, fids, factor=None):
+        self.__closures.append({'links': [str(fid) for fid in fids], 'factor': factor})
+        return self
+
+    # Close the road links intersecting a polygon in the British National Grid
+    def close_area(self, polygon, factor=None):
+        self.__closures.append({'area': mapping(polygon), 'factor': factor})
+        return self
+
+    # Close the road links with a road node at or below a water level (m)
+    def close_below(self, water_level, factor=None):
+        self.__closures.append({'water_level': float(water_level), 'factor': factor})
+        return self
+
+    # Reopen every road
+    def clear(self):
+        self.__closures = []
+        return self
+
+    # Factor of the walking time of each closed road link of a NaismithGraph (inf if impassable), as expected by
+    # NaismithGraph.set_link_factors. A road link closed more than once takes the largest factor.
+    def link_factors(self, naismith_graph):
+        store = naismith_graph.get_store()
+        factors = {}
+        for closure in self.__closures:
+            factor = math.inf if closure.get('factor') is None else float(closure['factor'])
+            if 'links' in closure:
+                links = []
+                for fid in closure['links']:
+                    # Error handling: an unknown road link is skipped, the other closures still apply
+                    try:
+                        links.append(store.link_index(fid))
+                    except KeyError:
+                        print('Road link ' + fid + ' does not exist in the road network, its closure is ignored.')
+            elif 'area' in closure:
+                links = naismith_graph.links_within(shape(closure['area'])).tolist()
+            else:
+                links = naismith_graph.links_below(closure['water_level']).tolist()
+            for link in links:
+                factors[link] = max(factors.get(link, 1.0), factor)
+        return factors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Add road closures to the JSON file read by the routers.')
+    parser.add_argument('closures', help='JSON file of the road closures')
+    parser.add_argument('--links', nargs='*', default=[], help='feature ids of the road links to close')
+    parser.add_argument('--area', help='vector file (e.g. GeoJSON) of the flooded areas whose road links are closed')
+    parser.add_argument('--water-level', type=float, help='close the road links with a road node at or below it (m)')
+    parser.add_argument('--factor', type=float, help='factor of the walking time of the road links (default: closed)')
+    parser.add_argument('--clear', action='store_true', help='reopen every road before adding the closures')
+    args = parser.parse_args()
+
+    closures = RoadClosures() if args.clear else RoadClosures.read(args.closures)
+    if args.links:
+        closures.close_links(args.links, args.factor)
+    if args.area is not None:
+        area = gpd.read_file(args.area)
+        if area.crs is not None:
+            area = area.to_crs(CRS_BNG)
+        closures.close_area(shapely.union_all(area.geometry.values), args.factor)
+    if args.water_level is not None:
+        closures.close_below(args.water_level, args.factor)
+    closures.write(args.closures)
+    print(str(len(closures.get_closures())) + ' road closures in ' + args.closures + '.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+import json
+import os
+import sys
+
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio.windows import Window
+
+
+# Elevation raster (DEM) opened once and read by windows in memory. Besides the formats of rasterio (e.g. SZ.asc or a
+# tiled GeoTIFF), it opens a raw .npy array, with its transform in a .json side file, which is memory-mapped so that a
+# window read is only a slice of the array. convert() writes both formats from the ASCII grid once.
+class ElevationProvider:
+    # Providers already opened by this process, keyed by the elevation file
+    __opened = {}
+
+    def __init__(self, elevation_file):
+        self.__elevation_file = elevation_file
+        self.__dataset = None
+        self.__array = None
+        self.__references = 0  # holders which have opened the provider with open() and not closed it yet
+        if elevation_file.lower().endswith('.npy'):
+            with open(elevation_file + '.json', 'r') as f:
+                meta = json.load(f)
+            self.__array = np.load(elevation_file, mmap_mode='r')
+            self.__transform = Affine(*meta['transform'])
+            self.__nodata = meta['nodata']
+            self.__crs = meta['crs']
+        else:
+            self.__dataset = rasterio.open(elevation_file)
+            self.__transform = self.__dataset.transform
+            self.__nodata = self.__dataset.nodata
+            self.__crs = self.__dataset.crs.to_wkt() if self.__dataset.crs else None
+        self.__height, self.__width = (self.__array.shape if self.__array is not None
+                                       else (self.__dataset.height, self.__dataset.width))
+
+    # Provider of an elevation file shared by every query of this process. Each holder which opens it has to close it
+    # once, and the raster is only released when the last of them does.
+    @staticmethod
+    def open(elevation_file):
+        key = os.path.abspath(elevation_file)
+        provider = ElevationProvider.__opened.get(key)
+        if provider is None:
+            provider = ElevationProvider(elevation_file)
+            ElevationProvider.__opened[key] = provider
+        provider.__references += 1
+        return provider
+
+    # Methods to return the properties of the raster
+    def get_elevation_file(self):
+        return self.__elevation_file
+
+    def get_transform(self):
+        return self.__transform
+
+    def get_nodata(self):
+        return self.__nodata
+
+    def get_shape(self):
+        return self.__height, self.__width
+
+    # Cell size (m) of the raster
+    def get_cell_size(self):
+        return abs(self.__transform.a)
+
+    # Read the whole raster
+    def read(self):
+        if self.__array is not None:
+            return np.asarray(self.__array)
+        return self.__dataset.read(1)
+
+    # Window of the raster covering a bounding box, cut at the edge of the raster. None if they do not overlap.
+    def window(self, min_x, min_y, max_x, max_y):
+        col_start, row_start = ~self.__transform * (min_x, max_y)
+        col_stop, row_stop = ~self.__transform * (max_x, min_y)
+        col_start, row_start = max(int(np.floor(col_start)), 0), max(int(np.floor(row_start)), 0)
+        col_stop, row_stop = min(int(np.ceil(col_stop)), self.__width), min(int(np.ceil(row_stop)), self.__height)
+        if col_start >= col_stop or row_start >= row_stop:
+            return None
+        return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+    # Read a window of the raster, returning the array and its transform
+    def read_window(self, window):
+        if self.__array is not None:
+            array = np.asarray(self.__array[window.row_off:window.row_off + window.height,
+                                            window.col_off:window.col_off + window.width])
+        else:
+            array = self.__dataset.read(1, window=window)
+        return array, rasterio.windows.transform(window, self.__transform)
+
+    # Read the cells within a radius of a location, i.e. the window of the circle around it, cut at the edge of the
+    # raster. Like rasterio.mask.mask with all_touched=True, a cell is kept if any part of it is within the circle,
+    # and the other cells are filled with the nodata value of the raster (0 if it has none).
+    # The array, its transform and the mask of the cells within the circle are returned.
+    def read_circle(self, x, y, radius):
+        window = self.window(x - radius, y - radius, x + radius, y + radius)
+        if window is None:
+            return np.zeros((0, 0)), self.__transform, np.zeros((0, 0), dtype=bool)
+        array, transform = self.read_window(window)
+        mask = self.circle_mask(transform, array.shape, x, y, radius)
+        fill = self.__nodata if self.__nodata is not None else 0
+        return np.where(mask, array, np.array(fill, dtype=array.dtype)), transform, mask
+
+    # Mask of the cells of a window touching a circle: the distance from the centre of the circle to the nearest
+    # point of the cell is at most the radius
+    @staticmethod
+    def circle_mask(transform, shape, x, y, radius):
+        half_x, half_y = abs(transform.a) / 2, abs(transform.e) / 2
+        centre_x = transform.c + (np.arange(shape[1]) + 0.5) * transform.a
+        centre_y = transform.f + (np.arange(shape[0]) + 0.5) * transform.e
+        dx = np.maximum(np.abs(centre_x - x) - half_x, 0)
+        dy = np.maximum(np.abs(centre_y - y) - half_y, 0)
+        return dy[:, np.newaxis] ** 2 + dx[np.newaxis, :] ** 2 <= radius ** 2
+
+    # Release the raster once every holder which has opened it has closed it
+    def close(self):
+        self.__references = max(self.__references - 1, 0)
+        if self.__references > 0:
+            return
+        if self.__dataset is not None:
+            self.__dataset.close()
+        ElevationProvider.__opened.pop(os.path.abspath(self.__elevation_file), None)
+
+    # Convert an elevation raster (e.g. SZ.asc) once into a format which is cheap to read by windows: a tiled GeoTIFF
+    # (.tif) or a raw memory-mapped array (.npy) with its transform in a .json side file
+    @staticmethod
+    def convert(elevation_file, output_file):
+        with rasterio.open(elevation_file) as src:
+            elevation = src.read(1)
+            if output_file.lower().endswith('.npy'):
+                np.save(output_file, elevation)
+                meta = {'transform': list(src.transform)[:6], 'nodata': src.nodata,
+                        'crs': src.crs.to_wkt() if src.crs else None}
+                with open(output_file + '.json', 'w') as f:
+                    json.dump(meta, f)
+            else:
+                profile = src.profile
+                profile.update(driver='GTiff', tiled=True, blockxsize=256, blockysize=256, compress='deflate')
+                with rasterio.open(output_file, 'w', **profile) as dst:
+                    dst.write(elevation, 1)
+
+
+# Convert the DEM once, e.g. python elevation.py Material/elevation/SZ.asc Material/elevation/SZ.npy
+if __name__ == '__main__':
+    ElevationProvider.convert(sys.argv[1], sys.argv[2])
+    print('Elevation raster converted to ' + sys.argv[2] + '.')
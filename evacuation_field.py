@@ -0,0 +1,233 @@
+import argparse
+import hashlib
+import json
+import os
+
+import geopandas as gpd
+import numpy as np
+from shapely.geometry import LineString, MultiLineString, Point, mapping
+
+from elevation import ElevationProvider
+from itn_store import ITNStore
+from naismith_graph import NaismithGraph
+from node_index import NodeIndex
+from router import EvacuationRouter, elevation_file, road_file, shape_file
+from routing import CSRGraph
+from summit_index import SummitIndex
+
+
+# Routing table of the whole road network towards high ground, computed ahead of time.
+# The summits are the highest points of the 5km neighbourhoods centred on a regular grid over the road network (or a
+# given list of summits). A reverse multi-source Dijkstra from the road nodes nearest to the summits stores, for every
+# road node, the walking time to the nearest summit by Naismith's rule and the next road node on the way to it.
+# A query is then a nearest road node lookup followed by the next hop pointers, without any search.
+class EvacuationField:
+    # Version of the field file, it has to be increased whenever the arrays written by build() change
+    VERSION = 1
+
+    def __init__(self, store, elevation_file, spacing=1000, radius=5000):
+        self.__store = store
+        self.__elevation_file = elevation_file
+        self.__spacing = spacing  # distance (m) between the centres of the neighbourhoods
+        self.__radius = radius  # radius (m) of the neighbourhoods
+        self.__field_file = os.path.join(store.get_store_dir(), 'evacuation_field.npz')
+        self.__arrays = {}
+
+    # Load the field from its file if it is up to date, otherwise build it
+    @staticmethod
+    def load(store, elevation_file, spacing=1000, radius=5000):
+        field = EvacuationField(store, elevation_file, spacing, radius)
+        if field.is_stale():
+            print('Building the evacuation field of the whole network...\n')
+            return field.build()
+        return field.read()
+
+    # Signature of the road graph and of the parameters the field is built from. A field built from a given list of
+    # summits is signed with a hash of them, so that load() never takes it for the field of the neighbourhood summits.
+    def signature(self, summits=None):
+        graph_signature = NaismithGraph(self.__store, self.__elevation_file).signature()
+        if summits is not None:
+            summits = np.array(summits, dtype=np.float64).reshape(-1, 2)
+            summits = hashlib.sha1(summits.tobytes()).hexdigest()
+        return {'version': self.VERSION, 'graph': graph_signature, 'spacing': self.__spacing, 'radius': self.__radius,
+                'summits': summits}
+
+    # Check whether the field file is missing or has been built from different data
+    def is_stale(self):
+        if not os.path.exists(self.__field_file):
+            return True
+        with np.load(self.__field_file) as cached:
+            return json.loads(str(cached['signature'])) != self.signature()
+
+    # Highest point of every 5km neighbourhood centred on a regular grid over the road network, found with the summit
+    # index of the DEM. Like HighestPoint, every cell with the highest elevation of a neighbourhood is kept, and
+    # neighbourhoods below the waterline are skipped.
+    def neighbourhood_summits(self):
+        node_coords = np.asarray(self.__store.get_node_coords())
+        dem = ElevationProvider.open(self.__elevation_file)
+        summit_index = SummitIndex.load(dem)
+        transform = dem.get_transform()
+        xs = np.arange(node_coords[:, 0].min(), node_coords[:, 0].max() + self.__spacing, self.__spacing)
+        ys = np.arange(node_coords[:, 1].min(), node_coords[:, 1].max() + self.__spacing, self.__spacing)
+        summits = set()
+        for x in xs.tolist():
+            for y in ys.tolist():
+                highest, rows, cols = summit_index.query(x, y, self.__radius)
+                if highest <= 0:
+                    continue
+                for row, col in zip(rows.tolist(), cols.tolist()):
+                    summits.add(transform * (col + 0.5, row + 0.5))
+        dem.close()
+        return sorted(summits)
+
+    # Compute the walking time to safety and the next hop of every road node.
+    # summits is an optional list of (easting, northing) of candidate summits, the highest points of the 5km
+    # neighbourhoods are used otherwise.
+    def build(self, summits=None):
+        signature = self.signature(summits)
+        graph = NaismithGraph.load(self.__store, self.__elevation_file)
+        if summits is None:
+            summits = self.neighbourhood_summits()
+        summits = np.array(summits, dtype=np.float64).reshape(-1, 2)
+        summit_nodes = NodeIndex.open(self.__store).nearest_batch(summits[:, 0], summits[:, 1])
+
+        # The reverse graph holds each edge u -> v of the road graph as v -> u, so that the multi-source Dijkstra from
+        # the summits finds the walking time from every road node to its nearest summit
+        reverse = CSRGraph(len(self.__store.get_node_ids()), graph.get_edge_to(), graph.get_edge_from(),
+                           graph.get_edge_weight(), graph.get_edge_link())
+        time_to_safety, next_hop, next_edge, origin = reverse.multi_source_dijkstra(summit_nodes.tolist())
+        next_link = np.array([reverse.edge_link(k) if k >= 0 else -1 for k in next_edge.tolist()], dtype=np.int64)
+
+        self.__arrays = {
+            'time_to_safety': time_to_safety,
+            'next_hop': next_hop,
+            'next_link': next_link,
+            'summit': origin,
+            'summits': summits,
+            'summit_nodes': summit_nodes
+        }
+        temp_file = self.__field_file + '.' + str(os.getpid()) + '.tmp.npz'
+        np.savez(temp_file, signature=np.array(json.dumps(signature)), **self.__arrays)
+        os.replace(temp_file, self.__field_file)
+        return self
+
+    # Read the arrays from the field file
+    def read(self):
+        with np.load(self.__field_file) as cached:
+            self.__arrays = {name: cached[name] for name in cached.files if name != 'signature'}
+        return self
+
+    # Methods to return the arrays of the field
+    # Walking time (s) from each road node to its nearest summit, inf if no summit can be reached
+    def get_time_to_safety(self):
+        return self.__arrays['time_to_safety']
+
+    # Next road node on the way from each road node to its summit, -1 at the summits
+    def get_next_hop(self):
+        return self.__arrays['next_hop']
+
+    # Road link to the next hop of each road node, -1 at the summits
+    def get_next_link(self):
+        return self.__arrays['next_link']
+
+    # Position in get_summits() of the summit each road node goes to, -1 if no summit can be reached
+    def get_summit(self):
+        return self.__arrays['summit']
+
+    # Coordinates of the summits
+    def get_summits(self):
+        return self.__arrays['summits']
+
+    # Road node nearest to each summit
+    def get_summit_nodes(self):
+        return self.__arrays['summit_nodes']
+
+    # Index of the road node nearest to a location, from the persistent r-tree of all the road nodes
+    def nearest_node(self, x, y):
+        return int(NodeIndex.open(self.__store).nearest(x, y)[0])
+
+    # Route from a location to high ground by following the next hop pointers from its nearest road node.
+    # The result has the same layout as EvacuationRouter.route.
+    def route(self, easting, northing):
+        node = self.nearest_node(easting, northing)
+        result = {'user': [float(easting), float(northing)]}
+        summit = int(self.get_summit()[node])
+        if summit < 0:
+            result['error'] = 'Sorry, no summit can be reached from your location!'
+            return result
+
+        node_ids = self.__store.get_node_ids()
+        link_ids = self.__store.get_link_ids()
+        next_hop, next_link = self.get_next_hop(), self.get_next_link()
+        links = []
+        u = node
+        while next_hop[u] >= 0:
+            links.append(int(next_link[u]))
+            u = int(next_hop[u])
+        result.update({
+            'node_user': str(node_ids[node]),
+            'node_highest': str(node_ids[u]),
+            'highest_point': self.get_summits()[summit].tolist(),
+            'walking_time': float(self.get_time_to_safety()[node]),
+            'route': [str(link_ids[link]) for link in links],
+            'geometry': mapping(MultiLineString([LineString(self.__store.get_link_coords_of(link))
+                                                 for link in links]))
+        })
+        return result
+
+    # Compare the field with the 5km-radius rule of EvacuationRouter at a sample of road nodes, and return where the
+    # two give a different destination or walking time as a GeoDataFrame of the road nodes
+    def validate(self, router, samples=200, seed=0, tolerance=1e-6):
+        reachable = np.flatnonzero(self.get_summit() >= 0)
+        rng = np.random.default_rng(seed)
+        nodes = rng.choice(reachable, size=min(samples, len(reachable)), replace=False)
+        node_coords = self.__store.get_node_coords()
+        rows = []
+        for node in nodes.tolist():
+            x, y = node_coords[node]
+            field_result = self.route(x, y)
+            rule_result = router.route(x, y)
+            rule_time = rule_result.get('walking_time', np.inf)
+            same_node = rule_result.get('node_highest') == field_result['node_highest']
+            rows.append({
+                'node': field_result['node_user'],
+                'field_time': field_result['walking_time'],
+                'rule_time': rule_time,
+                'field_highest': field_result['node_highest'],
+                'rule_highest': rule_result.get('node_highest'),
+                'rule_error': rule_result.get('error'),
+                'differs': not same_node or abs(field_result['walking_time'] - rule_time) > tolerance,
+                'geometry': Point(x, y)
+            })
+        differences = gpd.GeoDataFrame(rows, geometry='geometry', crs=27700)
+        print(str(int(differences['differs'].sum())) + ' of ' + str(len(differences)) +
+              ' sampled road nodes give a different answer from the 5km-radius rule.\n')
+        return differences
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precomputed evacuation field of the whole road network.')
+    parser.add_argument('command', choices=('build', 'route', 'validate'))
+    parser.add_argument('coords', nargs='*', type=float, help='easting and northing for the route command')
+    parser.add_argument('--spacing', type=float, default=1000, help='distance (m) between neighbourhood centres')
+    parser.add_argument('--samples', type=int, default=200, help='number of road nodes checked by validate')
+    parser.add_argument('--output', help='file to write the road nodes checked by validate to (e.g. GeoJSON)')
+    args = parser.parse_args()
+
+    store = ITNStore(road_file).open()
+    if args.command == 'build':
+        field = EvacuationField(store, elevation_file, args.spacing).build()
+        print(str(len(field.get_summits())) + ' summits, ' + str(int(np.isfinite(field.get_time_to_safety()).sum())) +
+              ' road nodes can reach one of them.')
+        return
+    field = EvacuationField.load(store, elevation_file, args.spacing)
+    if args.command == 'route':
+        print(json.dumps(field.route(*args.coords)))
+    else:
+        differences = field.validate(EvacuationRouter(shape_file, road_file, elevation_file), args.samples)
+        if args.output:
+            differences.to_file(args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+import json
+import os
+
+import numpy as np
+from scipy import ndimage
+
+from link_profiles import LinkProfiles, chunk_links, count_link_samples, sample_links
+
+
+# Flooded area and dry regions of the elevation raster (DEM) for a water level (m).
+# The water rises from the sea: a cell is flooded if it is at or below the water level and connected to the sea (cells
+# at or below 0 m, without data or on the edge of the raster) through such cells, so that a dry hollow inland is not
+# flooded. The dry cells are then labelled by connected regions, and a place can only be reached on foot from the
+# places of the same region. Both come from two labellings of connected components of the whole raster with
+# scipy.ndimage, computed once for each water level and saved next to the DEM as a memory-mapped array of the region of
+# each cell (0 if it is flooded), which every query and every process then shares.
+class FloodScenario:
+    # Version of the file, it has to be increased whenever the labels computed by build() change
+    VERSION = 1
+    # Scenarios already opened by this process, keyed by the elevation file and the water level
+    __opened = {}
+
+    def __init__(self, dem, water_level):
+        self.__dem = dem  # ElevationProvider of the raster
+        self.__water_level = float(water_level)
+        # The extension of the DEM is kept, so that SZ.asc and its conversions (e.g. SZ.npy) have their own labels
+        self.__labels_file = dem.get_elevation_file() + '.flood_' + format(self.__water_level, 'g') + 'm.npy'
+        self.__labels = None  # region of each cell, 0 if it is flooded
+        self.__regions = 0  # number of dry regions
+
+    # Scenario of a water level shared by every query of this process: read from its file if it is up to date,
+    # otherwise computed and saved first
+    @staticmethod
+    def load(dem, water_level):
+        key = (os.path.abspath(dem.get_elevation_file()), float(water_level))
+        scenario = FloodScenario.__opened.get(key)
+        if scenario is None:
+            scenario = FloodScenario(dem, water_level)
+            if scenario.is_stale():
+                print('Computing the flooded area at a water level of ' + format(float(water_level), 'g') + ' m...\n')
+                scenario.build()
+            else:
+                scenario.read()
+            FloodScenario.__opened[key] = scenario
+        return scenario
+
+    # Signature of the elevation file and of the water level, the labels are computed again whenever it changes
+    def signature(self):
+        stat = os.stat(self.__dem.get_elevation_file())
+        return {'version': self.VERSION, 'water_level': self.__water_level,
+                'elevation': [stat.st_size, stat.st_mtime_ns]}
+
+    # Check whether the file is missing or has been computed from different data
+    def is_stale(self):
+        if not os.path.exists(self.__labels_file + '.json'):
+            return True
+        with open(self.__labels_file + '.json', 'r') as f:
+            return json.load(f)['signature'] != self.signature()
+
+    # Compute the flooded cells and label the dry regions
+    def build(self):
+        signature = self.signature()
+        elevation = self.__dem.read()
+        sea = elevation <= 0
+        if self.__dem.get_nodata() is not None:
+            sea |= elevation == self.__dem.get_nodata()
+        water = (elevation <= self.__water_level) | sea
+
+        # Connected areas under the water level, flooded if one of their cells is in the sea or on the edge of the
+        # raster, where the water may come from beyond it
+        low, _ = ndimage.label(water)
+        seeds = sea.copy()
+        seeds[[0, -1], :] |= water[[0, -1], :]
+        seeds[:, [0, -1]] |= water[:, [0, -1]]
+        flooded_areas = np.zeros(low.max() + 1, dtype=bool)
+        flooded_areas[low[seeds]] = True
+        flooded_areas[0] = False
+        flooded = flooded_areas[low]
+
+        labels, regions = ndimage.label(~flooded)
+        self.__labels = labels.astype(np.int32)
+        self.__regions = int(regions)
+
+        # The array is written under a temporary name and then moved into place, and its side file is written last
+        temp_file = self.__labels_file + '.' + str(os.getpid()) + '.tmp.npy'
+        np.save(temp_file, self.__labels)
+        os.replace(temp_file, self.__labels_file)
+        temp_file = self.__labels_file + '.' + str(os.getpid()) + '.tmp.json'
+        with open(temp_file, 'w') as f:
+            json.dump({'signature': signature, 'regions': self.__regions}, f)
+        os.replace(temp_file, self.__labels_file + '.json')
+        return self
+
+    # Read the labels from the file, memory-mapped
+    def read(self):
+        with open(self.__labels_file + '.json', 'r') as f:
+            self.__regions = json.load(f)['regions']
+        self.__labels = np.load(self.__labels_file, mmap_mode='r')
+        return self
+
+    # Methods to return the properties of the scenario
+    def get_water_level(self):
+        return self.__water_level
+
+    # Number of dry regions
+    def get_regions(self):
+        return self.__regions
+
+    # Region of each cell of the raster, 0 if it is flooded
+    def get_labels(self):
+        return self.__labels
+
+    # Region of each cell of a window of the raster
+    def read_window(self, window):
+        return np.asarray(self.__labels[window.row_off:window.row_off + window.height,
+                                        window.col_off:window.col_off + window.width])
+
+    # Region of locations, 0 if they are flooded or beyond the raster
+    def regions_xy(self, xs, ys):
+        cols, rows = ~self.__dem.get_transform() * (np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64))
+        rows, cols = np.floor(rows).astype(np.int64), np.floor(cols).astype(np.int64)
+        height, width = self.__labels.shape
+        inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+        regions = np.zeros(len(rows), dtype=np.int32)
+        regions[inside] = self.__labels[rows[inside], cols[inside]]
+        return regions
+
+    # Region of a location, 0 if it is flooded or beyond the raster
+    def region_at(self, x, y):
+        return int(self.regions_xy([x], [y])[0])
+
+    # Road links of the road graph (NaismithGraph) under water, i.e. whose geometry crosses a flooded cell.
+    # The road links are sampled like their elevation profiles (see link_profiles.py): at every vertex and at points
+    # spaced by at most the cell size along the segments between them, so that a segment crossing a flooded valley
+    # between two dry vertices is found. Two consecutive points are then at most one row and one column of cells
+    # apart, and when they are in diagonal cells the segment between them also crosses one of the two other cells
+    # around their common corner, which is tested too. Like the elevation of the road nodes, the points beyond the edge
+    # of the raster take the nearest edge cell.
+    def flooded_links(self, naismith_graph):
+        store = naismith_graph.get_store()
+        coords = np.asarray(store.get_link_coords())
+        offsets = np.asarray(store.get_link_offsets())
+        flooded = np.zeros(len(offsets) - 1, dtype=bool)
+        segment_points, link_points = count_link_samples(coords, offsets, self.__dem.get_cell_size())
+        for first, last in chunk_links(link_points, LinkProfiles.CHUNK_SAMPLES):
+            xs, ys, _, _, link = sample_links(coords, offsets, segment_points, first, last)
+            cols, rows = ~self.__dem.get_transform() * (xs, ys)
+            cell_rows, cell_cols = np.floor(rows).astype(np.int64), np.floor(cols).astype(np.int64)
+            flooded[link[self.__is_flooded(cell_rows, cell_cols)]] = True
+
+            # Corner cell crossed between consecutive points of the same road link in diagonal cells: the cell of the
+            # column of the second point if the segment crosses the column boundary first, otherwise that of its row.
+            # A segment going exactly through the corner only touches the other two cells.
+            a = np.flatnonzero((link[1:] == link[:-1]) & (np.diff(cell_rows) != 0) & (np.diff(cell_cols) != 0))
+            b = a + 1
+            to_column = (np.maximum(cell_cols[a], cell_cols[b]) - cols[a]) / (cols[b] - cols[a])
+            to_row = (np.maximum(cell_rows[a], cell_rows[b]) - rows[a]) / (rows[b] - rows[a])
+            corner_rows = np.where(to_column < to_row, cell_rows[a], cell_rows[b])
+            corner_cols = np.where(to_column < to_row, cell_cols[b], cell_cols[a])
+            crossed = to_column != to_row
+            flooded[link[a][crossed & self.__is_flooded(corner_rows, corner_cols)]] = True
+        return np.flatnonzero(flooded)
+
+    # Whether cells of the raster are flooded, the cells beyond its edge taking the nearest edge cell
+    def __is_flooded(self, rows, cols):
+        height, width = self.__labels.shape
+        rows, cols = np.clip(rows, 0, height - 1), np.clip(cols, 0, width - 1)
+        return np.asarray(self.__labels[rows, cols]) == 0
@@ -0,0 +1,193 @@
+import atexit
+import contextlib
+import cProfile
+import json
+import multiprocessing.util
+import os
+import sys
+import time
+import tracemalloc
+
+
+# Timers, counters and peak memory of the stages of the evacuation pipeline, written as JSON lines.
+# A query (e.g. one user) is a group of stages: each stage records its elapsed time and, if the memory is traced, the
+# peak memory it allocated above what was allocated when it started, and counters (e.g. road nodes settled) are added
+# to the query they are counted in. One JSON line is written for every query, and for every stage run outside a query.
+# The instrumentation is off until it is configured, and then costs no more than a function call per stage.
+class Instrumentation:
+
+    def __init__(self):
+        self.__enabled = False
+        self.__output = None  # file the JSON lines are written to
+        self.__trace_memory = False
+        self.__profiler = None
+        self.__profile_file = None
+        self.__query = None  # query being recorded
+        self.__stack = []  # stages being recorded, innermost last
+        self.__queries = 0
+        self.__registered = False  # whether close() is called when the process exits
+
+    # Turn the instrumentation on.
+    # output is the file the JSON lines are appended to ('-' for the standard error), trace_memory turns on the peak
+    # memory of the stages (tracemalloc, which slows the program down) and profile is a file to dump a profile of the
+    # whole run to when close() is called: a pyinstrument HTML page if it ends with .html, otherwise cProfile stats.
+    def configure(self, output='-', trace_memory=False, profile=None):
+        self.close()
+        if not self.__registered:
+            atexit.register(self.close)
+            self.__registered = True
+        self.__enabled = True
+        self.__output = sys.stderr if output in (None, '-') else open(output, 'a', buffering=1)
+        self.__trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if profile is not None:
+            self.__profile_file = profile
+            if profile.lower().endswith('.html'):
+                # Error handling: pyinstrument is optional
+                try:
+                    from pyinstrument import Profiler
+                except ImportError:
+                    print('pyinstrument is not installed, the profile is written by cProfile instead.')
+                    self.__profile_file = os.path.splitext(profile)[0] + '.prof'
+                    self.__profiler = cProfile.Profile()
+                else:
+                    self.__profiler = Profiler()
+            else:
+                self.__profiler = cProfile.Profile()
+            if isinstance(self.__profiler, cProfile.Profile):
+                self.__profiler.enable()
+            else:
+                self.__profiler.start()
+        return self
+
+    # Check whether the instrumentation is on
+    def is_enabled(self):
+        return self.__enabled
+
+    # Write a record as a JSON line
+    def __emit(self, record):
+        record['time'] = round(time.time(), 3)
+        record['pid'] = os.getpid()
+        self.__output.write(json.dumps(record) + '\n')
+
+    # Record a query around a block, e.g. with instruments.query(easting=x, northing=y): ... The fields are written
+    # with the stages and the counters of the query.
+    @contextlib.contextmanager
+    def query(self, **fields):
+        if not self.__enabled or self.__query is not None:
+            yield
+            return
+        self.__queries += 1
+        self.__query = {'event': 'query', 'query': self.__queries, **fields, 'stages': [], 'counters': {}}
+        start = time.perf_counter()
+        try:
+            with self.stage('query'):
+                yield
+        finally:
+            query, self.__query = self.__query, None
+            query['ms'] = round((time.perf_counter() - start) * 1000, 3)
+            # The whole query is kept as the time of the query rather than as one of its stages
+            query['stages'] = [stage for stage in query['stages'] if stage['stage'] != 'query']
+            self.__emit(query)
+
+    # Record a stage around a block, e.g. with instruments.stage('r_tree'): ...
+    def stage(self, name):
+        if not self.__enabled:
+            return contextlib.nullcontext()
+        return self.__stage(name)
+
+    @contextlib.contextmanager
+    def __stage(self, name):
+        frame = {'peak': 0, 'start_memory': 0}
+        if self.__trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # The peak of the enclosing stage so far is kept before the peak is reset for this stage
+            if self.__stack:
+                self.__stack[-1]['peak'] = max(self.__stack[-1]['peak'], peak)
+            frame['start_memory'] = current
+            tracemalloc.reset_peak()
+        self.__stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = {'stage': name, 'ms': round((time.perf_counter() - start) * 1000, 3)}
+            self.__stack.pop()
+            if self.__trace_memory:
+                peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+                record['peak_memory_mb'] = round((peak - frame['start_memory']) / 2 ** 20, 3)
+                if self.__stack:
+                    self.__stack[-1]['peak'] = max(self.__stack[-1]['peak'], peak)
+                tracemalloc.reset_peak()
+            if self.__query is not None:
+                self.__query['stages'].append(record)
+            else:
+                self.__emit(dict(record, event='stage'))
+
+    # Add to a counter of the current query (e.g. road nodes settled). Outside a query the counter is written as a
+    # record of its own.
+    def count(self, name, value=1):
+        if not self.__enabled:
+            return
+        if self.__query is not None:
+            counters = self.__query['counters']
+            counters[name] = counters.get(name, 0) + value
+        else:
+            self.__emit({'event': 'counter', 'counter': name, 'value': value})
+
+    # Dump the profile and close the output
+    def close(self):
+        if self.__profiler is not None:
+            if isinstance(self.__profiler, cProfile.Profile):
+                self.__profiler.disable()
+                self.__profiler.dump_stats(self.__profile_file)
+            else:
+                self.__profiler.stop()
+                with open(self.__profile_file, 'w') as f:
+                    f.write(self.__profiler.output_html())
+            self.__profiler = None
+        if self.__output is not None and self.__output is not sys.stderr:
+            self.__output.close()
+        self.__output = None
+        self.__enabled = False
+
+    # Configuration of the instrumentation, to configure it in the same way in another process (e.g. a worker).
+    # None if it is off.
+    def get_config(self):
+        if not self.__enabled:
+            return None
+        output = self.__output.name if self.__output is not sys.stderr else '-'
+        return {'output': output, 'trace_memory': self.__trace_memory, 'profile': self.__profile_file}
+
+    # Configure the instrumentation from a configuration returned by get_config(). Each process writes its profile to
+    # a file of its own, named after its process id.
+    def apply_config(self, config):
+        if config is None:
+            return self
+        profile = config['profile']
+        if profile is not None:
+            base, ext = os.path.splitext(profile)
+            profile = base + '.' + str(os.getpid()) + ext
+        self.configure(config['output'], config['trace_memory'], profile)
+        # The worker processes of multiprocessing do not run the atexit functions, but they run its finalizers
+        multiprocessing.util.Finalize(self, self.close, exitpriority=10)
+        return self
+
+
+# Instrumentation shared by the whole process
+instruments = Instrumentation()
+
+
+# Add the command line options of the instrumentation to an argparse parser
+def add_arguments(parser):
+    parser.add_argument('--metrics', help="file to append the timings of the stages to as JSON lines ('-' for stderr)")
+    parser.add_argument('--trace-memory', action='store_true', help='record the peak memory of the stages')
+    parser.add_argument('--profile', help='file to write a profile to (cProfile stats, or pyinstrument if .html)')
+
+
+# Configure the shared instrumentation from the command line options, if any of them is given
+def configure_from_args(args):
+    if args.metrics is not None or args.trace_memory or args.profile is not None:
+        instruments.configure(args.metrics, args.trace_memory, args.profile)
+    return instruments
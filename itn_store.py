@@ -0,0 +1,217 @@
+import json
+import os
+import sys
+from collections.abc import Mapping
+
+import numpy as np
+
+from instrumentation import instruments
+
+
+# Compact binary copy of the ITN road network (i.e. solent_itn.json). The road nodes and road links are compiled once
+# into flat NumPy arrays saved as .npy files, which are memory-mapped when opened, so a query no longer has to parse
+# the whole JSON file.
+class ITNStore:
+    # Version of the store layout, it has to be increased whenever the arrays written by build() change
+    VERSION = 1
+    # Arrays kept in the store
+    ARRAYS = ('node_ids', 'node_coords', 'link_ids', 'link_start', 'link_end', 'link_length', 'link_offsets',
+              'link_coords')
+
+    def __init__(self, itn_path, store_dir=None):
+        self.__itn_path = itn_path
+        # By default the store is kept next to the JSON file (e.g. Material/itn/solent_itn.store)
+        self.__store_dir = store_dir if store_dir is not None else os.path.splitext(itn_path)[0] + '.store'
+        self.__arrays = {}
+        self.__node_index = None
+        self.__link_index = None
+
+    # Method to return the folder of the store
+    def get_store_dir(self):
+        return self.__store_dir
+
+    # Method to return the path to the source JSON file
+    def get_itn_path(self):
+        return self.__itn_path
+
+    # Check whether the store has been built
+    def exists(self):
+        return os.path.exists(os.path.join(self.__store_dir, 'meta.json'))
+
+    # Signature of the source JSON file, the store is rebuilt whenever it changes
+    def source_signature(self):
+        stat = os.stat(self.__itn_path)
+        return {'version': self.VERSION, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    # Check whether the store is missing or has been built from a different version of the source JSON file
+    def is_stale(self):
+        if not self.exists():
+            return True
+        with open(os.path.join(self.__store_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        # Error handling: if the JSON file has been removed, keep using the store which has already been built
+        if not os.path.exists(self.__itn_path):
+            return meta.get('version') != self.VERSION
+        return meta.get('source') != self.source_signature()
+
+    # Compile the road nodes and road links of the JSON file into arrays and save them into the store
+    def build(self):
+        signature = self.source_signature()
+        with open(self.__itn_path, 'r') as f:
+            itn = json.load(f)
+        road_nodes = itn['roadnodes']
+        road_links = itn['roadlinks']
+
+        node_ids = list(road_nodes)
+        node_index = {node: i for i, node in enumerate(node_ids)}
+        node_coords = [road_nodes[node]['coords'][:2] for node in node_ids]
+
+        link_ids = list(road_links)
+        link_start = np.empty(len(link_ids), dtype=np.int32)
+        link_end = np.empty(len(link_ids), dtype=np.int32)
+        link_length = np.empty(len(link_ids), dtype=np.float64)
+        link_offsets = np.zeros(len(link_ids) + 1, dtype=np.int64)
+        link_coords = []
+        for i, link in enumerate(link_ids):
+            road_link = road_links[link]
+            coords = [coord[:2] for coord in road_link['coords']]
+            # Error handling: a road link may refer to a road node which is not listed in the road nodes, in which
+            # case the node is added with the coordinates of the end of the road link
+            for key, coord in (('start', coords[0]), ('end', coords[-1])):
+                if road_link[key] not in node_index:
+                    node_index[road_link[key]] = len(node_ids)
+                    node_ids.append(road_link[key])
+                    node_coords.append(coord)
+            link_start[i] = node_index[road_link['start']]
+            link_end[i] = node_index[road_link['end']]
+            link_length[i] = road_link['length']
+            link_offsets[i + 1] = link_offsets[i] + len(coords)
+            link_coords.extend(coords)
+
+        arrays = {
+            'node_ids': np.array(node_ids, dtype=str),
+            'node_coords': np.array(node_coords, dtype=np.float64).reshape(-1, 2),
+            'link_ids': np.array(link_ids, dtype=str),
+            'link_start': link_start,
+            'link_end': link_end,
+            'link_length': link_length,
+            'link_offsets': link_offsets,
+            'link_coords': np.array(link_coords, dtype=np.float64).reshape(-1, 2)
+        }
+
+        # Each file is written under a temporary name and then moved into place, and meta.json is written last, so a
+        # process opening the store at the same time never reads a half written array
+        os.makedirs(self.__store_dir, exist_ok=True)
+        for name, array in arrays.items():
+            self.__save(name + '.npy', lambda f, a=array: np.save(f, a))
+        meta = {'source': signature, 'version': self.VERSION, 'nodes': len(node_ids), 'links': len(link_ids)}
+        self.__save('meta.json', lambda f: f.write(json.dumps(meta).encode()))
+
+        self.__arrays = {}
+        self.__node_index = None
+        self.__link_index = None
+        return self
+
+    # Write a file of the store under a temporary name and then move it into place
+    def __save(self, file_name, write):
+        path = os.path.join(self.__store_dir, file_name)
+        temp_path = path + '.' + str(os.getpid()) + '.tmp'
+        with open(temp_path, 'wb') as f:
+            write(f)
+        os.replace(temp_path, path)
+
+    # Memory-map the arrays of the store, (re)building it first if it is missing or out of date
+    def open(self):
+        if self.is_stale():
+            print('Building the road network store ' + self.__store_dir + '...\n')
+            with instruments.stage('itn_store_build'):
+                self.build()
+        for name in self.ARRAYS:
+            self.__arrays[name] = np.load(os.path.join(self.__store_dir, name + '.npy'), mmap_mode='r')
+        return self
+
+    # Methods to return the arrays of the store
+    # Road node feature ids
+    def get_node_ids(self):
+        return self.__arrays['node_ids']
+
+    # Road node coordinates, one (x, y) row per road node
+    def get_node_coords(self):
+        return self.__arrays['node_coords']
+
+    # Road link feature ids
+    def get_link_ids(self):
+        return self.__arrays['link_ids']
+
+    # Index of the start road node of each road link
+    def get_link_start(self):
+        return self.__arrays['link_start']
+
+    # Index of the end road node of each road link
+    def get_link_end(self):
+        return self.__arrays['link_end']
+
+    # Length (m) of each road link
+    def get_link_length(self):
+        return self.__arrays['link_length']
+
+    # The coordinates of road link i are link_coords[link_offsets[i]:link_offsets[i + 1]]
+    def get_link_offsets(self):
+        return self.__arrays['link_offsets']
+
+    # Coordinates of all the road links, flattened into one (x, y) buffer
+    def get_link_coords(self):
+        return self.__arrays['link_coords']
+
+    # Coordinates of the road link with index i
+    def get_link_coords_of(self, i):
+        offsets = self.__arrays['link_offsets']
+        return self.__arrays['link_coords'][offsets[i]:offsets[i + 1]]
+
+    # Index of a road node from its feature id
+    def node_index(self, node):
+        if self.__node_index is None:
+            self.__node_index = {str(fid): i for i, fid in enumerate(self.get_node_ids())}
+        return self.__node_index[node]
+
+    # Index of a road link from its feature id
+    def link_index(self, link):
+        if self.__link_index is None:
+            self.__link_index = {str(fid): i for i, fid in enumerate(self.get_link_ids())}
+        return self.__link_index[link]
+
+    # Read-only view of the road links in the same layout as solent_itn.json['roadlinks']
+    def get_road_links(self):
+        return RoadLinks(self)
+
+
+# Read-only mapping from road link feature id to a dictionary of 'length', 'coords', 'start' and 'end', as found in
+# solent_itn.json['roadlinks']. The dictionaries are created from the arrays of the store when they are accessed.
+class RoadLinks(Mapping):
+
+    def __init__(self, store):
+        self.__store = store
+
+    def __getitem__(self, link):
+        store = self.__store
+        i = store.link_index(link)
+        node_ids = store.get_node_ids()
+        return {
+            'length': float(store.get_link_length()[i]),
+            'coords': store.get_link_coords_of(i).tolist(),
+            'start': str(node_ids[store.get_link_start()[i]]),
+            'end': str(node_ids[store.get_link_end()[i]])
+        }
+
+    def __iter__(self):
+        return (str(link) for link in self.__store.get_link_ids())
+
+    def __len__(self):
+        return len(self.__store.get_link_ids())
+
+
+# Build the store of an ITN JSON file once, e.g. python itn_store.py Material/itn/solent_itn.json
+if __name__ == '__main__':
+    itn_file = sys.argv[1] if len(sys.argv) > 1 else 'Material/itn/solent_itn.json'
+    itn_store = ITNStore(itn_file).build()
+    print('Road network store built in ' + itn_store.get_store_dir() + '.')
@@ -0,0 +1,72 @@
+import os
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from rasterio import features
+
+from instrumentation import instruments
+
+
+# Land boundary of the Isle of Wight, loaded once and kept as an STRtree of its polygons in the British National Grid.
+# A location is on the land if it is within one of the polygons, like position.within(isle_of_wight['geometry']).any().
+# Arrays of locations are checked with the vectorised predicates of shapely, and an optional land mask rasterised at
+# the resolution of the DEM gives an O(1) lookup per location.
+class LandBoundary:
+    # Boundaries already loaded by this process, keyed by the shape file
+    __opened = {}
+
+    def __init__(self, shape_file):
+        self.__shape_file = shape_file
+        # Error handling by changing CRS to the British National Grid
+        self.__geometries = gpd.read_file(shape_file).to_crs(27700)['geometry'].values
+        self.__tree = shapely.STRtree(self.__geometries)
+        self.__mask = None
+        self.__transform = None
+
+    # Boundary of a shape file shared by every query of this process
+    @staticmethod
+    def open(shape_file):
+        key = os.path.abspath(shape_file)
+        boundary = LandBoundary.__opened.get(key)
+        if boundary is None:
+            with instruments.stage('land_boundary'):
+                boundary = LandBoundary(shape_file)
+            LandBoundary.__opened[key] = boundary
+        return boundary
+
+    # Method to return the polygons of the boundary
+    def get_geometries(self):
+        return self.__geometries
+
+    # Check whether a location (Point) is on the land
+    def contains(self, position):
+        return bool(self.contains_xy(np.array([position.x]), np.array([position.y]))[0])
+
+    # Check whether each location of arrays of eastings and northings is on the land
+    def contains_xy(self, eastings, northings):
+        eastings = np.asarray(eastings, dtype=np.float64)
+        instruments.count('land_checks', len(eastings))
+        on_land = np.zeros(len(eastings), dtype=bool)
+        points, _ = self.__tree.query(shapely.points(eastings, northings), predicate='within')
+        on_land[points] = True
+        return on_land
+
+    # Rasterise the land at the resolution of an elevation raster (ElevationProvider): a cell is on the land if its
+    # centre is within one of the polygons
+    def rasterise(self, dem):
+        self.__transform = dem.get_transform()
+        self.__mask = features.rasterize(((geometry, 1) for geometry in self.__geometries), out_shape=dem.get_shape(),
+                                         transform=self.__transform, fill=0, dtype='uint8').astype(bool)
+        return self
+
+    # Check whether each location is on the land with the rasterised land mask, locations beyond the raster are not.
+    # rasterise() has to be called first.
+    def contains_xy_raster(self, eastings, northings):
+        cols, rows = ~self.__transform * (np.asarray(eastings, dtype=np.float64),
+                                          np.asarray(northings, dtype=np.float64))
+        rows, cols = np.floor(rows).astype(np.int64), np.floor(cols).astype(np.int64)
+        inside = (rows >= 0) & (rows < self.__mask.shape[0]) & (cols >= 0) & (cols < self.__mask.shape[1])
+        on_land = np.zeros(len(rows), dtype=bool)
+        on_land[inside] = self.__mask[rows[inside], cols[inside]]
+        return on_land
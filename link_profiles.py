@@ -0,0 +1,144 @@
+import numpy as np
+
+
+# Elevation profiles of the road links of an ITN store along their geometry, and the total ascent of each road link in
+# both directions, for the climbing time of Naismith's rule.
+# The DEM is interpolated bilinearly between the centres of its cells (clamped to the edge cells beyond them) at every
+# vertex of every road link, and at points spaced by at most the cell size along the segments between the vertices, so
+# that no hill crossed by a road link is missed. The profile of a road link starts and ends at the elevation of its road
+# nodes, so that its ascent is never less than the rise between them, which the lower bound of A* relies on.
+# All the road links are sampled in one vectorised pass, by chunks of at most CHUNK_SAMPLES points.
+class LinkProfiles:
+    # Largest number of points interpolated at once
+    CHUNK_SAMPLES = 2 ** 22
+
+    def __init__(self, store, dem):
+        self.__store = store
+        self.__dem = dem  # ElevationProvider of the raster
+        self.__elevation = None
+        self.__node_elevation = None
+        self.__vertex_elevation = None  # elevation of each vertex of the road links, aligned with their coordinates
+        self.__ascent_forward = None  # ascent (m) of each road link from its start to its end
+        self.__ascent_backward = None  # ascent (m) of each road link from its end to its start
+
+    # Elevation of locations, interpolated bilinearly between the centres of the cells of the raster
+    def interpolate(self, xs, ys):
+        elevation = self.__elevation
+        transform = self.__dem.get_transform()
+        cols, rows = ~transform * (np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64))
+        # Error handling: locations beyond the centres of the edge cells take the elevation of the edge
+        rows = np.clip(rows - 0.5, 0, elevation.shape[0] - 1)
+        cols = np.clip(cols - 0.5, 0, elevation.shape[1] - 1)
+        row0 = np.clip(np.floor(rows).astype(np.int64), 0, max(elevation.shape[0] - 2, 0))
+        col0 = np.clip(np.floor(cols).astype(np.int64), 0, max(elevation.shape[1] - 2, 0))
+        row1 = np.minimum(row0 + 1, elevation.shape[0] - 1)
+        col1 = np.minimum(col0 + 1, elevation.shape[1] - 1)
+        dr, dc = rows - row0, cols - col0
+        top = elevation[row0, col0] * (1 - dc) + elevation[row0, col1] * dc
+        bottom = elevation[row1, col0] * (1 - dc) + elevation[row1, col1] * dc
+        return top * (1 - dr) + bottom * dr
+
+    # Sample the profiles of every road link and total their ascent in both directions
+    def compute(self):
+        elevation = self.__dem.read().astype(np.float64)
+        # Error handling: the cells without data are taken as the sea, at 0 m
+        if self.__dem.get_nodata() is not None:
+            elevation[elevation == self.__dem.get_nodata()] = 0
+        self.__elevation = elevation
+
+        store = self.__store
+        node_coords = np.asarray(store.get_node_coords())
+        link_start = np.asarray(store.get_link_start())
+        link_end = np.asarray(store.get_link_end())
+        coords = np.asarray(store.get_link_coords())
+        offsets = np.asarray(store.get_link_offsets())
+        num_links = len(offsets) - 1
+
+        self.__node_elevation = self.interpolate(node_coords[:, 0], node_coords[:, 1])
+        vertex_elevation = self.interpolate(coords[:, 0], coords[:, 1])
+        vertex_elevation[offsets[:-1]] = self.__node_elevation[link_start]
+        vertex_elevation[offsets[1:] - 1] = self.__node_elevation[link_end]
+        self.__vertex_elevation = vertex_elevation
+
+        self.__ascent_forward = np.zeros(num_links)
+        self.__ascent_backward = np.zeros(num_links)
+        segment_points, link_points = count_link_samples(coords, offsets, self.__dem.get_cell_size())
+        for first, last in chunk_links(link_points, self.CHUNK_SAMPLES):
+            self.__ascents(first, last, coords, offsets, segment_points, vertex_elevation)
+        return self
+
+    # Total the ascent of the road links first to last - 1 in both directions
+    def __ascents(self, first, last, coords, offsets, segment_points, vertex_elevation):
+        xs, ys, vertex, step, link = sample_links(coords, offsets, segment_points, first, last)
+        if len(xs) == 0:
+            return
+        profile = self.interpolate(xs, ys)
+        # The vertices keep their elevation, so that the profile ends at the elevation of the road nodes
+        at_vertex = step == 0
+        profile[at_vertex] = vertex_elevation[vertex[at_vertex]]
+
+        # Rise between consecutive points of the same road link
+        rise = np.diff(profile)
+        same = link[1:] == link[:-1]
+        rise, rise_link = rise[same], link[1:][same] - first
+        self.__ascent_forward[first:last] = np.bincount(rise_link, np.maximum(rise, 0), minlength=last - first)
+        self.__ascent_backward[first:last] = np.bincount(rise_link, np.maximum(-rise, 0), minlength=last - first)
+
+    # Methods to return the profiles
+    # Elevation (m) of each road node
+    def get_node_elevation(self):
+        return self.__node_elevation
+
+    # Elevation (m) of each vertex of the road links, aligned with ITNStore.get_link_coords()
+    def get_vertex_elevation(self):
+        return self.__vertex_elevation
+
+    # Ascent (m) of each road link from its start to its end
+    def get_ascent_forward(self):
+        return self.__ascent_forward
+
+    # Ascent (m) of each road link from its end to its start
+    def get_ascent_backward(self):
+        return self.__ascent_backward
+
+
+# Number of points sampled along each segment between two vertices of the road links (the first vertex and the points
+# spaced by at most spacing along the segment, 0 from the last vertex of a road link to the first of the next one), and
+# along each road link with its last vertex, for arrays of the coordinates of the vertices and of the offsets of the
+# road links as in ITNStore
+def count_link_samples(coords, offsets, spacing):
+    lengths = np.hypot(*np.diff(coords, axis=0).T)
+    segment_points = np.maximum(np.ceil(lengths / spacing), 1).astype(np.int64)
+    segment_points[offsets[1:-1] - 1] = 0
+    link_points = np.add.reduceat(np.append(segment_points, 0), offsets[:-1]) + 1
+    link_points[offsets[1:] - offsets[:-1] < 2] = 1
+    return segment_points, link_points
+
+
+# Ranges (first, last) of consecutive road links with at most max_points points sampled along them (or a single road
+# link with more), so that the road links can be sampled by chunks
+def chunk_links(link_points, max_points):
+    chunks = np.cumsum(link_points) // max_points
+    bounds = np.concatenate([[0], np.flatnonzero(np.diff(chunks)) + 1, [len(link_points)]])
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+# Points sampled along the road links first to last - 1: each segment from its first vertex, at t = k / n for
+# k = 0 .. n - 1 where n is its number of points (see count_link_samples), and then the last vertex of each road link.
+# The coordinates of the points, the vertex each of them starts from, their step k along the segment and their road
+# link are returned.
+def sample_links(coords, offsets, segment_points, first, last):
+    v0, v1 = offsets[first], offsets[last]
+    if v1 - v0 == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return np.zeros(0), np.zeros(0), empty, empty, empty
+    counts = np.append(segment_points[v0:v1 - 1], 1)
+    counts[offsets[first + 1:last + 1] - 1 - v0] = 1
+    vertex = np.repeat(np.arange(v0, v1), counts)
+    step = np.arange(len(vertex)) - np.repeat(np.cumsum(counts) - counts, counts)
+    t = step / np.repeat(counts, counts)
+    following = np.minimum(vertex + 1, len(coords) - 1)
+    xs = coords[vertex, 0] + (coords[following, 0] - coords[vertex, 0]) * t
+    ys = coords[vertex, 1] + (coords[following, 1] - coords[vertex, 1]) * t
+    link = np.repeat(np.arange(first, last), offsets[first + 1:last + 1] - offsets[first:last])[vertex - v0]
+    return xs, ys, vertex, step, link
@@ -1,3 +1,8 @@
+import argparse
+
+from elevation import ElevationProvider
+from instrumentation import add_arguments, configure_from_args, instruments
+from map_tiles import MapTiles
 from task1 import CoordinateInput
 from task2 import HighestPoint
 from task3 import ITN
@@ -7,16 +12,35 @@ from task5 import Plotting
 shape_file = 'Material/shape/isle_of_wight.shp'
 road_file = 'Material/itn/solent_itn.json'
 elevation_file = 'Material/elevation/SZ.asc'
-masked_elevation = 'Material/elevation/Masked_SZ.asc'
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Evacuation route to the highest point within 5km of the user.')
+    parser.add_argument('--tiles', metavar='PNG',
+                        help='draw the route on the map tiles (see map_tiles.py) into a PNG file instead of plotting it')
+    add_arguments(parser)
+    args = parser.parse_args()
+    configure_from_args(args)
+
     # (Task 1) User Input
     user_location = CoordinateInput(shape_file).user_input()
 
+    # The pipeline after the user input is recorded as one query by the instrumentation, if it is on. The DEM is
+    # opened once for the whole pipeline and released at the end.
+    dem = ElevationProvider.open(elevation_file)
+    try:
+        with instruments.query(easting=user_location.x, northing=user_location.y):
+            run(user_location, dem, args.tiles)
+    finally:
+        dem.close()
+
+
+# Find the highest point in the DEM (an ElevationProvider), the shortest path to it and plot the map for a user
+# location, or draw it on the map tiles into tiles_file if it is given
+def run(user_location, dem, tiles_file=None):
     # (Task 2 & Task 6) Highest Point Identification & Extend the Region
     print("Finding highest location within 5 kilometres...\n")
-    hp = HighestPoint(user_location)
+    hp = HighestPoint(user_location, dem)
     highest_points = hp.get_highest_point()  # the highest point
     transform = hp.get_5k_transform()  # transformation parameters of the masked raster
     buffer = hp.get_buffer()  # 5 km buffer around the user location
@@ -32,6 +56,10 @@ def main():
                                                                                             highest_points)
 
     # (Task 5) Map Plotting
+    if tiles_file is not None:
+        MapTiles.open().route_map(user_location, highest_point, shortest_path_gpd, tiles_file)
+        print('Route map written to ' + tiles_file + '.')
+        return
     plotter = Plotting(user_location, highest_point, shortest_path_gpd)
     plotter.plot_map()
 
@@ -0,0 +1,138 @@
+import os
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+from pyproj import CRS
+from rasterio.windows import Window
+from shapely.geometry import box
+
+from elevation import ElevationProvider
+
+CRS_BNG = CRS('epsg:27700')
+
+
+# Layers of the map (Task 5), loaded on first use and kept for the next maps of the process.
+# The vector layers are reprojected to the British National Grid once, the colormap of the background raster is turned
+# into a palette once, and the rasters are only read by windows covering the extent of a map.
+class MapLayers:
+    # Layers already opened by this process, keyed by their files
+    __opened = {}
+    # Number of palette-expanded background windows kept in memory
+    BACKGROUND_CACHE_SIZE = 16
+
+    def __init__(self, shape_file='Material/shape/isle_of_wight.shp', links_file='Material/roads/links.shp',
+                 nodes_file='Material/roads/nodes.shp', background_file='Material/background/raster-50k_2724246.tif',
+                 elevation_file='Material/elevation/SZ.asc'):
+        self.__files = {'shape': shape_file, 'links': links_file, 'nodes': nodes_file, 'background': background_file,
+                        'elevation': elevation_file}
+        self.__vectors = {}  # reprojected vector layers
+        self.__background = None
+        self.__palette = None
+        self.__background_windows = {}  # palette-expanded windows of the background, in the order they were read
+        self.__elevation = None
+        self.__elevation_range = None
+
+    # Layers of a set of files shared by every map of this process
+    @staticmethod
+    def open(shape_file='Material/shape/isle_of_wight.shp', links_file='Material/roads/links.shp',
+             nodes_file='Material/roads/nodes.shp', background_file='Material/background/raster-50k_2724246.tif',
+             elevation_file='Material/elevation/SZ.asc'):
+        files = (shape_file, links_file, nodes_file, background_file, elevation_file)
+        key = tuple(os.path.abspath(path) for path in files)
+        layers = MapLayers.__opened.get(key)
+        if layers is None:
+            layers = MapLayers(*files)
+            MapLayers.__opened[key] = layers
+        return layers
+
+    # Method to return the files of the layers
+    def get_files(self):
+        return dict(self.__files)
+
+    # Vector layer read and reprojected to the British National Grid on first use
+    def __vector(self, name):
+        if name not in self.__vectors:
+            self.__vectors[name] = gpd.read_file(self.__files[name]).to_crs(CRS_BNG)
+        return self.__vectors[name]
+
+    # Methods to return the vector layers, cut to a bounding box if one is given
+    def get_isle_of_wight(self, bounds=None):
+        return self.__clip(self.__vector('shape'), bounds)
+
+    def get_road_links(self, bounds=None):
+        return self.__clip(self.__vector('links'), bounds)
+
+    def get_road_nodes(self, bounds=None):
+        return self.__clip(self.__vector('nodes'), bounds)
+
+    # Features of a layer whose bounding box intersects a bounding box (min_x, min_y, max_x, max_y), found with its
+    # spatial index
+    @staticmethod
+    def __clip(layer, bounds):
+        if bounds is None:
+            return layer
+        return layer.iloc[np.sort(layer.sindex.query(box(*bounds)))]
+
+    # Background raster, opened on first use
+    def get_background(self):
+        if self.__background is None:
+            self.__background = rasterio.open(self.__files['background'])
+        return self.__background
+
+    # Colours of the colormap of the background raster, one RGBA row per value
+    def get_palette(self):
+        if self.__palette is None:
+            self.__palette = np.array(list(self.get_background().colormap(1).values()))
+        return self.__palette
+
+    # Elevation raster, opened once on first use and shared with the other queries of the process
+    def get_elevation(self):
+        if self.__elevation is None:
+            self.__elevation = ElevationProvider.open(self.__files['elevation'])
+        return self.__elevation
+
+    # Palette-expanded window of the background covering a bounding box, and the extent (left, right, bottom, top)
+    # of the window. If max_size is given, the window is read with at most max_size cells along each side (nearest
+    # cell), as a map does not need more cells than it has pixels. The last windows read are kept in memory.
+    def background_window(self, min_x, min_y, max_x, max_y, max_size=None):
+        background = self.get_background()
+        col_start, row_start = ~background.transform * (min_x, max_y)
+        col_stop, row_stop = ~background.transform * (max_x, min_y)
+        col_start, row_start = max(int(np.floor(col_start)), 0), max(int(np.floor(row_start)), 0)
+        col_stop = min(int(np.ceil(col_stop)), background.width)
+        row_stop = min(int(np.ceil(row_stop)), background.height)
+        if col_start >= col_stop or row_start >= row_stop:
+            return None, None
+        key = (col_start, row_start, col_stop, row_stop, max_size)
+        if key not in self.__background_windows:
+            window = Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+            step = 1 if max_size is None else max(int(np.ceil(max(window.width, window.height) / max_size)), 1)
+            out_shape = (-(-window.height // step), -(-window.width // step))
+            image = self.get_palette()[background.read(1, window=window, out_shape=out_shape)]
+            left, top = background.transform * (col_start, row_start)
+            right, bottom = background.transform * (col_stop, row_stop)
+            if len(self.__background_windows) >= self.BACKGROUND_CACHE_SIZE:
+                self.__background_windows.pop(next(iter(self.__background_windows)))
+            self.__background_windows[key] = (image, [left, right, bottom, top])
+        return self.__background_windows[key]
+
+    # Lowest and highest elevation of the raster, read once for the colour bar
+    def get_elevation_range(self):
+        if self.__elevation_range is None:
+            elevation = self.get_elevation()
+            array = elevation.read()
+            if elevation.get_nodata() is not None:
+                array = array[array != elevation.get_nodata()]
+            self.__elevation_range = (float(array.min()), float(array.max()))
+        return self.__elevation_range
+
+    # Release the rasters
+    def close(self):
+        if self.__background is not None:
+            self.__background.close()
+            self.__background = None
+        self.__background_windows = {}
+        if self.__elevation is not None:
+            self.__elevation.close()
+            self.__elevation = None
@@ -0,0 +1,229 @@
+import argparse
+import json
+import os
+import shutil
+
+import numpy as np
+from matplotlib import colormaps, colors
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from PIL import Image, ImageDraw
+
+from map_layers import MapLayers
+
+
+# Pyramid of PNG tiles of the static layers of the map (background, road links, outline of the Isle of Wight and a
+# hillshaded terrain), rendered once in the British National Grid.
+# Tile (z, x, y) covers TILE_SIZE x TILE_SIZE pixels of RESOLUTIONS[z] metres from the top left corner ORIGIN, x going
+# east and y going south as in XYZ tiles, and is saved as tile_dir/z/x/y.png. A route map is then a mosaic of the
+# tiles covering its view, with the route and the markers drawn on top.
+class MapTiles:
+    # Version of the tiles, it has to be increased whenever render_tile() changes
+    VERSION = 1
+    TILE_SIZE = 256
+    # Size (m) of a pixel at each zoom level
+    RESOLUTIONS = (80, 40, 20, 10, 5)
+    # Top left corner of the grid of tiles, the corner of the British National Grid
+    ORIGIN = (0, 1300000)
+
+    def __init__(self, tile_dir='Material/tiles', layers=None):
+        self.__tile_dir = tile_dir
+        self.__layers = layers if layers is not None else MapLayers.open()
+        self.__road_colours = None
+
+    # Tiles of a folder, discarded first if they have been rendered from different layers. Only a folder of tiles,
+    # with the tiles.json file written by MapTiles, is ever deleted.
+    @staticmethod
+    def open(tile_dir='Material/tiles', layers=None):
+        tiles = MapTiles(tile_dir, layers)
+        if tiles.is_stale():
+            # Error handling: a folder which is not empty and does not hold tiles is refused rather than deleted
+            if os.path.isdir(tile_dir) and os.listdir(tile_dir) and not tiles.is_tile_dir():
+                print('Error! ' + tile_dir + ' is not a folder of map tiles, it will not be deleted!!!')
+                exit()
+            shutil.rmtree(tile_dir, ignore_errors=True)
+            os.makedirs(tile_dir)
+            with open(os.path.join(tile_dir, 'tiles.json'), 'w') as f:
+                json.dump(tiles.signature(), f)
+        return tiles
+
+    # Signature of the files of the layers, the tiles are rendered again whenever it changes
+    def signature(self):
+        files = self.__layers.get_files()
+        return {'version': self.VERSION, 'tile_size': self.TILE_SIZE, 'resolutions': list(self.RESOLUTIONS),
+                'layers': {name: [os.stat(path).st_size, os.stat(path).st_mtime_ns] for name, path in files.items()}}
+
+    # Check whether the folder holds tiles, i.e. a tiles.json file with the signature written by MapTiles
+    def is_tile_dir(self):
+        signature_file = os.path.join(self.__tile_dir, 'tiles.json')
+        if not os.path.isfile(signature_file):
+            return False
+        try:
+            with open(signature_file, 'r') as f:
+                signature = json.load(f)
+        except ValueError:
+            return False
+        return isinstance(signature, dict) and set(signature) == set(self.signature())
+
+    # Check whether the tiles are missing or have been rendered from different layers
+    def is_stale(self):
+        signature_file = os.path.join(self.__tile_dir, 'tiles.json')
+        if not os.path.exists(signature_file):
+            return True
+        with open(signature_file, 'r') as f:
+            return json.load(f) != self.signature()
+
+    # Bounding box (min_x, min_y, max_x, max_y) of a tile
+    def tile_bounds(self, z, x, y):
+        size = self.TILE_SIZE * self.RESOLUTIONS[z]
+        return (self.ORIGIN[0] + x * size, self.ORIGIN[1] - (y + 1) * size,
+                self.ORIGIN[0] + (x + 1) * size, self.ORIGIN[1] - y * size)
+
+    # Range of the columns and rows of the tiles of a zoom level covering a bounding box
+    def tile_range(self, z, min_x, min_y, max_x, max_y):
+        size = self.TILE_SIZE * self.RESOLUTIONS[z]
+        x0, x1 = int(np.floor((min_x - self.ORIGIN[0]) / size)), int(np.ceil((max_x - self.ORIGIN[0]) / size))
+        y0, y1 = int(np.floor((self.ORIGIN[1] - max_y) / size)), int(np.ceil((self.ORIGIN[1] - min_y) / size))
+        return range(x0, x1), range(y0, y1)
+
+    # Zoom level whose pixels are the closest to (but not larger than) a given size (m), or the coarsest one
+    def zoom_for(self, resolution):
+        finer = [z for z, r in enumerate(self.RESOLUTIONS) if r <= resolution]
+        return finer[0] if finer else len(self.RESOLUTIONS) - 1
+
+    # Colour of each type of road (descript_1), from the RdYlGn colormap as in the map of Task 5
+    def get_road_colours(self):
+        if self.__road_colours is None:
+            road_types = sorted(self.__layers.get_road_links()['descript_1'].dropna().unique())
+            cmap = colormaps['RdYlGn'].resampled(max(len(road_types), 1))
+            self.__road_colours = {road_type: cmap(i) for i, road_type in enumerate(road_types)}
+        return self.__road_colours
+
+    # Hillshaded terrain of a bounding box as an RGBA image of at most max_size cells across: the elevation coloured
+    # with the terrain colormap over the range of the whole DEM, shaded by a light from the north west
+    def __terrain(self, bounds, max_size):
+        elevation = self.__layers.get_elevation()
+        window = elevation.window(*bounds)
+        if window is None:
+            return None, None
+        array, transform = elevation.read_window(window)
+        step = max(int(np.ceil(max(array.shape) / max_size)), 1)
+        array = array[::step, ::step].astype(np.float64)
+        # Error handling: the shade needs at least 2 x 2 cells
+        if min(array.shape) < 2:
+            return None, None
+        cell_size = elevation.get_cell_size() * step
+        norm = colors.Normalize(*self.__layers.get_elevation_range())
+        light = colors.LightSource(azdeg=315, altdeg=45)
+        image = light.shade(array, cmap=colormaps['terrain'], norm=norm, blend_mode='soft', dx=cell_size, dy=cell_size)
+        if elevation.get_nodata() is not None:
+            image[array == elevation.get_nodata(), 3] = 0
+        left, top = transform * (0, 0)
+        right, bottom = transform * (window.width, window.height)
+        return image, [left, right, bottom, top]
+
+    # Render the static layers of a tile into an RGBA image
+    def render_tile(self, z, x, y):
+        bounds = self.tile_bounds(z, x, y)
+        dpi = 100
+        fig = Figure(figsize=(self.TILE_SIZE / dpi, self.TILE_SIZE / dpi), dpi=dpi)
+        canvas = FigureCanvasAgg(fig)
+        ax = fig.add_axes((0, 0, 1, 1))
+        ax.set_axis_off()
+
+        background_image, extent = self.__layers.background_window(*bounds, max_size=self.TILE_SIZE)
+        if background_image is not None:
+            ax.imshow(background_image, extent=extent, zorder=0)
+        terrain, extent = self.__terrain(bounds, self.TILE_SIZE)
+        if terrain is not None:
+            ax.imshow(terrain, extent=extent, alpha=0.5, zorder=1)
+        isle_of_wight = self.__layers.get_isle_of_wight(bounds)
+        if len(isle_of_wight) > 0:
+            isle_of_wight.plot(ax=ax, color='none', zorder=2)
+        road_links = self.__layers.get_road_links(bounds)
+        for road_type, colour in self.get_road_colours().items():
+            links = road_links[road_links['descript_1'] == road_type]
+            if len(links) > 0:
+                links.plot(ax=ax, linewidth=1, color=colour, zorder=3)
+
+        ax.set_xlim(bounds[0], bounds[2])
+        ax.set_ylim(bounds[1], bounds[3])
+        canvas.draw()
+        return np.asarray(canvas.buffer_rgba()).copy()
+
+    # Image of a tile, read from its file or rendered and saved first if it has not been rendered yet.
+    # The file is written under a temporary name and then moved into place.
+    def tile(self, z, x, y):
+        path = os.path.join(self.__tile_dir, str(z), str(x), str(y) + '.png')
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = path + '.' + str(os.getpid()) + '.tmp.png'
+            Image.fromarray(self.render_tile(z, x, y)).save(temp_path)
+            os.replace(temp_path, path)
+        with Image.open(path) as image:
+            return np.asarray(image.convert('RGBA'))
+
+    # Render the tiles of zoom levels covering a bounding box (by default the road links) ahead of time, the tiles
+    # which have already been rendered are kept. The number of tiles covering the bounding box is returned.
+    def build(self, zooms=None, bounds=None):
+        if bounds is None:
+            bounds = tuple(self.__layers.get_road_links().total_bounds)
+        count = 0
+        for z in (zooms if zooms is not None else range(len(self.RESOLUTIONS))):
+            xs, ys = self.tile_range(z, *bounds)
+            for x in xs:
+                for y in ys:
+                    self.tile(z, x, y)
+                    count += 1
+        return count
+
+    # Mosaic of the tiles of a zoom level covering a bounding box, cut to the bounding box
+    def mosaic(self, z, min_x, min_y, max_x, max_y):
+        xs, ys = self.tile_range(z, min_x, min_y, max_x, max_y)
+        rows = [np.concatenate([self.tile(z, x, y) for x in xs], axis=1) for y in ys]
+        image = np.concatenate(rows, axis=0)
+        left, _, _, top = self.tile_bounds(z, xs[0], ys[0])
+        resolution = self.RESOLUTIONS[z]
+        col0, row0 = int(round((min_x - left) / resolution)), int(round((top - max_y) / resolution))
+        col1, row1 = int(round((max_x - left) / resolution)), int(round((top - min_y) / resolution))
+        return image[row0:row1, col0:col1]
+
+    # Draw a route map on top of the tiles: the view of size (m) around the user (20km x 20km as in Task 5), at the
+    # zoom level with about width pixels across, with the route (a GeoDataFrame from ShortestPath.add_geometry) and
+    # the markers of the user and the highest point. The map is written to a PNG file and returned as an image.
+    def route_map(self, user_location, highest_point, shortest_path_gpd, output_file=None, size=20000, width=1000):
+        min_x, max_x = user_location.x - size / 2, user_location.x + size / 2
+        min_y, max_y = user_location.y - size / 2, user_location.y + size / 2
+        z = self.zoom_for(size / width)
+        image = Image.fromarray(self.mosaic(z, min_x, min_y, max_x, max_y))
+        resolution = self.RESOLUTIONS[z]
+        draw = ImageDraw.Draw(image)
+
+        # Pixel of a location in the map
+        def pixel(x, y):
+            return (x - min_x) / resolution, (max_y - y) / resolution
+
+        for geometry in shortest_path_gpd.geometry:
+            lines = geometry.geoms if hasattr(geometry, 'geoms') else [geometry]
+            for line in lines:
+                draw.line([pixel(x, y) for x, y in line.coords], fill=(255, 165, 0, 255), width=5)
+        for point, colour in ((user_location, (255, 0, 0, 255)), (highest_point, (0, 128, 0, 255))):
+            px, py = pixel(point.x, point.y)
+            draw.ellipse((px - 8, py - 8, px + 8, py + 8), fill=colour)
+
+        if output_file is not None:
+            image.save(output_file, compress_level=1)
+        return image
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tile pyramid of the static layers of the map.')
+    parser.add_argument('--tile-dir', default='Material/tiles')
+    parser.add_argument('--zooms', type=int, nargs='*', help='zoom levels to render (default: all)')
+    args = parser.parse_args()
+    count = MapTiles.open(args.tile_dir).build(args.zooms)
+    print(str(count) + ' tiles ready in ' + args.tile_dir + '.')
+
+
+if __name__ == '__main__':
+    main()
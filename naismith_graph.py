@@ -0,0 +1,301 @@
+import json
+import math
+import os
+
+import networkx as nx
+import numpy as np
+import shapely
+
+from elevation import ElevationProvider
+from instrumentation import instruments
+from link_profiles import LinkProfiles
+from routing import CSRGraph
+
+# Naismith's rule: walking speed of 5 km/h (m/s) and one minute more for every 10 metres climbed (s/m)
+WALKING_SPEED = 5000 / 3600
+CLIMB_TIME = 60 / 10
+
+
+# Directed road graph of the whole road network, where the weight of each road link is the walking time calculated by
+# Naismith's rule in each direction, with the ascent along the elevation profile of the road link (see LinkProfiles).
+# The weights and the profiles are computed once with NumPy for all the road links of the ITN store,
+# and the graph is cached on disk next to the store and in memory, so a query only selects the road nodes within its
+# 5km buffer instead of building a new graph.
+# Road closures (e.g. flooded roads) are applied to the loaded graph in place by scaling the walking time of their road
+# links, the cache file always keeps the walking times of the open network.
+class NaismithGraph:
+    # Version of the cached arrays, it has to be increased whenever the weights computed by build() change
+    VERSION = 2
+    # Graphs already loaded by this process, keyed by the store folder and the elevation file
+    __loaded = {}
+
+    def __init__(self, store, elevation_file):
+        self.__store = store
+        self.__elevation_file = elevation_file
+        self.__cache_file = os.path.join(store.get_store_dir(), 'naismith.npz')
+        self.__arrays = {}
+        self.__signature = None  # signature of the data the arrays have been computed from
+        self.__graph = None
+        self.__csr = None
+        self.__bound_data = None
+        self.__link_factors = {}  # factor of the walking time of the closed road links, inf if impassable
+        self.__link_tree = None
+
+    # Load the graph of an ITN store and an elevation file: from memory if it has already been loaded by this process,
+    # otherwise from the cache file if it is up to date, otherwise build it
+    @staticmethod
+    def load(store, elevation_file):
+        key = (os.path.abspath(store.get_store_dir()), os.path.abspath(elevation_file))
+        graph = NaismithGraph.__loaded.get(key)
+        if graph is None or graph.is_stale():
+            graph = NaismithGraph(store, elevation_file)
+            if graph.is_cache_stale():
+                print('Building the road graph of the whole network...\n')
+                with instruments.stage('graph_build'):
+                    graph.build()
+                instruments.count('edges_built', len(graph.get_edge_weight()))
+            else:
+                with instruments.stage('graph_read'):
+                    graph.read()
+            NaismithGraph.__loaded[key] = graph
+        return graph
+
+    # Signature of the road network store and the elevation file, the graph is rebuilt whenever it changes
+    def signature(self):
+        store_stat = os.stat(os.path.join(self.__store.get_store_dir(), 'meta.json'))
+        stat = os.stat(self.__elevation_file)
+        return {'version': self.VERSION, 'store': [store_stat.st_size, store_stat.st_mtime_ns],
+                'elevation': [os.path.abspath(self.__elevation_file), stat.st_size, stat.st_mtime_ns]}
+
+    # Check whether the arrays in memory have been computed from different data
+    def is_stale(self):
+        return self.__signature != self.signature()
+
+    # Check whether the cache file is missing or has been built from different data
+    def is_cache_stale(self):
+        if not os.path.exists(self.__cache_file):
+            return True
+        with np.load(self.__cache_file) as cached:
+            return json.loads(str(cached['signature'])) != self.signature()
+
+    # Compute the walking time of every road link in both directions
+    def build(self):
+        signature = self.signature()
+        store = self.__store
+        link_start = np.asarray(store.get_link_start())
+        link_end = np.asarray(store.get_link_end())
+        link_length = np.asarray(store.get_link_length())
+
+        # Elevation profile of every road link along its geometry, interpolated from the DEM
+        with instruments.stage('link_profiles'):
+            dem = ElevationProvider.open(self.__elevation_file)
+            profiles = LinkProfiles(store, dem).compute()
+            dem.close()
+        ascent_forward, ascent_backward = profiles.get_ascent_forward(), profiles.get_ascent_backward()
+
+        # total walking time = road_length(m) / speed(m/s) + climbing elevation(m) * (60s/10m), where the climbing is
+        # the ascent along the road link in the direction it is walked
+        walking_time = link_length / WALKING_SPEED
+        links = np.arange(len(link_length), dtype=np.int64)
+        self.__arrays = {
+            'node_elevation': profiles.get_node_elevation(),
+            'vertex_elevation': profiles.get_vertex_elevation(),
+            'ascent_forward': ascent_forward,
+            'ascent_backward': ascent_backward,
+            # Each road link from start to end followed by the same road link from end to start, in the order of the
+            # road links, so that the last of parallel road links is kept in the graph as before
+            'edge_from': np.column_stack([link_start, link_end]).ravel().astype(np.int64),
+            'edge_to': np.column_stack([link_end, link_start]).ravel().astype(np.int64),
+            'edge_link': np.repeat(links, 2),
+            'edge_weight': np.column_stack([walking_time + ascent_forward * CLIMB_TIME,
+                                            walking_time + ascent_backward * CLIMB_TIME]).ravel()
+        }
+        self.__signature = signature
+        self.__graph = None
+        self.__csr = None
+        self.__bound_data = None
+        self.__link_factors = {}
+
+        temp_file = self.__cache_file + '.' + str(os.getpid()) + '.tmp.npz'
+        np.savez(temp_file, signature=np.array(json.dumps(signature)), **self.__arrays)
+        os.replace(temp_file, self.__cache_file)
+        return self
+
+    # Read the arrays from the cache file
+    def read(self):
+        with np.load(self.__cache_file) as cached:
+            self.__signature = json.loads(str(cached['signature']))
+            self.__arrays = {name: cached[name] for name in cached.files if name != 'signature'}
+        self.__graph = None
+        self.__csr = None
+        self.__bound_data = None
+        self.__link_factors = {}
+        return self
+
+    # Methods to return the arrays of the graph
+    # Elevation (m) of each road node
+    def get_node_elevation(self):
+        return self.__arrays['node_elevation']
+
+    # Elevation (m) of each vertex of the road links, aligned with ITNStore.get_link_coords()
+    def get_vertex_elevation(self):
+        return self.__arrays['vertex_elevation']
+
+    # Ascent (m) of each road link from its start to its end, and from its end to its start
+    def get_ascent_forward(self):
+        return self.__arrays['ascent_forward']
+
+    def get_ascent_backward(self):
+        return self.__arrays['ascent_backward']
+
+    # Index of the road node each directed edge starts from
+    def get_edge_from(self):
+        return self.__arrays['edge_from']
+
+    # Index of the road node each directed edge goes to
+    def get_edge_to(self):
+        return self.__arrays['edge_to']
+
+    # Index of the road link of each directed edge
+    def get_edge_link(self):
+        return self.__arrays['edge_link']
+
+    # Walking time (s) of each directed edge
+    def get_edge_weight(self):
+        return self.__arrays['edge_weight']
+
+    # Method to return the ITN store of the graph
+    def get_store(self):
+        return self.__store
+
+    # Directed road graph of the whole network with the feature ids of the road nodes as nodes, and the feature id of
+    # the road link and its walking time as the attributes 'fid' and 'weight' of each edge. It is built on first use.
+    def get_graph(self):
+        if self.__graph is None:
+            node_ids = self.__store.get_node_ids().tolist()
+            link_ids = self.__store.get_link_ids().tolist()
+            graph = nx.DiGraph()
+            graph.add_edges_from(
+                (node_ids[u], node_ids[v], {'fid': link_ids[link], 'weight': weight})
+                for u, v, link, weight in zip(self.get_edge_from().tolist(), self.get_edge_to().tolist(),
+                                              self.get_edge_link().tolist(), self.get_edge_weight().tolist()))
+            self.__graph = graph
+            # The road closures applied before the graph is built
+            self.__update_graph(self.__link_factors)
+        return self.__graph
+
+    # Compressed sparse row arrays of the graph, used by the CSR routing backend. They are built on first use.
+    def get_csr(self):
+        if self.__csr is None:
+            self.__csr = CSRGraph.from_naismith(self)
+        return self.__csr
+
+    # Lower bound of the walking time between two road nodes by Naismith's rule: the straight-line distance at walking
+    # speed plus the climb from the lower to the higher road node. No path can take less, as a road link is never
+    # shorter than the straight line between its road nodes and the climbs along a path add up to at least the
+    # difference of elevation between its ends. It is the heuristic of the A* search.
+    # It returns a function of a road node index v giving the lower bound from v to node, or from node to v if reverse.
+    def lower_bound(self, node, reverse=False):
+        if self.__bound_data is None:
+            node_coords = np.asarray(self.__store.get_node_coords())
+            link_start = np.asarray(self.__store.get_link_start())
+            link_end = np.asarray(self.__store.get_link_end())
+            straight = np.hypot(*(node_coords[link_end] - node_coords[link_start]).T)
+            # Error handling: if a road link is shorter than the straight line between its road nodes (e.g. rounded
+            # lengths), the distances are scaled down so that the bound stays below the walking time. The bound is also
+            # kept slightly below so that rounding errors never make it larger than the walking time of a road link.
+            ratio = np.asarray(self.__store.get_link_length())[straight > 0] / straight[straight > 0]
+            factor = min(float(ratio.min()) if len(ratio) > 0 else 1.0, 1.0) * (1 - 1e-9) / WALKING_SPEED
+            self.__bound_data = (node_coords[:, 0].tolist(), node_coords[:, 1].tolist(),
+                                 (self.get_node_elevation() * (1 - 1e-9)).tolist(), factor)
+        xs, ys, elevation, factor = self.__bound_data
+        x, y, z = xs[node], ys[node], elevation[node]
+        if reverse:
+            return lambda v: factor * math.hypot(xs[v] - x, ys[v] - y) + max(elevation[v] - z, 0) * CLIMB_TIME
+        return lambda v: factor * math.hypot(x - xs[v], y - ys[v]) + max(z - elevation[v], 0) * CLIMB_TIME
+
+    # Mask of the road nodes within (or touching) a polygon, e.g. the 5km buffer around the user. The road graph of a
+    # query keeps every road link between two road nodes of the mask, including those whose geometry bends out of the
+    # polygon, which the original per-query graph left out.
+    def node_mask(self, polygon):
+        node_coords = self.__store.get_node_coords()
+        min_x, min_y, max_x, max_y = polygon.bounds
+        mask = ((node_coords[:, 0] >= min_x) & (node_coords[:, 0] <= max_x) &
+                (node_coords[:, 1] >= min_y) & (node_coords[:, 1] <= max_y))
+        candidates = np.flatnonzero(mask)
+        mask[candidates] = shapely.intersects_xy(polygon, node_coords[candidates, 0], node_coords[candidates, 1])
+        return mask
+
+    # Road links intersecting a polygon (e.g. a flooded area), found with a spatial index of the road links built on
+    # first use
+    def links_within(self, polygon):
+        if self.__link_tree is None:
+            offsets = np.asarray(self.__store.get_link_offsets())
+            indices = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+            self.__link_tree = shapely.STRtree(shapely.linestrings(np.asarray(self.__store.get_link_coords()),
+                                                                   indices=indices))
+        return np.sort(self.__link_tree.query(polygon, predicate='intersects'))
+
+    # Road links with a road node at or below a water level (m)
+    def links_below(self, water_level):
+        node_elevation = self.get_node_elevation()
+        link_start = np.asarray(self.__store.get_link_start())
+        link_end = np.asarray(self.__store.get_link_end())
+        return np.flatnonzero((node_elevation[link_start] <= water_level) | (node_elevation[link_end] <= water_level))
+
+    # Method to return the factors of the walking time of the closed road links
+    def get_link_factors(self):
+        return dict(self.__link_factors)
+
+    # Replace the road closures: factors maps road link indices to the factor of their walking time (inf for an
+    # impassable road, at least 1 otherwise so that the lower bounds of A* still hold), the other road links are
+    # reopened. Only the road links whose factor changes are updated, in the CSR graph and in the networkx graph if
+    # they have been built. The road links whose walking time has gone up and those whose walking time has gone down
+    # are returned.
+    def set_link_factors(self, factors):
+        factors = {int(link): float(factor) for link, factor in factors.items() if factor != 1}
+        # Error handling: a factor below 1 would make the lower bounds of A* larger than the walking time
+        for link, factor in factors.items():
+            if not factor >= 1:
+                raise ValueError('The factor of road link ' + str(link) + ' must be at least 1, not ' + str(factor))
+        raised, lowered = compare_link_factors(self.__link_factors, factors)
+        changed = {link: factors.get(link, 1.0) for link in raised + lowered}
+        self.__link_factors = factors
+        if changed:
+            self.get_csr().scale_links(changed)
+        if changed and self.__graph is not None:
+            self.__update_graph(changed)
+        return raised, lowered
+
+    # Update the edges of changed road links in the networkx graph, like the CSR graph: only the last road link between
+    # the same pair of road nodes is in the graph, and an impassable road link is removed from it
+    def __update_graph(self, changed):
+        csr = self.get_csr()
+        node_ids = self.__store.get_node_ids()
+        link_ids = self.__store.get_link_ids()
+        edge_from, edge_to = self.get_edge_from(), self.get_edge_to()
+        for link in changed:
+            for e in (2 * link, 2 * link + 1):
+                k = csr.edge(int(edge_from[e]), int(edge_to[e]))
+                if csr.edge_link(k) != link:
+                    continue
+                u, v = str(node_ids[edge_from[e]]), str(node_ids[edge_to[e]])
+                if math.isinf(csr.edge_weight(k)):
+                    if self.__graph.has_edge(u, v):
+                        self.__graph.remove_edge(u, v)
+                else:
+                    self.__graph.add_edge(u, v, fid=str(link_ids[link]), weight=csr.edge_weight(k))
+
+    # View of the graph restricted to the road nodes within a polygon, without copying the graph
+    def subgraph(self, polygon):
+        node_ids = self.__store.get_node_ids()
+        return self.get_graph().subgraph(node_ids[self.node_mask(polygon)].tolist())
+
+
+# Road links whose factor of the walking time has gone up and those whose factor has gone down between two sets of road
+# closures (road link index -> factor, 1 for the road links which are not given)
+def compare_link_factors(old_factors, new_factors):
+    links = set(old_factors) | set(new_factors)
+    raised = sorted(link for link in links if new_factors.get(link, 1.0) > old_factors.get(link, 1.0))
+    lowered = sorted(link for link in links if new_factors.get(link, 1.0) < old_factors.get(link, 1.0))
+    return raised, lowered
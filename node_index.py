@@ -0,0 +1,126 @@
+import json
+import os
+import sys
+
+import numpy as np
+from rtree import index
+
+from instrumentation import instruments
+from itn_store import ITNStore
+
+
+# Disk-backed r-tree of every road node of the ITN store, bulk loaded once with the stream constructor of rtree and
+# saved next to the store (node_rtree.idx and node_rtree.dat). The ids of the r-tree are the indices of the road nodes
+# in the store. Queries are not restricted to the 5km buffer of the user when the r-tree is built, a maximum distance
+# can be given at lookup time instead.
+class NodeIndex:
+    # Version of the r-tree files, it has to be increased whenever build() changes
+    VERSION = 1
+    # r-trees already opened, keyed by the process id and the folder of the store. libspatialindex keeps the position
+    # and the buffers of the files in memory, so a process forked from one which has opened an r-tree opens it again
+    # instead of sharing it.
+    __opened = {}
+
+    def __init__(self, store):
+        self.__store = store  # opened ITNStore
+        self.__base = os.path.join(store.get_store_dir(), 'node_rtree')
+        self.__idx = None
+
+    # r-tree of the road nodes of an opened store shared by every query of this process, (re)built first if it is
+    # missing or out of date
+    @staticmethod
+    def open(store):
+        key = (os.getpid(), os.path.abspath(store.get_store_dir()))
+        node_index = NodeIndex.__opened.get(key)
+        if node_index is None:
+            node_index = NodeIndex(store)
+            if node_index.is_stale():
+                print('Building the r-tree of the road nodes...\n')
+                node_index.build()
+            node_index.read()
+            NodeIndex.__opened[key] = node_index
+        return node_index
+
+    # Signature of the road node coordinates of the store, the r-tree is rebuilt whenever they change
+    def signature(self):
+        stat = os.stat(os.path.join(self.__store.get_store_dir(), 'node_coords.npy'))
+        return {'version': self.VERSION, 'node_coords': [stat.st_size, stat.st_mtime_ns]}
+
+    # Check whether the r-tree files are missing or have been built from different road nodes
+    def is_stale(self):
+        if not all(os.path.exists(self.__base + ext) for ext in ('.idx', '.dat', '.json')):
+            return True
+        with open(self.__base + '.json', 'r') as f:
+            return json.load(f) != self.signature()
+
+    # Bulk load every road node into the r-tree files.
+    # The files are written under a temporary name and then moved into place, and the signature is written last, so
+    # a process opening the r-tree at the same time never reads half written files.
+    def build(self):
+        signature = self.signature()
+        coords = np.asarray(self.__store.get_node_coords())
+        temp_base = self.__base + '.' + str(os.getpid()) + '.tmp'
+        properties = index.Property()
+        properties.overwrite = True
+        stream = ((i, (x, y, x, y), None) for i, (x, y) in enumerate(coords.tolist()))
+        with instruments.stage('node_index_build'):
+            index.Index(temp_base, stream, properties=properties).close()
+        instruments.count('nodes_inserted', len(coords))
+        for ext in ('.idx', '.dat'):
+            os.replace(temp_base + ext, self.__base + ext)
+        with open(temp_base + '.json', 'w') as f:
+            json.dump(signature, f)
+        os.replace(temp_base + '.json', self.__base + '.json')
+        return self
+
+    # Open the r-tree files
+    def read(self):
+        self.__idx = index.Index(self.__base)
+        return self
+
+    # Indices of the k road nodes nearest to a location, in ascending index order. Like rtree, road nodes at the same
+    # distance as the k-th nearest one are all returned. Road nodes farther than max_distance (m) are left out.
+    def nearest(self, x, y, k=1, max_distance=None):
+        nodes = np.array(list(self.__idx.nearest((x, y, x, y), k)), dtype=np.int64)
+        if max_distance is not None and len(nodes) > 0:
+            coords = np.asarray(self.__store.get_node_coords())[nodes]
+            nodes = nodes[np.hypot(coords[:, 0] - x, coords[:, 1] - y) <= max_distance]
+        return np.sort(nodes)
+
+    # Indices of the road nodes within a bounding box, in ascending index order
+    def intersection(self, min_x, min_y, max_x, max_y):
+        return np.sort(np.fromiter(self.__idx.intersection((min_x, min_y, max_x, max_y)), dtype=np.int64))
+
+    # Index of the road node nearest to each location of arrays of eastings and northings, in one bulk query of the
+    # r-tree. -1 is returned for the locations without any road node within max_distance (m).
+    # Among road nodes at the same distance, the one with the lowest index is taken.
+    def nearest_batch(self, eastings, northings, max_distance=None):
+        points = np.column_stack([np.asarray(eastings, dtype=np.float64), np.asarray(northings, dtype=np.float64)])
+        nodes = np.full(len(points), -1, dtype=np.int64)
+        if len(points) == 0:
+            return nodes
+        ids, counts = self.__idx.nearest_v(points, points, num_results=1)
+        ids, counts = ids.astype(np.int64), counts.astype(np.int64)
+        # Lowest index among the ties of each location
+        starts = np.cumsum(counts) - counts
+        found = counts > 0
+        nodes[found] = np.minimum.reduceat(ids, starts[found])
+        if max_distance is not None:
+            coords = np.asarray(self.__store.get_node_coords())[nodes[found]]
+            far = np.hypot(*(coords - points[found]).T) > max_distance
+            nodes[np.flatnonzero(found)[far]] = -1
+        return nodes
+
+    # Release the r-tree files
+    def close(self):
+        if self.__idx is not None:
+            self.__idx.close()
+            self.__idx = None
+        NodeIndex.__opened.pop((os.getpid(), os.path.abspath(self.__store.get_store_dir())), None)
+
+
+# Build the r-tree of the road nodes once, e.g. python node_index.py Material/itn/solent_itn.json
+if __name__ == '__main__':
+    itn_path = sys.argv[1] if len(sys.argv) > 1 else 'Material/itn/solent_itn.json'
+    NodeIndex(ITNStore(itn_path).open()).build()
+    print('r-tree of the road nodes of ' + itn_path + ' built.')
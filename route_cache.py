@@ -0,0 +1,134 @@
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+
+# Cache of the results of EvacuationRouter.route, shared by the users who snap to the same road node(s) and whose 5km
+# buffers have the same highest point(s). The route is searched within the 5km buffer around the road node of the
+# user, so it only depends on them and on the road node(s) nearest to the highest point(s) within it. Each result is
+# kept with the version of the network it was found on (road network, DEM, flood scenario and road closures), so a
+# result is never reused on a different network.
+# The cache keeps at most max_size results and evicts the least recently used ones. It is kept in memory, or in a
+# SQLite file if a path is given, so that several worker processes reuse each other's results.
+class RouteCache:
+
+    def __init__(self, max_size=1024, path=None):
+        self.__max_size = max_size
+        self.__path = path
+        self.__results = OrderedDict()  # results kept in memory, the least recently used first
+        self.__connection = None  # SQLite connection, opened on first use by the process using it
+        self.__pid = None  # process the connection has been opened by
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+
+    # Key of the results of the road node(s) nearest to the user, of the highest points and of the road node(s) nearest
+    # to each of them within the buffer of the road node of the user (feature ids)
+    @staticmethod
+    def key(nodes_user, highest_points, nodes_highest):
+        return json.dumps([list(nodes_user), [[p.x, p.y] for p in highest_points],
+                           [list(nodes) for nodes in nodes_highest]])
+
+    # SQLite connection of this process. A connection cannot be shared with the worker processes forked after it was
+    # opened, so each process opens its own.
+    def __connect(self):
+        if self.__connection is None or self.__pid != os.getpid():
+            connection = sqlite3.connect(self.__path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS routes (version TEXT, key TEXT, result TEXT, used REAL, '
+                               'PRIMARY KEY (version, key))')
+            connection.execute('CREATE INDEX IF NOT EXISTS routes_used ON routes (used)')
+            self.__connection, self.__pid = connection, os.getpid()
+        return self.__connection
+
+    # Result of a key on a version of the network, None if it is not in the cache
+    def get(self, version, key):
+        if self.__path is None:
+            result = self.__results.get((version, key))
+            if result is not None:
+                self.__results.move_to_end((version, key))
+        else:
+            connection = self.__connect()
+            row = connection.execute('SELECT result FROM routes WHERE version = ? AND key = ?',
+                                     (version, key)).fetchone()
+            result = json.loads(row[0]) if row is not None else None
+            if result is not None:
+                connection.execute('UPDATE routes SET used = ? WHERE version = ? AND key = ?',
+                                   (time.time(), version, key))
+        if result is None:
+            self.__misses += 1
+        else:
+            self.__hits += 1
+        return result
+
+    # Keep the result of a key on a version of the network, and evict the least recently used results beyond max_size
+    def put(self, version, key, result):
+        if self.__max_size <= 0:
+            return
+        if self.__path is None:
+            self.__results[(version, key)] = result
+            self.__results.move_to_end((version, key))
+            while len(self.__results) > self.__max_size:
+                self.__results.popitem(last=False)
+                self.__evictions += 1
+            return
+        connection = self.__connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('INSERT OR REPLACE INTO routes VALUES (?, ?, ?, ?)',
+                               (version, key, json.dumps(result), time.time()))
+            evicted = connection.execute('DELETE FROM routes WHERE rowid IN (SELECT rowid FROM routes ORDER BY used '
+                                         'LIMIT max(0, (SELECT count(*) FROM routes) - ?))', (self.__max_size,))
+            self.__evictions += evicted.rowcount
+            connection.execute('COMMIT')
+        except sqlite3.Error:
+            connection.execute('ROLLBACK')
+            raise
+
+    # Move the results of a version of the network to a new version (e.g. new road closures), except those for which
+    # is_stale(result) is true, which are removed. The number of removed results is returned.
+    # Run by several processes sharing a SQLite file, the results are only moved by the first one.
+    def migrate(self, old_version, new_version, is_stale):
+        removed = 0
+        if self.__path is None:
+            for version, key in list(self.__results):
+                if version == old_version:
+                    result = self.__results.pop((version, key))
+                    if is_stale(result):
+                        removed += 1
+                    else:
+                        self.__results[(new_version, key)] = result
+            return removed
+        connection = self.__connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = connection.execute('SELECT key, result FROM routes WHERE version = ?', (old_version,)).fetchall()
+            stale = [(old_version, key) for key, result in rows if is_stale(json.loads(result))]
+            removed = len(stale)
+            connection.executemany('DELETE FROM routes WHERE version = ? AND key = ?', stale)
+            connection.execute('UPDATE OR REPLACE routes SET version = ? WHERE version = ?', (new_version, old_version))
+            connection.execute('COMMIT')
+        except sqlite3.Error:
+            connection.execute('ROLLBACK')
+            raise
+        return removed
+
+    # Remove every result
+    def clear(self):
+        self.__results = OrderedDict()
+        if self.__path is not None:
+            self.__connect().execute('DELETE FROM routes')
+
+    # Number of results in the cache
+    def __len__(self):
+        if self.__path is None:
+            return len(self.__results)
+        return self.__connect().execute('SELECT count(*) FROM routes').fetchone()[0]
+
+    # Hits, misses and evictions of this process, and the number of results in the cache
+    def get_stats(self):
+        lookups = self.__hits + self.__misses
+        return {'hits': self.__hits, 'misses': self.__misses, 'evictions': self.__evictions, 'size': len(self),
+                'hit_rate': round(self.__hits / lookups, 4) if lookups else None}
@@ -0,0 +1,338 @@
+import contextlib
+import hashlib
+import io
+import json
+import math
+import traceback
+
+import numpy as np
+
+from shapely.geometry import MultiLineString, Point, Polygon, mapping
+
+from closures import RoadClosures
+from elevation import ElevationProvider
+from flood import FloodScenario
+from instrumentation import instruments
+from itn_store import ITNStore
+from land_check import LandBoundary
+from node_index import NodeIndex
+from naismith_graph import NaismithGraph, compare_link_factors
+from route_cache import RouteCache
+from summit_index import SummitIndex
+from task2 import HighestPoint
+from task3 import ITN, RoadNode
+from task4 import ShortestPath
+
+# Boundary of the elevation raster which the user location must be within (see CoordinateInput.prompt)
+EASTING_RANGE = (425000, 470000)
+NORTHING_RANGE = (75000, 100000)
+
+# Default data files of the Isle of Wight, used by the command line tools
+shape_file = 'Material/shape/isle_of_wight.shp'
+road_file = 'Material/itn/solent_itn.json'
+elevation_file = 'Material/elevation/SZ.asc'
+
+# Router of a worker process (see batch.py and server.py), created once by init_worker when the worker starts
+_router = None
+
+
+# Answer evacuation queries without any interaction with the user. The land boundary, the road network and the DEM
+# are loaded once when the router is created and then shared by every query, so it can be kept by a long-running
+# service which answers many queries.
+class EvacuationRouter:
+
+    # backend is the routing backend of ShortestPath (see routing.ROUTING_BACKENDS) and closures_file an optional JSON
+    # file of road closures (see closures.RoadClosures), read again before a query whenever it has changed.
+    # If a water level (m) is given, the highest points are only searched among the dry places connected to the user
+    # and the road links under water are closed (see flood.FloodScenario).
+    # cache is an optional RouteCache of the results, shared by the users who snap to the same road node(s) and have
+    # the same highest point(s) (see route_group).
+    def __init__(self, shape_file, road_file, elevation_file, backend='csr', closures_file=None, water_level=None,
+                 cache=None):
+        self.__road_file = road_file
+        self.__elevation_file = elevation_file
+        self.__backend = backend
+        self.__closures_file = closures_file
+        self.__closures = RoadClosures()
+        self.__closures_signature = None  # signature of the closures file when it was last read
+        self.__closures_graph = None  # road graph the closures have been applied to
+        self.__link_factors = {}  # factors of the walking time of the road links closed by this router
+        self.__water_level = water_level
+        self.__cache = cache
+        self.__version = None  # version of the network of the cached results, set when the closures are applied
+        self.__searches = 0  # searches of the road graph run by this router
+        # Land boundary of the Isle of Wight in the British National Grid
+        self.__land = LandBoundary.open(shape_file)
+        # Road network, the store is built first if it does not exist yet
+        self.__store = ITNStore(road_file).open()
+        # DEM, kept open for windowed reads
+        self.__dem = ElevationProvider.open(elevation_file)
+        # Pyramid of the elevation maxima for finding the highest points, built once and cached
+        self.__summits = SummitIndex.load(self.__dem)
+        # Flooded area and dry regions of the water level, computed once and cached
+        self.__flood = None
+        if water_level is not None:
+            with instruments.stage('flood'):
+                self.__flood = FloodScenario.load(self.__dem, water_level)
+        # Road graph of the whole network, built once and cached
+        NaismithGraph.load(self.__store, elevation_file)
+
+    # Apply road closures to the road graph in place, replacing the previous ones, on top of the road links under water
+    # if a water level is given. Only the road links whose walking time changes are updated. If a dictionary of routes
+    # (results of route()) is given, the routes which may have changed are removed from it: those going through a road
+    # link whose walking time has gone up, and those whose road graph reaches a road link whose walking time has gone
+    # down. The road graph of a route is the 5km buffer around the road node the user snaps to from up to 5km away,
+    # so it is within 10km of the user. The feature ids of the road links whose walking time has gone up and down are
+    # returned.
+    # The road graph is shared by the routers of a process, so they all route with the last closures applied, but the
+    # routes are compared with the closures previously applied by this router.
+    def update_closures(self, closures, routes=None):
+        with instruments.stage('closures'):
+            graph = NaismithGraph.load(self.__store, self.__elevation_file)
+            factors = closures.link_factors(graph)
+            if self.__flood is not None:
+                factors.update((link, math.inf) for link in self.__flood.flooded_links(graph).tolist())
+            graph.set_link_factors(factors)
+            factors = graph.get_link_factors()
+            raised, lowered = compare_link_factors(self.__link_factors if graph is self.__closures_graph else {},
+                                                   factors)
+            self.__link_factors = factors
+            self.__closures = closures
+            self.__closures_graph = graph
+            if routes is not None:
+                is_stale = self.__stale_test(raised, lowered, lambda result: result['user'], 10000)
+                for key in [key for key, result in routes.items() if is_stale(result)]:
+                    del routes[key]
+            self.__update_version(graph, factors, raised, lowered)
+        instruments.count('links_changed', len(raised) + len(lowered))
+        link_ids = self.__store.get_link_ids()
+        return [str(link_ids[link]) for link in raised], [str(link_ids[link]) for link in lowered]
+
+    # Test of the routes which may have changed with the walking time of some road links: those going through a road
+    # link whose walking time has gone up, and those with a road node of a road link whose walking time has gone down
+    # within a radius of position(result)
+    def __stale_test(self, raised, lowered, position, radius):
+        link_ids = self.__store.get_link_ids()
+        raised_fids = {str(link_ids[link]) for link in raised}
+        node_coords = np.asarray(self.__store.get_node_coords())
+        lowered_nodes = np.concatenate([np.asarray(self.__store.get_link_start())[lowered],
+                                        np.asarray(self.__store.get_link_end())[lowered]])
+        lowered_coords = node_coords[np.unique(lowered_nodes)]
+
+        def is_stale(result):
+            if raised_fids.intersection(result.get('route', [])):
+                return True
+            if len(lowered_coords) == 0:
+                return False
+            return np.hypot(*(lowered_coords - np.asarray(position(result))).T).min() <= radius
+        return is_stale
+
+    # Version of the network of the cached results: the road graph, the flood scenario and the road closures. When only
+    # the road closures change, the cached results which cannot have changed are moved to the new version, as for the
+    # routes of update_closures.
+    def __update_version(self, graph, factors, raised, lowered):
+        network = hashlib.sha1(json.dumps([graph.signature(), self.__water_level]).encode()).hexdigest()[:16]
+        closures = hashlib.sha1(json.dumps(sorted(factors.items())).encode()).hexdigest()[:16]
+        version = network + '-' + closures
+        migrate = self.__version is not None and self.__version != version and self.__version.startswith(network)
+        if self.__cache is not None and migrate:
+            is_stale = self.__stale_test(raised, lowered, lambda result: result['user'], 10000)
+            instruments.count('route_cache_invalidated', self.__cache.migrate(self.__version, version, is_stale))
+        self.__version = version
+
+    # Method to return the statistics of the route cache, None if there is no cache
+    def get_cache_stats(self):
+        return self.__cache.get_stats() if self.__cache is not None else None
+
+    # Read the closures file again if it has changed, and apply the closures again if the road graph has been reloaded
+    def __refresh_closures(self):
+        if self.__closures_file is not None:
+            signature = RoadClosures.file_signature(self.__closures_file)
+            if signature != self.__closures_signature:
+                self.__closures_signature = signature
+                # Error handling: a malformed file is reported and the previous closures are kept
+                try:
+                    closures = RoadClosures.read(self.__closures_file)
+                except (ValueError, KeyError) as e:
+                    print('The road closures of ' + self.__closures_file + ' cannot be read (' + repr(e) + ').')
+                else:
+                    self.update_closures(closures)
+                    return
+        if NaismithGraph.load(self.__store, self.__elevation_file) is not self.__closures_graph:
+            self.update_closures(self.__closures)
+
+    # Check whether a location is within the boundary of the elevation raster and on the land of the Isle of Wight
+    def is_valid(self, position):
+        if not EASTING_RANGE[0] <= position.x <= EASTING_RANGE[1]:
+            return False
+        if not NORTHING_RANGE[0] <= position.y <= NORTHING_RANGE[1]:
+            return False
+        return self.__land.contains(position)
+
+    # Find the highest point within 5km from the user, the shortest path to it and the walking time.
+    # The result is returned as a dictionary which can be serialised to JSON. The messages which the tasks print for
+    # the user are captured, and the last one is returned as the error if no route can be found.
+    # validate can be turned off when the location has already been checked.
+    # The stages and the counters of each query are recorded by the instrumentation if it is on.
+    def route(self, easting, northing, validate=True):
+        with instruments.query(easting=easting, northing=northing):
+            return self.route_group([(easting, northing)], validate)[0]
+
+    # Route a group of users given as (easting, northing) pairs, e.g. the users of a population file who snap to the
+    # same road node (see batch.py), and return their results in the same order.
+    # The highest point(s) are found within the 5km buffer of each user, but the road graph of the route is the 5km
+    # buffer around the road node the user snaps to, where the road node(s) nearest to the highest points are found
+    # too. The route therefore only depends on the road node(s) of the user and the highest point(s), which key the
+    # route cache, and all the users of the group who start from the same road node(s) are routed with one search.
+    def route_group(self, locations, validate=True):
+        self.__refresh_closures()
+        results = []
+        shortest_paths = {}  # ShortestPath of the 5km buffer around the road node(s) of the users, keyed by them
+        pending = {}  # users whose route has to be searched, grouped by their road node(s)
+        for easting, northing in locations:
+            with instruments.query(easting=easting, northing=northing):
+                result, query = self.__prepare(Point(easting, northing), validate, shortest_paths)
+            results.append(result)
+            if query is not None:
+                pending.setdefault(query['nodes_user'], []).append((result, query))
+        for nodes_user, queries in pending.items():
+            with instruments.query(node_user=nodes_user[0].object, users=len(queries)):
+                self.__search(nodes_user, queries, shortest_paths[nodes_user])
+        return results
+
+    # Find the highest point(s) of a user, the road node(s) the user snaps to and the road node(s) nearest to each
+    # highest point, and take the result from the route cache if it is there. The result is returned with the query
+    # of the search if the route has to be searched, None otherwise.
+    def __prepare(self, position, validate, shortest_paths):
+        result = {'user': [position.x, position.y]}
+        if validate and not self.is_valid(position):
+            result['error'] = 'The position is not on the land of Isle of Wight.'
+            return result, None
+
+        def find_nodes():
+            hp = HighestPoint(position, self.__dem, self.__summits, self.__flood)
+            highest_points = hp.get_highest_point()
+            nodes_user = self.__snap(position)
+            if nodes_user not in shortest_paths:
+                x, y = np.asarray(self.__store.get_node_coords())[nodes_user[0].id]
+                buffer = Polygon(Point(x, y).buffer(5000))
+                shortest_paths[nodes_user] = ShortestPath(self.__road_file, ITN(self.__road_file, buffer, self.__store),
+                                                          None, buffer, self.__store, self.__backend)
+            return {'nodes_user': nodes_user, 'highest_points': highest_points,
+                    'nodes_highest': shortest_paths[nodes_user].nearest_nodes_highest(highest_points)}
+        query = self.__capture(result, find_nodes)
+        if query is None:
+            return result, None
+
+        # Result of the same road nodes and highest point(s) found by an earlier query
+        if self.__cache is not None:
+            query['cache_key'] = RouteCache.key([node.object for node in query['nodes_user']],
+                                                query['highest_points'],
+                                                [[node.object for node in nodes] for nodes in query['nodes_highest']])
+            cached = self.__cache.get(self.__version, query['cache_key'])
+            instruments.count('route_cache_hits' if cached is not None else 'route_cache_misses')
+            if cached is not None:
+                result.update(cached, user=result['user'])
+                return result, None
+        return result, query
+
+    # Road node(s) nearest to a user within 5km, found with the r-tree of all the road nodes like ITN.nearest_node
+    def __snap(self, position):
+        with instruments.stage('nearest_node'):
+            nodes = NodeIndex.open(self.__store).nearest(position.x, position.y, max_distance=5000)
+        # Error handling: no road node within 5km
+        if len(nodes) == 0:
+            print('Sorry, no ITN node found within 5km!')
+            exit()
+        node_ids = self.__store.get_node_ids()
+        return tuple(RoadNode(int(node), str(node_ids[node])) for node in nodes)
+
+    # Search the routes of the users who start from the same road node(s) at once, in the 5km buffer around them, and
+    # select the route of each user from the search. Users with the same highest point(s) and road nodes share the
+    # same result.
+    def __search(self, nodes_user, queries, shortest_path):
+        nodes_highest = [nodes for _, query in queries for nodes in query['nodes_highest']]
+        messages = io.StringIO()
+        # Error handling: the search is the same for all the users of the group, which all get its error
+        try:
+            with contextlib.redirect_stdout(messages):
+                shortest_path.search(self.__elevation_file, nodes_user, nodes_highest)
+        except Exception as e:
+            traceback.print_exc()
+            for result, _ in queries:
+                result['error'] = repr(e)
+            return
+        self.__searches += len(nodes_user)
+
+        selected = {}  # results selected for the users of the group, keyed by their highest points and road nodes
+        for result, query in queries:
+            key = (tuple((p.x, p.y) for p in query['highest_points']),
+                   tuple(tuple(node.object for node in nodes) for nodes in query['nodes_highest']))
+            if key in selected:
+                result.update(selected[key], user=result['user'])
+                continue
+            path = self.__capture(result, lambda: shortest_path.select(nodes_user, query['highest_points'],
+                                                                       query['nodes_highest']))
+            if path is None:
+                continue
+            node_user, node_highest, highest_point, shortest_path_gpd = path
+            result.update({
+                'node_user': node_user.object,
+                'node_highest': node_highest.object,
+                'highest_point': [highest_point.x, highest_point.y],
+                'walking_time': float(shortest_path.get_walking_time()),
+                'path': [str(node) for node in shortest_path.get_path()],
+                'settled': shortest_path.get_settled(),
+                'route': [str(fid) for fid in shortest_path_gpd['fid']],
+                'geometry': mapping(MultiLineString(list(shortest_path_gpd['geometry'])))
+            })
+            selected[key] = result
+            if 'cache_key' in query:
+                self.__cache.put(self.__version, query['cache_key'], result)
+
+    # Run a step of the tasks for a user and return what it returns, or None after putting its error in the result.
+    # The tasks print a message and call exit() when there is no answer for the user, which is returned as the error.
+    # Any other exception is a failure of the router, returned as such with its traceback logged to stderr rather than
+    # hidden behind the last message of the tasks.
+    @staticmethod
+    def __capture(result, step):
+        messages = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(messages):
+                return step()
+        except SystemExit as e:
+            lines = [line for line in messages.getvalue().splitlines() if line.strip()]
+            result['error'] = lines[-1] if lines else repr(e)
+        except Exception as e:
+            traceback.print_exc()
+            result['error'] = repr(e)
+        return None
+
+    # Method to return the number of searches of the road graph run by this router, one from each road node a group
+    # of users starts from
+    def get_searches(self):
+        return self.__searches
+
+    # Release the DEM of this router, which stays open for the other holders of the process
+    def close(self):
+        if self.__dem is not None:
+            self.__dem.close()
+            self.__dem = None
+
+
+# Load the land boundary, the road network and the DEM once in each worker process, and configure its
+# instrumentation like that of the main process. The road closures of closures_path and the flood of water_level
+# apply to its queries, and their results are kept in a route cache of cache_size results (in the SQLite file
+# cache_path if it is given, shared by the workers) unless cache_size is 0.
+def init_worker(shape_path, road_path, elevation_path, closures_path=None, water_level=None, cache_size=0,
+                cache_path=None, instrumentation=None):
+    global _router
+    instruments.apply_config(instrumentation)
+    cache = RouteCache(cache_size, cache_path) if cache_size > 0 else None
+    _router = EvacuationRouter(shape_path, road_path, elevation_path, closures_file=closures_path,
+                               water_level=water_level, cache=cache)
+
+
+# Router of this worker process, created by init_worker
+def worker_router():
+    return _router
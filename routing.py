@@ -0,0 +1,414 @@
+import heapq
+import math
+
+import networkx as nx
+import numpy as np
+
+
+# Directed road graph stored as compressed sparse row (CSR) arrays: the edges leaving road node u are
+# indices[indptr[u]:indptr[u + 1]], with their walking times in weights and their road links in links.
+# Like DiGraph.add_edge, only the last road link between the same pair of road nodes is kept, and the edges leaving a
+# road node keep the order in which they were first added, so that ties are broken the same way as by networkx.
+# The walking times of the road links can be scaled in place (e.g. flooded roads), an edge whose walking time is
+# infinite is impassable and never followed by the searches.
+class CSRGraph:
+
+    def __init__(self, num_nodes, edge_from, edge_to, edge_weight, edge_link):
+        edge_from = np.asarray(edge_from, dtype=np.int64)
+        keys = edge_from * num_nodes + np.asarray(edge_to, dtype=np.int64)
+        # First and last occurrence of each pair of road nodes, in the order of their first occurrence
+        _, first = np.unique(keys, return_index=True)
+        _, last = np.unique(keys[::-1], return_index=True)
+        last = len(keys) - 1 - last
+        order = np.argsort(first)
+        first, last = first[order], last[order]
+        # Group the edges by the road node they start from
+        order = np.argsort(edge_from[first], kind='stable')
+        first, last = first[order], last[order]
+
+        counts = np.bincount(edge_from[first], minlength=num_nodes)
+        self.__num_nodes = num_nodes
+        self.__indptr = np.concatenate([[0], np.cumsum(counts)]).tolist()
+        self.__indices = np.asarray(edge_to)[first].tolist()
+        self.__weights = np.asarray(edge_weight)[last].tolist()
+        self.__links = np.asarray(edge_link)[last].tolist()
+        self.__base_weights = list(self.__weights)  # walking times before any scaling
+        self.__link_edges = None  # edges of each road link, built on first use
+        self.__reverse = None  # edges entering each road node, built on first use
+        self.__reverse_position = None  # position of each edge in the edges entering the road nodes
+        self.__settled = 0  # number of road nodes settled by the last search
+
+    # CSR graph of a NaismithGraph
+    @staticmethod
+    def from_naismith(naismith_graph):
+        return CSRGraph(len(naismith_graph.get_store().get_node_ids()), naismith_graph.get_edge_from(),
+                        naismith_graph.get_edge_to(), naismith_graph.get_edge_weight(), naismith_graph.get_edge_link())
+
+    # Method to return the number of road nodes
+    def get_num_nodes(self):
+        return self.__num_nodes
+
+    # Number of edges leaving road node u
+    def degree(self, u):
+        return self.__indptr[u + 1] - self.__indptr[u]
+
+    # Index of the edge from road node u to road node v, or -1 if there is no such edge
+    def edge(self, u, v):
+        for k in range(self.__indptr[u], self.__indptr[u + 1]):
+            if self.__indices[k] == v:
+                return k
+        return -1
+
+    # Road link of edge k
+    def edge_link(self, k):
+        return self.__links[k]
+
+    # Walking time of edge k
+    def edge_weight(self, k):
+        return self.__weights[k]
+
+    # Number of road nodes settled by the last search, to compare the work done by the search algorithms
+    def get_settled(self):
+        return self.__settled
+
+    # CSR arrays of the edges entering each road node: the road nodes the edges come from and their walking times
+    def __reverse_csr(self):
+        if self.__reverse is None:
+            indptr = np.asarray(self.__indptr)
+            edge_from = np.repeat(np.arange(self.__num_nodes), np.diff(indptr))
+            edge_to = np.asarray(self.__indices, dtype=np.int64)
+            order = np.argsort(edge_to, kind='stable')
+            counts = np.bincount(edge_to, minlength=self.__num_nodes)
+            self.__reverse = (np.concatenate([[0], np.cumsum(counts)]).tolist(), edge_from[order].tolist(),
+                              np.asarray(self.__weights)[order].tolist())
+            position = np.empty(len(order), dtype=np.int64)
+            position[order] = np.arange(len(order))
+            self.__reverse_position = position.tolist()
+        return self.__reverse
+
+    # Edges of a road link (at most one in each direction)
+    def link_edges(self, link):
+        if self.__link_edges is None:
+            link_edges = {}
+            for k, edge_link in enumerate(self.__links):
+                link_edges.setdefault(edge_link, []).append(k)
+            self.__link_edges = link_edges
+        return self.__link_edges.get(link, [])
+
+    # Scale the walking time of road links in place, e.g. {link: 2.0} for a road which takes twice as long to walk,
+    # {link: math.inf} for an impassable road and {link: 1.0} to restore it. Only the edges of these road links are
+    # changed, so it is quick enough to be repeated as flood extents change.
+    def scale_links(self, factors):
+        for link, factor in factors.items():
+            for k in self.link_edges(link):
+                weight = math.inf if math.isinf(factor) else self.__base_weights[k] * factor
+                self.__weights[k] = weight
+                if self.__reverse is not None:
+                    self.__reverse[2][self.__reverse_position[k]] = weight
+
+    # Walking time and path (list of road node indices) of every settled target, from the predecessors of a search
+    @staticmethod
+    def __paths(targets, dist, pred):
+        times, paths = {}, {}
+        for target in targets:
+            if target in dist:
+                times[target] = dist[target]
+                path = [target]
+                while pred[path[-1]] != -1:
+                    path.append(pred[path[-1]])
+                paths[target] = path[::-1]
+        return times, paths
+
+    # One-to-many Dijkstra from a source road node, with a binary heap over the road node indices.
+    # The search stops as soon as every target has been settled, and only the road nodes of node_mask are visited if
+    # it is given. The walking time and the path (list of road node indices) of every reached target are returned.
+    def dijkstra(self, source, targets, node_mask=None):
+        indptr, indices, weights = self.__indptr, self.__indices, self.__weights
+        remaining = set(targets)
+        dist = {}  # walking time of the settled road nodes
+        seen = {source: 0.0}  # best walking time found so far
+        pred = {source: -1}  # previous road node on the best path found so far
+        heap = [(0.0, 0, source)]
+        counter = 1
+        while heap and remaining:
+            d, _, u = heapq.heappop(heap)
+            if u in dist:
+                continue
+            dist[u] = d
+            remaining.discard(u)
+            for k in range(indptr[u], indptr[u + 1]):
+                v = indices[k]
+                if v in dist or (node_mask is not None and not node_mask[v]):
+                    continue
+                vd = d + weights[k]
+                if vd < seen.get(v, math.inf):
+                    seen[v] = vd
+                    pred[v] = u
+                    heapq.heappush(heap, (vd, counter, v))
+                    counter += 1
+        self.__settled = len(dist)
+        return self.__paths(targets, dist, pred)
+
+    # A* search from a source road node to a list of targets. heuristic(v) is a lower bound of the walking time from
+    # road node v to the nearest target which never decreases by more than the walking time of an edge (consistent),
+    # so that a road node is settled with its shortest walking time, as by dijkstra(), but the search is led towards
+    # the targets and settles fewer road nodes. It returns the same walking times and paths as dijkstra().
+    def astar(self, source, targets, heuristic, node_mask=None):
+        indptr, indices, weights = self.__indptr, self.__indices, self.__weights
+        remaining = set(targets)
+        dist = {}  # walking time of the settled road nodes
+        seen = {source: 0.0}  # best walking time found so far
+        pred = {source: -1}  # previous road node on the best path found so far
+        estimate = {source: heuristic(source)}  # heuristic of the road nodes reached so far
+        heap = [(estimate[source], 0, source)]
+        counter = 1
+        while heap and remaining:
+            _, _, u = heapq.heappop(heap)
+            if u in dist:
+                continue
+            d = seen[u]
+            dist[u] = d
+            remaining.discard(u)
+            for k in range(indptr[u], indptr[u + 1]):
+                v = indices[k]
+                if v in dist or (node_mask is not None and not node_mask[v]):
+                    continue
+                vd = d + weights[k]
+                if vd < seen.get(v, math.inf):
+                    seen[v] = vd
+                    pred[v] = u
+                    if v not in estimate:
+                        estimate[v] = heuristic(v)
+                    heapq.heappush(heap, (vd + estimate[v], counter, v))
+                    counter += 1
+        self.__settled = len(dist)
+        return self.__paths(targets, dist, pred)
+
+    # Bidirectional A* search between a source and a target road node: a forward search from the source and a backward
+    # search from the target over the edges entering each road node, which stop when they meet on the shortest path.
+    # heuristic(v) and reverse_heuristic(v) are consistent lower bounds of the walking time from v to the target and
+    # from the source to v. Both searches use their average as potential (forward (heuristic - reverse_heuristic) / 2
+    # and backward the opposite), so that they can stop as soon as the sum of their smallest keys reaches the walking
+    # time of the best path found. The walking time (inf if the target cannot be reached) and the path are returned,
+    # and the walking time is summed along the path from the source as by dijkstra().
+    def bidirectional_astar(self, source, target, heuristic, reverse_heuristic, node_mask=None):
+        if source == target:
+            self.__settled = 1
+            return 0.0, [source]
+        sides = ((self.__indptr, self.__indices, self.__weights), self.__reverse_csr())
+        potential = {}
+
+        # Forward potential of road node v, the backward potential is its opposite
+        def forward_potential(v):
+            if v not in potential:
+                potential[v] = (heuristic(v) - reverse_heuristic(v)) / 2
+            return potential[v]
+
+        dist = ({}, {})  # walking time of the road nodes settled by each search
+        seen = ({source: 0.0}, {target: 0.0})  # best walking time found so far by each search
+        pred = ({source: -1}, {target: -1})  # previous road node (next one for the backward search)
+        heaps = ([(forward_potential(source), 0, source)], [(-forward_potential(target), 0, target)])
+        counter = 1
+        best, meeting = float('inf'), -1  # walking time of the best path found so far and where the searches met
+        while heaps[0] and heaps[1] and heaps[0][0][0] + heaps[1][0][0] < best:
+            side = 0 if heaps[0][0][0] <= heaps[1][0][0] else 1
+            indptr, indices, weights = sides[side]
+            _, _, u = heapq.heappop(heaps[side])
+            if u in dist[side]:
+                continue
+            d = seen[side][u]
+            dist[side][u] = d
+            for k in range(indptr[u], indptr[u + 1]):
+                v = indices[k]
+                if v in dist[side] or (node_mask is not None and not node_mask[v]):
+                    continue
+                vd = d + weights[k]
+                if vd < seen[side].get(v, math.inf):
+                    seen[side][v] = vd
+                    pred[side][v] = u
+                    key = vd + forward_potential(v) if side == 0 else vd - forward_potential(v)
+                    heapq.heappush(heaps[side], (key, counter, v))
+                    counter += 1
+                    # A path from the source to the target through v
+                    if v in seen[1 - side] and vd + seen[1 - side][v] < best:
+                        best, meeting = vd + seen[1 - side][v], v
+        self.__settled = len(dist[0]) + len(dist[1])
+        if meeting < 0:
+            return float('inf'), []
+
+        path = [meeting]
+        while pred[0][path[-1]] != -1:
+            path.append(pred[0][path[-1]])
+        path.reverse()
+        while pred[1][path[-1]] != -1:
+            path.append(pred[1][path[-1]])
+        time = 0.0
+        for u, v in zip(path[:-1], path[1:]):
+            time += self.__weights[self.edge(u, v)]
+        return time, path
+
+    # Multi-source Dijkstra from a list of source road nodes, which settles every road node reachable from them.
+    # For each road node it returns the walking time from the nearest source, the previous road node and the edge on
+    # that path (-1 for the sources and the unreachable road nodes) and the position of the source in sources.
+    def multi_source_dijkstra(self, sources):
+        indptr, indices, weights = self.__indptr, self.__indices, self.__weights
+        dist = [float('inf')] * self.__num_nodes
+        pred = [-1] * self.__num_nodes
+        pred_edge = [-1] * self.__num_nodes
+        origin = [-1] * self.__num_nodes
+        settled = bytearray(self.__num_nodes)
+        heap = []
+        for i, source in enumerate(sources):
+            if origin[source] < 0:
+                dist[source] = 0.0
+                origin[source] = i
+                heap.append((0.0, len(heap), source))
+        counter = len(heap)
+        while heap:
+            d, _, u = heapq.heappop(heap)
+            if settled[u]:
+                continue
+            settled[u] = 1
+            for k in range(indptr[u], indptr[u + 1]):
+                v = indices[k]
+                vd = d + weights[k]
+                if not settled[v] and vd < dist[v]:
+                    dist[v] = vd
+                    pred[v] = u
+                    pred_edge[v] = k
+                    origin[v] = origin[u]
+                    heapq.heappush(heap, (vd, counter, v))
+                    counter += 1
+        return np.array(dist), np.array(pred), np.array(pred_edge), np.array(origin)
+
+
+# Routing backend using the Dijkstra algorithm of networkx on a DiGraph of road node feature ids, kept as the
+# reference implementation
+class NetworkXRouting:
+
+    def __init__(self, graph):
+        self.__graph = graph
+
+    # Check whether a road node is in the road graph
+    def has_node(self, node):
+        return self.__graph.has_node(node)
+
+    # Walking time and path (list of road node feature ids) from a source road node to every reachable target
+    def search(self, source, targets):
+        times, paths = {}, {}
+        for target in targets:
+            try:
+                times[target], paths[target] = nx.single_source_dijkstra(self.__graph, source, target,
+                                                                         weight='weight')
+            except (nx.exception.NodeNotFound, nx.exception.NetworkXNoPath):
+                continue
+        return times, paths
+
+    # networkx does not count the road nodes settled by its searches
+    def get_settled(self):
+        return None
+
+    # Edges of the road graph, edges[u, v]['fid'] is the feature id of the road link from u to v
+    @property
+    def edges(self):
+        return self.__graph.edges
+
+
+# Routing backend searching the CSR graph of the whole network, restricted to the road nodes within a polygon (e.g. the
+# 5km buffer around the user). The algorithm is one of CSR_ALGORITHMS:
+# 'dijkstra': one one-to-many Dijkstra, which finds every target at once
+# 'astar': one one-to-many A* search led by the lower bound of the walking time to the nearest target
+# 'bidirectional': one bidirectional A* search for each target
+# They all find the same shortest walking times, A* settling fewer road nodes.
+class CSRRouting:
+
+    def __init__(self, naismith_graph, polygon, algorithm='dijkstra'):
+        if algorithm not in CSR_ALGORITHMS:
+            raise ValueError('Unknown search algorithm ' + str(algorithm) + ', expected one of ' + str(CSR_ALGORITHMS))
+        self.__naismith_graph = naismith_graph
+        self.__store = naismith_graph.get_store()
+        self.__csr = naismith_graph.get_csr()
+        self.__node_mask = naismith_graph.node_mask(polygon)
+        self.__node_ids = self.__store.get_node_ids()
+        self.__algorithm = algorithm
+        self.__settled = 0  # number of road nodes settled by the searches of this backend
+
+    # Index of a road node, or -1 if it is not in the road graph, i.e. outside the polygon or without any road link
+    def __node_index(self, node):
+        try:
+            i = self.__store.node_index(node)
+        except KeyError:
+            return -1
+        return i if self.__node_mask[i] and self.__csr.degree(i) > 0 else -1
+
+    # Check whether a road node is in the road graph
+    def has_node(self, node):
+        return self.__node_index(node) >= 0
+
+    # Walking time and path (list of road node feature ids) from a source road node to every reachable target
+    def search(self, source, targets):
+        source_index = self.__node_index(source)
+        if source_index < 0:
+            return {}, {}
+        target_index = {self.__node_index(target): target for target in targets}
+        target_index.pop(-1, None)
+        if self.__algorithm == 'dijkstra':
+            times, paths = self.__csr.dijkstra(source_index, list(target_index), self.__node_mask)
+            self.__settled += self.__csr.get_settled()
+        elif self.__algorithm == 'astar':
+            bounds = [self.__naismith_graph.lower_bound(t) for t in target_index]
+            times, paths = self.__csr.astar(source_index, list(target_index),
+                                            lambda v: min(bound(v) for bound in bounds), self.__node_mask)
+            self.__settled += self.__csr.get_settled()
+        else:
+            times, paths = {}, {}
+            reverse_bound = self.__naismith_graph.lower_bound(source_index, reverse=True)
+            for t in target_index:
+                time, path = self.__csr.bidirectional_astar(source_index, t, self.__naismith_graph.lower_bound(t),
+                                                            reverse_bound, self.__node_mask)
+                self.__settled += self.__csr.get_settled()
+                if path:
+                    times[t], paths[t] = time, path
+        return ({target_index[t]: time for t, time in times.items()},
+                {target_index[t]: [str(self.__node_ids[u]) for u in path] for t, path in paths.items()})
+
+    # Number of road nodes settled by the searches of this backend
+    def get_settled(self):
+        return self.__settled
+
+    # Edges of the road graph, edges[u, v]['fid'] is the feature id of the road link from u to v
+    @property
+    def edges(self):
+        return CSREdges(self.__csr, self.__store)
+
+
+# Read-only view of the edges of a CSR graph, indexed by pairs of road node feature ids like DiGraph.edges
+class CSREdges:
+
+    def __init__(self, csr, store):
+        self.__csr = csr
+        self.__store = store
+
+    def __getitem__(self, edge):
+        k = self.__csr.edge(self.__store.node_index(edge[0]), self.__store.node_index(edge[1]))
+        if k < 0:
+            raise KeyError(edge)
+        return {'fid': str(self.__store.get_link_ids()[self.__csr.edge_link(k)]), 'weight': self.__csr.edge_weight(k)}
+
+
+# Search algorithms of the CSR routing backend
+CSR_ALGORITHMS = ('dijkstra', 'astar', 'bidirectional')
+
+# Available routing backends: 'csr' runs Dijkstra, 'astar' and 'bidirectional' run A* over the same CSR graph
+ROUTING_BACKENDS = ('csr', 'astar', 'bidirectional', 'networkx')
+
+
+# Create the routing backend of a query restricted to the road nodes within a polygon
+def routing_backend(backend, naismith_graph, polygon):
+    if backend == 'csr':
+        return CSRRouting(naismith_graph, polygon)
+    if backend in ('astar', 'bidirectional'):
+        return CSRRouting(naismith_graph, polygon, backend)
+    if backend == 'networkx':
+        return NetworkXRouting(naismith_graph.subgraph(polygon))
+    raise ValueError('Unknown routing backend ' + str(backend) + ', expected one of ' + str(ROUTING_BACKENDS))
@@ -0,0 +1,172 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+from instrumentation import add_arguments, configure_from_args, instruments
+from elevation import ElevationProvider
+from flood import FloodScenario
+from itn_store import ITNStore
+from router import elevation_file, init_worker, road_file, shape_file, worker_router
+
+
+# Answer one query in a worker process
+def route(easting, northing):
+    return worker_router().route(easting, northing)
+
+
+# Called once per worker at startup so that the data is loaded before the first query arrives
+def ping():
+    return os.getpid()
+
+
+# Local HTTP/JSON service answering evacuation queries against one loaded network.
+# GET /route?easting=...&northing=... or POST /route with {"easting": ..., "northing": ...} returns the highest point,
+# the route and the walking time, GET /stats returns the number of queries and their latency.
+# The routing is CPU-bound, so it runs on a pool of worker processes and slow queries do not block the event loop.
+# The road closures of closures_path (see closures.py) are read again by the workers whenever the file changes, and
+# with a water level the queries only reach the dry places connected to the user (see flood.py).
+class RoutingServer:
+
+    def __init__(self, host='127.0.0.1', port=8080, workers=None, shape_path=shape_file, road_path=road_file,
+                 elevation_path=elevation_file, closures_path=None, water_level=None, cache_size=1024, cache_path=None):
+        self.__host = host
+        self.__port = port
+        self.__workers = workers or os.cpu_count() or 1
+        self.__paths = (shape_path, road_path, elevation_path)
+        self.__closures_path = closures_path
+        self.__water_level = water_level
+        self.__cache = (cache_size, cache_path)  # size and SQLite file of the route cache of the workers
+        self.__pool = None
+        self.__latencies = []  # latency (ms) of every answered query
+
+    # Start the worker pool and serve until the process is stopped
+    async def serve_forever(self):
+        # Build the road network store once before the workers open it
+        ITNStore(self.__paths[1]).open()
+        # Compute the flooded area once before the workers read it
+        if self.__water_level is not None:
+            dem = ElevationProvider.open(self.__paths[2])
+            FloodScenario.load(dem, self.__water_level)
+            # The raster is closed before the workers are forked, so that they do not share its file
+            dem.close()
+        self.__pool = ProcessPoolExecutor(max_workers=self.__workers, initializer=init_worker,
+                                          initargs=self.__paths + (self.__closures_path, self.__water_level) +
+                                          self.__cache + (instruments.get_config(),))
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.gather(*[loop.run_in_executor(self.__pool, ping) for _ in range(self.__workers)])
+            server = await asyncio.start_server(self.handle, self.__host, self.__port)
+            print('Routing service listening on http://' + self.__host + ':' + str(self.__port) + ' with ' +
+                  str(self.__workers) + ' workers.\n')
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.__pool.shutdown(cancel_futures=True)
+
+    # Handle one HTTP connection
+    async def handle(self, reader, writer):
+        start = time.perf_counter()
+        method, target = '-', '-'
+        try:
+            method, target, body = await self.read_request(reader)
+            status, payload = await self.dispatch(method, target, body)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            writer.close()
+            return
+        except (ValueError, KeyError) as e:
+            status, payload = 400, {'error': 'Bad request: ' + str(e)}
+        except Exception as e:
+            status, payload = 500, {'error': repr(e)}
+
+        latency = (time.perf_counter() - start) * 1000
+        payload['latency_ms'] = round(latency, 3)
+        if target.startswith('/route'):
+            self.__latencies.append(latency)
+        print(method + ' ' + target + ' ' + str(status) + ' ' + str(round(latency, 1)) + ' ms')
+
+        body = json.dumps(payload).encode()
+        reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 422: 'Unprocessable Entity',
+                   500: 'Internal Server Error'}
+        writer.write(('HTTP/1.1 ' + str(status) + ' ' + reasons[status] + '\r\n'
+                      'Content-Type: application/json\r\n'
+                      'Content-Length: ' + str(len(body)) + '\r\n'
+                      'Connection: close\r\n\r\n').encode() + body)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    # Read the request line, the headers and the body of an HTTP request
+    @staticmethod
+    async def read_request(reader):
+        request_line = (await reader.readuntil(b'\r\n')).decode('latin-1').split()
+        if len(request_line) != 3:
+            raise ValueError('malformed request line')
+        headers = {}
+        while True:
+            line = (await reader.readuntil(b'\r\n')).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+        return request_line[0], request_line[1], body
+
+    # Answer a request
+    async def dispatch(self, method, target, body):
+        url = urlsplit(target)
+        if url.path == '/stats' and method == 'GET':
+            return 200, self.stats()
+        if url.path != '/route' or method not in ('GET', 'POST'):
+            return 404, {'error': 'Unknown endpoint ' + method + ' ' + url.path}
+
+        if method == 'POST':
+            query = json.loads(body or b'{}')
+        else:
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        easting, northing = float(query['easting']), float(query['northing'])
+
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(self.__pool, route, easting, northing)
+        return (422 if 'error' in result else 200), result
+
+    # Number of queries answered and their latency (ms)
+    def stats(self):
+        latencies = sorted(self.__latencies)
+        if not latencies:
+            return {'queries': 0}
+        return {
+            'queries': len(latencies),
+            'mean_ms': round(sum(latencies) / len(latencies), 3),
+            'p50_ms': round(latencies[len(latencies) // 2], 3),
+            'p95_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3),
+            'max_ms': round(latencies[-1], 3)
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evacuation routing service for the Isle of Wight.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: CPU count)')
+    parser.add_argument('--closures', help='JSON file of road closures, read again whenever it changes')
+    parser.add_argument('--water-level', type=float, help='water level (m) of the flood scenario')
+    parser.add_argument('--cache-size', type=int, default=1024, help='results kept in the route cache (0: no cache)')
+    parser.add_argument('--cache', help='SQLite file of a route cache shared by the workers (default: in memory)')
+    add_arguments(parser)
+    args = parser.parse_args()
+    configure_from_args(args)
+    try:
+        asyncio.run(RoutingServer(args.host, args.port, args.workers,
+                                  closures_path=args.closures, water_level=args.water_level,
+                                  cache_size=args.cache_size, cache_path=args.cache).serve_forever())
+    except KeyboardInterrupt:
+        print('\nRouting service stopped.')
+
+
+if __name__ == '__main__':
+    main()
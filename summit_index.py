@@ -0,0 +1,192 @@
+import heapq
+import json
+import os
+import sys
+
+import numpy as np
+from rasterio.windows import Window
+
+from elevation import ElevationProvider
+
+
+# Spatial index of the maxima of the elevation raster (DEM) for finding the highest point(s) within a circle.
+# Level 0 of the pyramid holds the maximum of each block of block_size x block_size cells, and each level above holds
+# the maximum of 2 x 2 blocks of the level below, up to a single block. A query searches the blocks from the highest
+# maximum down, skips the blocks whose maximum is below the best elevation found so far or which lie fully outside
+# the circle, takes the maximum of the blocks fully inside the circle directly, and only scans the cells of the
+# blocks crossing the circle at full resolution.
+# Like HighestPoint, a cell is within the circle if any part of it is, the circle is cut at the edge of the raster,
+# and every cell at the highest elevation is returned in row-major order.
+class SummitIndex:
+    # Version of the index file, it has to be increased whenever the arrays written by build() change
+    VERSION = 1
+
+    def __init__(self, dem, block_size=32):
+        self.__dem = dem  # ElevationProvider of the raster
+        self.__block_size = block_size
+        # The extension of the DEM is kept, so that SZ.asc and its conversions (e.g. SZ.npy) have their own index
+        self.__index_file = dem.get_elevation_file() + '.summits.npz'
+        self.__levels = []  # block maxima, from level 0 (blocks of cells) to the top of the pyramid
+        self.__argmax = None  # row and column of the highest cell of each block of level 0
+
+    # Load the index of a DEM from its file if it is up to date, otherwise build it
+    @staticmethod
+    def load(dem, block_size=32):
+        summit_index = SummitIndex(dem, block_size)
+        if summit_index.is_stale():
+            print('Building the summit index of the elevation raster...\n')
+            return summit_index.build()
+        return summit_index.read()
+
+    # Signature of the elevation file and of the block size, the index is rebuilt whenever it changes
+    def signature(self):
+        stat = os.stat(self.__dem.get_elevation_file())
+        return {'version': self.VERSION, 'block_size': self.__block_size, 'elevation': [stat.st_size, stat.st_mtime_ns]}
+
+    # Check whether the index file is missing or has been built from different data
+    def is_stale(self):
+        if not os.path.exists(self.__index_file):
+            return True
+        with np.load(self.__index_file) as cached:
+            return json.loads(str(cached['signature'])) != self.signature()
+
+    # Compute the pyramid of block maxima
+    def build(self):
+        signature = self.signature()
+        elevation = self.__dem.read().astype(np.float64)
+        # Error handling: the cells without data can never be the highest point
+        if self.__dem.get_nodata() is not None:
+            elevation[elevation == self.__dem.get_nodata()] = -np.inf
+
+        # Level 0: pad the raster with -inf to whole blocks and take the maximum and its location in each block
+        b = self.__block_size
+        height, width = elevation.shape
+        rows, cols = -(-height // b), -(-width // b)
+        padded = np.full((rows * b, cols * b), -np.inf)
+        padded[:height, :width] = elevation
+        blocks = padded.reshape(rows, b, cols, b).transpose(0, 2, 1, 3).reshape(rows, cols, b * b)
+        argmax = blocks.argmax(axis=2)
+        level = np.take_along_axis(blocks, argmax[..., np.newaxis], axis=2)[..., 0]
+        block_rows, block_cols = np.indices((rows, cols))
+        self.__argmax = np.stack([block_rows * b + argmax // b, block_cols * b + argmax % b])
+
+        # Levels above: maximum of 2 x 2 blocks
+        self.__levels = [level]
+        while level.shape != (1, 1):
+            rows, cols = -(-level.shape[0] // 2), -(-level.shape[1] // 2)
+            padded = np.full((rows * 2, cols * 2), -np.inf)
+            padded[:level.shape[0], :level.shape[1]] = level
+            level = padded.reshape(rows, 2, cols, 2).max(axis=(1, 3))
+            self.__levels.append(level)
+
+        arrays = {'level_' + str(k): level for k, level in enumerate(self.__levels)}
+        temp_file = self.__index_file + '.' + str(os.getpid()) + '.tmp.npz'
+        np.savez(temp_file, signature=np.array(json.dumps(signature)), argmax=self.__argmax, **arrays)
+        os.replace(temp_file, self.__index_file)
+        return self
+
+    # Read the pyramid from the index file
+    def read(self):
+        with np.load(self.__index_file) as cached:
+            self.__argmax = cached['argmax']
+            self.__levels = [cached['level_' + str(k)] for k in range(len(cached.files) - 2)]
+        return self
+
+    # Method to return the block maxima of a level of the pyramid
+    def get_level(self, k):
+        return self.__levels[k]
+
+    # Method to return the row and column of the highest cell of each block of level 0
+    def get_argmax(self):
+        return self.__argmax
+
+    # Cells (rows and columns) of block (i, j) of level k, cut at the edge of the raster
+    def __block_cells(self, k, i, j):
+        height, width = self.__dem.get_shape()
+        size = self.__block_size * 2 ** k
+        return i * size, min((i + 1) * size, height), j * size, min((j + 1) * size, width)
+
+    # Nearest and farthest distance from (x, y) to the area covered by the cells rows [r0, r1) and columns [c0, c1)
+    def __distances(self, x, y, r0, r1, c0, c1):
+        transform = self.__dem.get_transform()
+        x0, y0 = transform * (c0, r0)
+        x1, y1 = transform * (c1, r1)
+        x0, x1 = min(x0, x1), max(x0, x1)
+        y0, y1 = min(y0, y1), max(y0, y1)
+        near = np.hypot(max(x0 - x, 0, x - x1), max(y0 - y, 0, y - y1))
+        far = np.hypot(max(abs(x - x0), abs(x - x1)), max(abs(y - y0), abs(y - y1)))
+        return near, far
+
+    # Highest elevation of the cells of a block within the circle, and the rows and columns of the cells at that
+    # elevation, read from the raster at full resolution
+    def __scan(self, r0, r1, c0, c1, x, y, radius):
+        window = Window(c0, r0, c1 - c0, r1 - r0)
+        array, transform = self.__dem.read_window(window)
+        array = array.astype(np.float64)
+        if self.__dem.get_nodata() is not None:
+            array[array == self.__dem.get_nodata()] = -np.inf
+        array[~ElevationProvider.circle_mask(transform, array.shape, x, y, radius)] = -np.inf
+        highest = array.max()
+        rows, cols = np.nonzero(array == highest)
+        return highest, rows + window.row_off, cols + window.col_off
+
+    # Highest elevation within a circle, and the rows and columns of every cell at that elevation in row-major order.
+    # The elevation is -inf and no cell is returned if the circle does not cover any cell with data.
+    def query(self, x, y, radius):
+        top = len(self.__levels) - 1
+        best = -np.inf
+
+        # First pass: find the highest elevation, searching the blocks from the highest maximum down
+        heap = [(-self.__levels[top][0, 0], top, 0, 0)]
+        while heap:
+            negative_max, k, i, j = heapq.heappop(heap)
+            if -negative_max <= best:
+                break
+            r0, r1, c0, c1 = self.__block_cells(k, i, j)
+            near, far = self.__distances(x, y, r0, r1, c0, c1)
+            if near > radius:
+                continue
+            if far <= radius:
+                # The whole block is within the circle, so its maximum is within the circle
+                best = -negative_max
+            elif k > 0:
+                level = self.__levels[k - 1]
+                for ci in (2 * i, 2 * i + 1):
+                    for cj in (2 * j, 2 * j + 1):
+                        if ci < level.shape[0] and cj < level.shape[1] and level[ci, cj] > best:
+                            heapq.heappush(heap, (-level[ci, cj], k - 1, ci, cj))
+            else:
+                best = max(best, self.__scan(r0, r1, c0, c1, x, y, radius)[0])
+
+        if best == -np.inf:
+            return best, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        # Second pass: collect every cell at the highest elevation from the blocks of level 0 which reach it
+        rows, cols = [], []
+        stack = [(top, 0, 0)]
+        while stack:
+            k, i, j = stack.pop()
+            level = self.__levels[k]
+            if i >= level.shape[0] or j >= level.shape[1] or level[i, j] < best:
+                continue
+            r0, r1, c0, c1 = self.__block_cells(k, i, j)
+            if self.__distances(x, y, r0, r1, c0, c1)[0] > radius:
+                continue
+            if k > 0:
+                stack.extend((k - 1, ci, cj) for ci in (2 * i, 2 * i + 1) for cj in (2 * j, 2 * j + 1))
+                continue
+            highest, block_rows, block_cols = self.__scan(r0, r1, c0, c1, x, y, radius)
+            if highest == best:
+                rows.append(block_rows)
+                cols.append(block_cols)
+
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        order = np.lexsort((cols, rows))
+        return best, rows[order], cols[order]
+
+
+# Build the summit index of a DEM once, e.g. python summit_index.py Material/elevation/SZ.asc
+if __name__ == '__main__':
+    elevation_file = sys.argv[1] if len(sys.argv) > 1 else 'Material/elevation/SZ.asc'
+    SummitIndex(ElevationProvider.open(elevation_file)).build()
+    print('Summit index of ' + elevation_file + ' built.')
@@ -1,6 +1,7 @@
-import geopandas as gpd
 from shapely.geometry import Point
 
+from land_check import LandBoundary
+
 
 # Test whether location that is inputted is in the raster box and within the boundary of the Isle of Wight.
 class CoordinateInput:
@@ -12,17 +13,17 @@ class CoordinateInput:
     def user_input(self):
         # First, check if the entered location is within the boundary of the elevation raster
         position = self.prompt()
-        isle_of_wight = gpd.read_file(self.__shape_file)
-        # Error handling by changing CRS to the British National Grid
-        isle_of_wight.to_crs(27700)
+        # The boundary of the Isle of Wight is loaded once (in the British National Grid) and shared with the other
+        # entry points
+        isle_of_wight = LandBoundary.open(self.__shape_file)
         # Error handling by checking if the position is located within the boundary of the Isle of Wight
-        while not position.within(isle_of_wight['geometry']).any():
+        while not isle_of_wight.contains(position):
             print('The position is not on the land of Isle of Wight. Please try again.')
             print()
             position = self.prompt()
 
         # Test output for isle_of_wight
-        # for geo in isle_of_wight['geometry']:
+        # for geo in isle_of_wight.get_geometries():
         #     print(geo)
 
         print('\nEntered successfully! Your current position is: (Easting ' + str(position.x) + ', Northing ' + str(
@@ -1,52 +1,53 @@
-import os
-
 import numpy as np
 import rasterio
-from geopandas import GeoSeries
-from rasterio import mask
 from shapely.geometry import Point
 from shapely.geometry import Polygon
 
+from elevation import ElevationProvider
+from instrumentation import instruments
+
 
 # Define Class for Task 2 and Task 6 (i.e. Highest Point Identification and Extend the Region)
 class HighestPoint:
-    def __init__(self, user_location):
+    def __init__(self, user_location, dem=None, summits=None, flood=None):
         # Attribute for receiving the User Location
         self.__user_location = user_location
+        # ElevationProvider shared by several queries. If it is not given, SZ.asc is opened for this HighestPoint,
+        # which releases it in close()
+        self.__own_dem = dem is None
+        self.__dem = dem if dem is not None else ElevationProvider.open('Material/elevation/SZ.asc')
+        # Optional SummitIndex of the DEM, which finds the highest points without reading the whole buffer
+        self.__summits = summits
+        # Optional FloodScenario of a water level, only the dry cells connected to the User Location can be reached
+        self.__flood = flood
         self.__buffer = []
         self.__out_transform = []
+        self.__raster = None
 
     # Method for searching the highest point
     def get_highest_point(self):
+        with instruments.stage('highest_point'):
+            return self.__find_highest_point()
+
+    def __find_highest_point(self):
         # Creating a 5 km buffer from the User Location
         self.__buffer = Polygon(self.__user_location.buffer(5000))
-        # Creating a GeoSeries to store the buffer polygon
-        g = GeoSeries([self.__buffer])
-
-        # Read and mask the raster DEM file (i.e. SZ.asc)
-        with rasterio.open('Material/elevation/SZ.asc') as src:
-            # rasterio.mask.mask allows us to mask out the region beyond 5km from the User Location even at the zone
-            # within 5km from the raster's edge. (Reference:https://www.youtube.com/watch?v=TbbL2yeRTsk) It makes
-            # masking at location within 5km from the raster's edge feasible.  It is regarded as the solution to
-            # overcome the limitation stated in Task 6.
-            raster, self.__out_transform = rasterio.mask.mask(src, g, all_touched=True, filled=True,
-                                                                         invert=False, crop=True)
-            out_meta = src.meta
-
-        # Read update the metadata of the masked raster
-        out_meta.update({
-            'height': raster.shape[1],
-            'width': raster.shape[2],
-            'transform': self.__out_transform
-        })
-
-        # Write the masked raster to a new file (i.e. Masked_SZ.asc)
-        with rasterio.open('Material/elevation/Masked_SZ.asc', 'w', **out_meta) as dst:
-            dst.write(raster)
-
-        # Open and plot the new raster
-        # masked_dataset = rasterio.open(os.path.join('Material', 'elevation', 'Masked_SZ.asc'))
-        # rasterio.plot.show(masked_dataset, cmap='terrain')
+
+        if self.__flood is not None:
+            return self.__get_highest_point_flooded()
+        if self.__summits is not None:
+            return self.__get_highest_point_indexed()
+
+        # Read only the 10 km window around the User Location from the DEM (i.e. SZ.asc) and mask out the cells beyond
+        # 5km in memory. The window is cut at the raster's edge, which makes masking at location within 5km from the
+        # raster's edge feasible. It is regarded as the solution to overcome the limitation stated in Task 6.
+        raster, self.__out_transform, _ = self.__dem.read_circle(self.__user_location.x, self.__user_location.y, 5000)
+        self.__raster = raster
+
+        # Error handling to stop the program when the 5 km buffer is beyond the raster
+        if raster.size == 0:
+            print("Error! The 5000 m buffer zone is beyond the elevation raster!!!")
+            exit()
 
         # Error handling to stop the program when the elevation of the whole 5k m buffer are smaller than or equal to
         # zero
@@ -56,38 +57,93 @@ class HighestPoint:
         else:
             # search the masked area to find out the highest points
             result = np.where(raster == raster.max())
-            high_points = []
-
-            # Extract the highest points' X and Y image coordinates
-            highest_points_y = result[1]
-            highest_points_x = result[2]
-
-            for i, item in enumerate(highest_points_y):
-                # Convert the highest points' X and Y image coordinates to ground coordinates
-                tran_xy = (self.__out_transform * (highest_points_x[i], highest_points_y[i]))
-                # Add or subtract half size of a pixel (i.e. 2.5m) to find out the center of the highest points
-                tran_xy_center = (tran_xy[0] + 2.5, tran_xy[1] - 2.5)
-                # Create Shapely Point features for the highest points
-                hp_i = Point(tran_xy_center)
-                high_points.append(hp_i)
-
-            if len(high_points) == 1:
-                print('One highest location found: (Easting ' + str(high_points[0].x) + ', Northing ' + str(
-                    high_points[0].y) + ').\n')
-            else:
-                print(str(len(high_points)) + ' highest locations found:')
-                for i in range(len(high_points)):
-                    print('\t', i + 1,
-                          '(Easting ' + str(high_points[i].x) + ', Northing ' + str(high_points[i].y) + ')\t')
-                print()
-
-            # return the Shapely Point features storing the highest points
-            return high_points
+            return self.__to_points(result[0], result[1])
+
+    # Search the highest points with the summit index, which only scans the cells of the blocks crossing the buffer
+    def __get_highest_point_indexed(self):
+        x, y = self.__user_location.x, self.__user_location.y
+        window = self.__dem.window(x - 5000, y - 5000, x + 5000, y + 5000)
+        # Error handling to stop the program when the 5 km buffer is beyond the raster
+        if window is None:
+            print("Error! The 5000 m buffer zone is beyond the elevation raster!!!")
+            exit()
+        self.__out_transform = rasterio.windows.transform(window, self.__dem.get_transform())
+
+        highest, rows, cols = self.__summits.query(x, y, 5000)
+        # Error handling to stop the program when the elevation of the whole 5k m buffer are smaller than or equal to
+        # zero
+        if highest <= 0:
+            print("Error! The whole 5000 m buffer zone are below waterline!!!")
+            exit()
+        # Image coordinates of the highest points within the window of the buffer
+        return self.__to_points(rows - window.row_off, cols - window.col_off)
+
+    # Search the highest points among the dry cells of the buffer which are in the same dry region as the User Location,
+    # i.e. which can be reached without crossing the flooded area
+    def __get_highest_point_flooded(self):
+        x, y = self.__user_location.x, self.__user_location.y
+        raster, self.__out_transform, circle = self.__dem.read_circle(x, y, 5000)
+        self.__raster = raster
+
+        # Error handling to stop the program when the 5 km buffer is beyond the raster
+        if raster.size == 0:
+            print("Error! The 5000 m buffer zone is beyond the elevation raster!!!")
+            exit()
+
+        # Error handling to stop the program when the User Location is already under water
+        region = self.__flood.region_at(x, y)
+        if region == 0:
+            print("Error! The user location is under water at a water level of " +
+                  format(self.__flood.get_water_level(), 'g') + " m!!!")
+            exit()
+
+        labels = self.__flood.read_window(self.__dem.window(x - 5000, y - 5000, x + 5000, y + 5000))
+        reachable = np.where(circle & (labels == region), raster.astype(np.float64), -np.inf)
+        result = np.where(reachable == reachable.max())
+        return self.__to_points(result[0], result[1])
+
+    # Convert the image coordinates of the highest points within the masked raster to Shapely Point features
+    def __to_points(self, highest_points_y, highest_points_x):
+        high_points = []
+        for i, item in enumerate(highest_points_y):
+            # Convert the highest points' X and Y image coordinates to ground coordinates
+            tran_xy = (self.__out_transform * (highest_points_x[i], highest_points_y[i]))
+            # Add or subtract half size of a pixel (i.e. 2.5m) to find out the center of the highest points
+            tran_xy_center = (tran_xy[0] + 2.5, tran_xy[1] - 2.5)
+            # Create Shapely Point features for the highest points
+            hp_i = Point(tran_xy_center)
+            high_points.append(hp_i)
+
+        if len(high_points) == 1:
+            print('One highest location found: (Easting ' + str(high_points[0].x) + ', Northing ' + str(
+                high_points[0].y) + ').\n')
+        else:
+            print(str(len(high_points)) + ' highest locations found:')
+            for i in range(len(high_points)):
+                print('\t', i + 1,
+                      '(Easting ' + str(high_points[i].x) + ', Northing ' + str(high_points[i].y) + ')\t')
+            print()
+
+        # return the Shapely Point features storing the highest points
+        return high_points
 
     # Method to return the transformation parameters of the masked raster
     def get_5k_transform(self):
         return self.__out_transform
 
+    # Method to return the masked raster of the 5km buffer, which is kept in memory (read on demand when the highest
+    # points have been found with the summit index)
+    def get_5k_raster(self):
+        if self.__raster is None:
+            self.__raster = self.__dem.read_circle(self.__user_location.x, self.__user_location.y, 5000)[0]
+        return self.__raster
+
     # Method to return the 5km buffer
     def get_buffer(self):
         return self.__buffer
+
+    # Release the DEM if it was opened by this HighestPoint
+    def close(self):
+        if self.__own_dem and self.__dem is not None:
+            self.__dem.close()
+            self.__dem = None
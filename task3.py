@@ -1,46 +1,76 @@
-from rtree import index
-from shapely.geometry import Point
-import json
+from collections import namedtuple
+
+import numpy as np
+import shapely
+
+from instrumentation import instruments
+from itn_store import ITNStore
+from node_index import NodeIndex
+
+# Road node found by nearest_node: id is the index of the road node in the store and object its feature id
+RoadNode = namedtuple('RoadNode', ['id', 'object'])
 
 
 class ITN:
 
-    def __init__(self, itn_path, buffer):
+    def __init__(self, itn_path, buffer, store=None):
         self.__buffer = buffer  # 5km buffer around the user location
+        self.__store = store  # opened ITNStore shared by several queries
         self.__idx = self.r_tree(itn_path)  # r-tree storing road nodes
+        self.__nodes = None  # road nodes within the 5km buffer
+        self.__coords = None
 
-    # Init road nodes and store them in an r-tree
+    # Open the r-tree of all the road nodes, which is bulk loaded once from the binary store of the ITN and kept on
+    # disk, so that it is not rebuilt for every user
     def r_tree(self, itn_path):
-        with open(itn_path, 'r') as f:
-            ITN = json.load(f)
-        idx = index.Index()
-        road_nodes_idx = ITN['roadnodes']
-        road_nodes = []
-        id_node = 0
-        for node in road_nodes_idx:
-            point = Point(road_nodes_idx[node]['coords'])
-            if point.within(self.__buffer) or point.touches(self.__buffer):
-                # Test for output
-                # print(road_nodes_idx[node]['coords'])
-                road_nodes.append(road_nodes_idx[node]['coords'])
-                idx.insert(id_node, (point.x, point.y), obj=node)
-                id_node += 1
-        return idx
-
-    # Find the nearest nodes for a given location
-    def nearest_node(self, location):
+        with instruments.stage('r_tree'):
+            if self.__store is None:
+                self.__store = ITNStore(itn_path).open()
+            return NodeIndex.open(self.__store)
+
+    # Road nodes within (or on the boundary of) the 5km buffer, found from the r-tree at lookup time and kept for the
+    # next lookups of the same user
+    def __in_buffer(self):
+        if self.__nodes is None:
+            nodes = self.__idx.intersection(*self.__buffer.bounds)
+            coords = np.asarray(self.__store.get_node_coords())[nodes]
+            self.__nodes = nodes[shapely.intersects_xy(self.__buffer, coords[:, 0], coords[:, 1])]
+            self.__coords = np.asarray(self.__store.get_node_coords())[self.__nodes]
+            instruments.count('nodes_in_buffer', len(self.__nodes))
+        return self.__nodes, self.__coords
+
+    # Road nodes within the 5km buffer (indices in the store), which the road graph of the query is restricted to
+    def get_nodes_in_buffer(self):
+        return self.__in_buffer()[0]
+
+    # Find the nearest nodes for a given location, or its k nearest nodes. Like rtree, the nodes at the same distance
+    # as the k-th nearest one are all returned.
+    def nearest_node(self, location, k=1):
+        nodes, coords = self.__in_buffer()
         # Error handling by using a list for potential multiple nearest nodes.
-        nodes = list(self.__idx.nearest((location.x, location.y), 1, objects=True))
+        if len(nodes) > 0:
+            distance = np.hypot(coords[:, 0] - location.x, coords[:, 1] - location.y)
+            nodes = nodes[distance <= np.partition(distance, min(k, len(nodes)) - 1)[min(k, len(nodes)) - 1]]
         # Error handling by checking if there is node found
         if len(nodes) == 0:
             print('Sorry, no ITN node found within 5km!')
             exit()
+        node_ids = self.__store.get_node_ids()
         # Test the return of this function
         # print("Nodes: ")
         # for node in nodes:
-        #     print(node.id)
-        #     print(node.object)
-
-        return nodes
+        #     print(node)
+        #     print(node_ids[node])
 
+        return [RoadNode(int(node), str(node_ids[node])) for node in nodes]
 
+    # Find the nearest node for each location of a list of locations at once. Among nodes at the same distance the
+    # first one is taken, and None is returned if there is no node within the 5km buffer.
+    def nearest_nodes(self, locations):
+        nodes, coords = self.__in_buffer()
+        if len(nodes) == 0:
+            return [None] * len(locations)
+        xy = np.array([(location.x, location.y) for location in locations], dtype=np.float64).reshape(-1, 2)
+        distance = np.hypot(xy[:, 0, np.newaxis] - coords[:, 0], xy[:, 1, np.newaxis] - coords[:, 1])
+        node_ids = self.__store.get_node_ids()
+        return [RoadNode(int(nodes[i]), str(node_ids[nodes[i]])) for i in distance.argmin(axis=1)]
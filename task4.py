@@ -1,20 +1,33 @@
-import json
-
 import geopandas as gpd
-import networkx as nx
-import rasterio
 from shapely.geometry import LineString
 
+from instrumentation import instruments
+from itn_store import ITNStore
+from naismith_graph import NaismithGraph
+from routing import routing_backend
+
 
 class ShortestPath:
 
-    def __init__(self, road_file, itn, transform, buffer):
-        with open(road_file, 'r') as f:
-            solent_itn = json.load(f)
-        self.__road_links = solent_itn['roadlinks']  # init road links and
+    # backend is the routing engine: 'csr' (Dijkstra over compressed sparse row arrays), 'astar' or 'bidirectional'
+    # (A* over the same arrays) or 'networkx' (the reference implementation)
+    def __init__(self, road_file, itn, transform, buffer, store=None, backend='csr'):
+        # init road links from the binary store of the ITN, which is built first if it does not exist yet
+        if store is None:
+            store = ITNStore(road_file).open()
+        self.__store = store
+        self.__road_links = store.get_road_links()
         self.__itn = itn  # it finds the nearest nodes
+        # The road graph samples the elevation with the transform of the whole elevation raster, so the transform of
+        # the masked raster is only kept for compatibility
         self.__transform = transform
         self.__buffer = buffer  # 5km buffer around the user
+        self.__backend = backend
+        self.__walking_time = float('inf')  # walking time (s) of the shortest path
+        self.__settled = None  # number of road nodes settled by the searches
+        self.__path = []  # road nodes of the shortest path
+        self.__graph = None  # road graph of the buffer the searches were run on
+        self.__searches = []  # walking times and paths found from each node nearest to the user
 
     # Find the shortest path between the location of the user and the highest points(s) using Dijkstra Algorithm,
     # which means finding the path consuming the least time.
@@ -22,118 +35,103 @@ class ShortestPath:
     def shortest_path(self, elevation_file, user_location, highest_points):
         # find the nearest ITN nodes to the user's location
         print("Finding the nearest ITN nodes to your location...\n")
-        nodes_user = self.__itn.nearest_node(user_location)
-
-        # init elevation np array
-        elevation_f = rasterio.open(elevation_file)
-        elevation = elevation_f.read(1)
-
-        # init a directed road graph and the weight for each road link is the walking time calculated by Naismith’s rule
-        graph = nx.DiGraph()  # directed road graph
-        for link in self.__road_links:
-            road_length = self.__road_links[link]['length']
-
-            # coordinates for the start and end node of the road link
-            coord_start = self.__road_links[link]['coords'][0]
-            coord_end = self.__road_links[link]['coords'][-1]
-
-            # if the road is not within the buffer and touches the buffer, don't add this road into the graph
-            road_line = LineString(self.__road_links[link]['coords'])
-            if (not road_line.within(self.__buffer)) and (not road_line.touches(self.__buffer)):
-                continue
-
-            # raster location of the coordinates
-            raster_start = rasterio.transform.rowcol(self.__transform, coord_start[0], coord_start[1])
-            raster_end = rasterio.transform.rowcol(self.__transform, coord_end[0], coord_end[1])
-
-            # elevation of the coordinates
-            elevation_start = elevation[raster_start[0]][raster_start[1]]
-            elevation_end = elevation[raster_end[0]][raster_end[1]]
-
-            # total walking time = road_length(m) / speed(m/s) + climbing elevation(m) * (60s/10m))
-            total_walking_time_normal = road_length / (5000 / 3600)
-            total_walking_time_climb = road_length / (5000 / 3600) + abs(elevation_end - elevation_start) * (60 / 10)
-            if elevation_start < elevation_end:
-                # there is a climbing from start to end
-                graph.add_edge(self.__road_links[link]['start'], self.__road_links[link]['end'], fid=link,
-                               weight=total_walking_time_climb)
-                graph.add_edge(self.__road_links[link]['end'], self.__road_links[link]['start'], fid=link,
-                               weight=total_walking_time_normal)
-            elif elevation_start > elevation_end:
-                # there is a climbing from end to start
-                graph.add_edge(self.__road_links[link]['end'], self.__road_links[link]['start'], fid=link,
-                               weight=total_walking_time_climb)
-                graph.add_edge(self.__road_links[link]['start'], self.__road_links[link]['end'], fid=link,
-                               weight=total_walking_time_normal)
-            else:
-                # add same weight to both direction
-                graph.add_edge(self.__road_links[link]['start'], self.__road_links[link]['end'], fid=link,
-                               weight=total_walking_time_normal)
-                graph.add_edge(self.__road_links[link]['end'], self.__road_links[link]['start'], fid=link,
-                               weight=total_walking_time_normal)
-
-        # Find the most feasible path between nodes nearest to the user and nodes to the highest point(s)
+        with instruments.stage('nearest_node'):
+            nodes_user = self.__itn.nearest_node(user_location)
+
+        # find the nearest ITN nodes to each highest point
+        nodes_high_all = self.nearest_nodes_highest(highest_points)
+
+        self.search(elevation_file, nodes_user, nodes_high_all)
+        return self.select(nodes_user, highest_points, nodes_high_all)
+
+    # Find the nearest ITN nodes to each highest point
+    def nearest_nodes_highest(self, highest_points):
+        nodes_high_all = []
+        with instruments.stage('nearest_node_highest'):
+            for high_point in highest_points:
+                print("Finding nearest ITN nodes to highest point...\n")
+                nodes_high_all.append(self.__itn.nearest_node(high_point))
+        return nodes_high_all
+
+    # One search from each node nearest to the user finds the walking time and the path to the nodes of a list of
+    # lists of nodes (e.g. those nearest to each highest point) at once. The nodes of several users starting from the
+    # same nodes can be searched together, and the path of each of them is then selected by select().
+    def search(self, elevation_file, nodes_user, nodes_high_all):
+        # The directed road graph of the whole network, where the weight for each road link is the walking time
+        # calculated by Naismith’s rule, is built once and cached. Only the road nodes within the buffer are kept.
+        with instruments.stage('graph'):
+            self.__graph = routing_backend(self.__backend, NaismithGraph.load(self.__store, elevation_file),
+                                           self.__buffer)
+
         print("Finding shortest path...\n")
+        targets = list(dict.fromkeys(node.object for nodes_high in nodes_high_all for node in nodes_high))
+        with instruments.stage('search'):
+            self.__searches = [self.__graph.search(start.object, targets) for start in nodes_user]
+        self.__settled = self.__graph.get_settled()
+        instruments.count('searches', len(nodes_user))
+        if self.__settled is not None:
+            instruments.count('settled', self.__settled)
+
+    # Find the most feasible path between nodes nearest to the user and nodes to the highest point(s) among the paths
+    # found by search()
+    def select(self, nodes_user, highest_points, nodes_high_all):
+        graph = self.__graph
         shortest_path = []
         shortest_path_time = float('inf')  # time-consuming for the shortest path
         nodes_user_index = 0  # index of node nearest to the user
         nodes_high_index = 0  # index of node nearest to the highest point
         high_point_index = 0  # index of the highest point
-        for h_i, high_point in enumerate(highest_points):
-            print("Finding nearest ITN nodes to highest point...\n")
-            nodes_high = self.__itn.nearest_node(high_point)
-            if len(nodes_high) == 1 and len(nodes_user) == 1:
-                # only one node nearest to the user and only one node nearest to the highest point
-                try:
-                    shortest_path_time_temp = nx.dijkstra_path_length(graph, source=nodes_user[0].object,
-                                                                      target=nodes_high[0].object, weight='weight')
-                    if shortest_path_time_temp < shortest_path_time:
-                        shortest_path_time = shortest_path_time_temp
-                        shortest_path = nx.dijkstra_path(graph, source=nodes_user[0].object,
-                                                         target=nodes_high[0].object, weight='weight')
-                        nodes_user_index = 0
-                        nodes_high_index = 0
+        for h_i, nodes_high in enumerate(nodes_high_all):
+            # there might be more than one node nearest to the user and more than one node nearest to the highest point
+            for i, start in enumerate(nodes_user):
+                times, paths = self.__searches[i]
+                for j, end in enumerate(nodes_high):
+                    if not graph.has_node(start.object) or not graph.has_node(end.object):
+                        print('Road node ', start.object, 'or', end.object, 'does not exist in the road graph!\n')
+                    elif end.object not in times:
+                        print('No path exist between', start.object, 'and', end.object, '!\n')
+                    elif times[end.object] < shortest_path_time:
+                        shortest_path_time = times[end.object]
+                        shortest_path = paths[end.object]
+                        nodes_user_index = i
+                        nodes_high_index = j
                         high_point_index = h_i
-                except nx.exception.NodeNotFound:
-                    print('Road node ', nodes_user[0].object, 'or', nodes_high[0].object,
-                          'does not exist in the road graph!\n')
-                except nx.exception.NetworkXNoPath:
-                    print('No path exist between', nodes_user[0].object, 'and', nodes_high[0].object, '!\n')
-
-            else:
-                # more than one node nearest to the user and more than one node nearest to the highest point
-                try:
-                    for i, start in nodes_user[0:]:
-                        for j, end in nodes_high[0:]:
-                            shortest_path_time_temp = nx.dijkstra_path_length(graph, source=start.object,
-                                                                              target=end.object, weight='weight')
-                            if shortest_path_time_temp < shortest_path_time:
-                                shortest_path_time = shortest_path_time_temp
-                                shortest_path = nx.dijkstra_path(graph, source=start.object, target=end.object,
-                                                                 weight='weight')
-                                nodes_user_index = i
-                                nodes_high_index = j
-                                high_point_index = h_i
-                except nx.exception.NodeNotFound:
-                    print('Road node ', nodes_user[0].object, 'or', nodes_high[0].object,
-                          'does not exist in the road graph!\n')
-                except nx.exception.NetworkXNoPath:
-                    print('No path exist between', nodes_user[0].object, 'and', nodes_high[0].object, '!\n')
+
+        # Error handling to stop the program when no highest point can be reached from the user's location
+        if not shortest_path:
+            print('Sorry, no path found to the highest point(s) within 5km!')
+            exit()
 
         # final nodes in the path
         node_user = nodes_user[nodes_user_index]  # nearest node to the user
         highest_point = highest_points[high_point_index]  # the highest point
-        nodes_high = self.__itn.nearest_node(highest_point)
-        node_highest = nodes_high[nodes_high_index]  # nearest node to the highest point
+        node_highest = nodes_high_all[high_point_index][nodes_high_index]  # nearest node to the highest point
+
+        self.__walking_time = shortest_path_time
+        self.__path = shortest_path
 
         # give msg reminding user that shortest path has been found
         print('Shortest path found! Please have a look at the map.')
         # give msg telling the user how long it will take to get to a safe place
         print('Time consumed by walking to the highest point would be ' + str(round(shortest_path_time/60.0, 2)) + ' mins approximately.\n')
 
-        return node_user, node_highest, highest_point, self.add_geometry(shortest_path, graph)
+        with instruments.stage('add_geometry'):
+            shortest_path_gpd = self.add_geometry(shortest_path, graph)
+        return node_user, node_highest, highest_point, shortest_path_gpd
+
+    # Method to return the walking time (s) of the shortest path
+    def get_walking_time(self):
+        return self.__walking_time
+
+    # Method to return the road nodes (feature ids) of the shortest path
+    def get_path(self):
+        return self.__path
+
+    # Method to return the number of road nodes settled by the searches, None if the backend does not count them
+    def get_settled(self):
+        return self.__settled
 
-    # Associate road feature id with geometry
+    # Associate road feature id with geometry, graph is the road graph or routing backend the path was found in
     def add_geometry(self, shortest_path, graph):
         links = []  # this list will be used to populate the feature id (fid) column
         geom = []  # this list will be used to populate the geometry column
@@ -1,41 +1,43 @@
-import geopandas as gpd
 import matplotlib.pyplot as plt
 import numpy as np
-import rasterio
+from matplotlib import cm, colors
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 from mpl_toolkits.axes_grid1.anchored_artists import AnchoredSizeBar
-from pyproj import CRS
+from affine import Affine
 from rasterio import plot as raster_plot
-from rasterio.mask import mask
-from shapely.geometry import Point, Polygon
 
-CRS_BNG = CRS('epsg:27700')
-
-# Materials
-isle_of_wight = gpd.read_file('Material/shape/isle_of_wight.shp')
-road_links = gpd.read_file('Material/roads/links.shp')
-road_nodes = gpd.read_file('Material/roads/nodes.shp')
-background = rasterio.open('Material/background/raster-50k_2724246.tif')
-elevation = rasterio.open('Material/elevation/SZ.asc')
+from instrumentation import instruments
+from map_layers import MapLayers
 
 
 class Plotting:
+    # Largest number of raster cells drawn along each side of the map, more would not be visible at its size
+    MAX_CELLS = 1200
 
-    def __init__(self, user_location, highest_point, shortest_path_gpd):
+    def __init__(self, user_location, highest_point, shortest_path_gpd, layers=None):
         self.user_location = user_location
         self.highest_point = highest_point
         self.shortest_path_gpd = shortest_path_gpd
+        # Materials, loaded on first use and shared by the maps of this process
+        self.layers = layers if layers is not None else MapLayers.open()
+
+    # Plot the map and show it, or write it to a PNG file without any window (headless, e.g. on a server) if an
+    # output file is given
+    def plot_map(self, output_file=None):
+        with instruments.stage('plot'):
+            return self.__plot_map(output_file)
+
+    def __plot_map(self, output_file):
+        if output_file is None:
+            fig, ax = plt.subplots(figsize=(12, 8))
+        else:
+            # The Agg canvas draws the figure in memory, without pyplot or a display
+            fig = Figure(figsize=(12, 8))
+            FigureCanvasAgg(fig)
+            ax = fig.add_subplot()
+        bounds = self.layers.get_background().bounds
 
-    def plot_map(self):
-        bounds = background.bounds
-        palette = []
-        for key, val in background.colormap(1).items():
-            palette.append(val)
-        palette = np.array(palette)
-
-        # Drawing map background
-        background_image = palette[background.read(1)]
-        fig, ax = plt.subplots(figsize=(12, 8))
-        ax.imshow(background_image, extent=[bounds.left, bounds.right, bounds.bottom, bounds.top], zorder=0)
         ax.set_title('The shortest path between the user and the highest point within 5km radius', fontsize=15)
         ax.set_xlabel('Easting', fontsize=10)
         ax.set_ylabel('Northing', fontsize=10)
@@ -50,30 +52,42 @@ class Plotting:
         xmax = np.min([start_x + km * 500, bounds.right])
         ymin = np.max([start_y - km * 500, bounds.bottom])
         ymax = np.min([start_y + km * 500, bounds.top])
-        plt.xlim(xmin, xmax)
-        plt.ylim(ymin, ymax)
-
-        isle_of_wight.to_crs(CRS_BNG).plot(ax=ax, color='none')
-        road_nodes.to_crs(CRS_BNG).plot(ax=ax, markersize=3, color='grey')
-        road_links.to_crs(CRS_BNG).plot(ax=ax, linewidth=1, cmap='RdYlGn', column='descript_1')
+        view = (xmin, ymin, xmax, ymax)
+
+        # Drawing map background, only the window of the view is read and expanded through the palette
+        background_image, extent = self.layers.background_window(*view, max_size=self.MAX_CELLS)
+        if background_image is not None:
+            ax.imshow(background_image, extent=extent, zorder=0)
+        ax.set_xlim(xmin, xmax)
+        ax.set_ylim(ymin, ymax)
+
+        self.layers.get_isle_of_wight(view).plot(ax=ax, color='none')
+        self.layers.get_road_nodes(view).plot(ax=ax, markersize=3, color='grey')
+        road_links = self.layers.get_road_links()
+        # The colours of the road types are those of the whole layer, so they do not change with the view
+        road_links_view = self.layers.get_road_links(view)
+        road_links_view.plot(ax=ax, linewidth=1, cmap='RdYlGn', column='descript_1',
+                             categories=sorted(road_links['descript_1'].dropna().unique()))
 
         # Start, End Node and Path
-        plt.plot(start_x, start_y, 'ro', markersize=15, label='user point')
-        plt.plot(self.highest_point.x, self.highest_point.y, 'go', markersize=15, label='highest point')
+        ax.plot(start_x, start_y, 'ro', markersize=15, label='user point')
+        ax.plot(self.highest_point.x, self.highest_point.y, 'go', markersize=15, label='highest point')
         self.shortest_path_gpd.plot(ax=ax, edgecolor='orange', linewidth=5, label='shortest path', zorder=2)
 
-        # 5000m buffer elevation raster
+        # 5000m buffer elevation raster, read from the window around the user
         m = 5000
-        start = (start_x, start_y)
-        start_point = Point(start)
-        boundary = start_point.buffer(m)
-        polygon = Polygon([(elevation.bounds.left, elevation.bounds.bottom),
-                           (elevation.bounds.right, elevation.bounds.bottom),
-                           (elevation.bounds.right, elevation.bounds.top),
-                           (elevation.bounds.left, elevation.bounds.top)])
-        elev_masked, out_tf = mask(elevation, shapes=[boundary.intersection(polygon)], filled=False, crop=True)
-        raster_plot.show(source=elev_masked, ax=ax, zorder=1,
-                         transform=out_tf, alpha=0.5, cmap=plt.get_cmap('terrain'))
+        elevation = self.layers.get_elevation()
+        elev_array, out_tf, circle = elevation.read_circle(start_x, start_y, m)
+        if elev_array.size > 0:
+            hidden = ~circle
+            if elevation.get_nodata() is not None:
+                hidden |= elev_array == elevation.get_nodata()
+            # Only the cells which can be seen at the size of the map are drawn
+            step = max(int(np.ceil(max(xmax - xmin, ymax - ymin) / elevation.get_cell_size() / self.MAX_CELLS)), 1)
+            elev_array, hidden = elev_array[::step, ::step], hidden[::step, ::step]
+            out_tf = out_tf * Affine.scale(step)
+            raster_plot.show(source=np.ma.masked_array(elev_array, mask=hidden), ax=ax, zorder=1,
+                             transform=out_tf, alpha=0.5, cmap=plt.get_cmap('terrain'))
 
         # Adding North Arrow
         x, y, arrow_length = 0.9, 0.2, 0.1
@@ -87,16 +101,20 @@ class Plotting:
                                       label='1 km', loc=4, frameon=False, pad=0.6,
                                       size_vertical=0.7, color='black'))
 
-        # Adding Color Bar
-        dtm_array = elevation.read(1)
-        dtm = ax.imshow(dtm_array, cmap='terrain')
-        plt.text(1.15, 0.9, 'Elevation (m)', transform=ax.transAxes, fontsize=10)
-        plt.colorbar(dtm, ax=ax, orientation='vertical', anchor=(0.0, 0.5), shrink=0.8)
+        # Adding Color Bar, from the range of the whole DEM which is read once
+        vmin, vmax = self.layers.get_elevation_range()
+        dtm = cm.ScalarMappable(norm=colors.Normalize(vmin, vmax), cmap='terrain')
+        ax.text(1.15, 0.9, 'Elevation (m)', transform=ax.transAxes, fontsize=10)
+        fig.colorbar(dtm, ax=ax, orientation='vertical', anchor=(0.0, 0.5), shrink=0.8)
 
-        plt.legend()
-        plt.show()
+        ax.legend()
+        if output_file is None:
+            plt.show()
+        else:
+            fig.savefig(output_file)
+        return fig
 
 # References
 # https://matplotlib.org/3.1.0/api/_as_gen/mpl_toolkits.axes_grid1.anchored_artists.html
 # https://matplotlib.org/stable/api/_as_gen/matplotlib.pyplot.imshow.html#matplotlib.pyplot.imshow
-# https://snyk.io/advisor/python/rasterio/functions/rasterio.mask.mask
+# https://matplotlib.org/stable/api/backend_agg_api.html
@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+import benchmark
+from router import EvacuationRouter, elevation_file, road_file, shape_file
+from routing import ROUTING_BACKENDS
+
+# Number of random queries answered by every routing backend
+QUERIES = 30
+
+
+# Synthetic 'small' network of the benchmark (about 2 400 road nodes), generated once into a temporary folder
+@pytest.fixture(scope='module')
+def root(tmp_path_factory):
+    root = str(tmp_path_factory.mktemp('small'))
+    benchmark.generate(root, preset='small', seed=0, map_layers=False)
+    return root
+
+
+# Results of the same random queries answered by each routing backend
+@pytest.fixture(scope='module')
+def results(root):
+    locations = benchmark.random_locations(root, QUERIES, seed=1).tolist()
+    results = {}
+    for backend in ROUTING_BACKENDS:
+        router = EvacuationRouter(os.path.join(root, shape_file), os.path.join(root, road_file),
+                                  os.path.join(root, elevation_file), backend)
+        results[backend] = [router.route(x, y) for x, y in locations]
+        router.close()
+    return results
+
+
+# Every backend finds the same highest point, walking time and path as the CSR Dijkstra for every query
+@pytest.mark.parametrize('backend', [backend for backend in ROUTING_BACKENDS if backend != 'csr'])
+def test_same_routes(results, backend):
+    routed = 0
+    for expected, result in zip(results['csr'], results[backend]):
+        assert result.get('error') == expected.get('error')
+        if 'error' in expected:
+            continue
+        routed += 1
+        assert result['highest_point'] == expected['highest_point']
+        assert result['walking_time'] == pytest.approx(expected['walking_time'], rel=1e-9)
+        assert result['path'] == expected['path']
+        assert result['route'] == expected['route']
+    assert routed > 0
+
+
+# A* settles no more road nodes than Dijkstra, and the settled road nodes of each backend which counts them are
+# reported
+def test_settled(results):
+    settled = {backend: sum(result['settled'] for result in backend_results if result.get('settled') is not None)
+               for backend, backend_results in results.items() if backend != 'networkx'}
+    print('\nRoad nodes settled by ' + str(QUERIES) + ' queries: ' +
+          ', '.join(backend + ' ' + str(count) for backend, count in settled.items()))
+    assert 0 < settled['astar'] <= settled['csr']